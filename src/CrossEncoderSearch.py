@@ -1,19 +1,119 @@
-from sentence_transformers import CrossEncoder
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from encoders import backend_key, load_cross_encoder
+from tracing import tracer
+
+CROSS_ENCODER_MODEL = 'BAAI/bge-base-en-v1.5'
+
+_cross_encoders = {}
+_cross_encoders_lock = threading.Lock()
+
+def get_cross_encoder(model_name=CROSS_ENCODER_MODEL, max_length=512, backend='torch', threads=None):
+    """Returns the process-wide CrossEncoder for (model_name, max_length, backend), loading it on first use."""
+    key = (model_name, max_length, backend)
+    with _cross_encoders_lock:
+        if key not in _cross_encoders:
+            _cross_encoders[key] = load_cross_encoder(model_name, max_length, backend, threads)
+        return _cross_encoders[key]
+
+class ScoreCache:
+    """Thread-safe LRU of cross-encoder scores keyed by (model, query, passage hash)."""
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.scores = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            score = self.scores.get(key)
+            if score is not None:
+                self.scores.move_to_end(key)
+            return score
+
+    def put(self, key, score):
+        with self.lock:
+            self.scores[key] = score
+            self.scores.move_to_end(key)
+            while len(self.scores) > self.max_entries:
+                self.scores.popitem(last=False)
+
+score_cache = ScoreCache()
 
 class CrossencoderSearch:
 
-    def __init__(self,query,retrieved_docs):
+    def __init__(self,query,retrieved_docs,cross_encoding_model=None,model_name=CROSS_ENCODER_MODEL,
+                 max_length=512,max_passage_words=None,batch_size=32,cache=score_cache,backend='torch',threads=None):
 
         self.query=query
         self.pairs=retrieved_docs
         self.final_pairs=[]
-        self.cross_encoding_model= CrossEncoder('BAAI/bge-base-en-v1.5')
-
-    def run_cross_encoder(self):
-        self.final_pairs = [[self.query, doc_text, self.cross_encoding_model.predict([self.query, doc_text])] for doc_text in self.pairs]
-        self.final_pairs.sort(key=lambda x: x[2])
-        self.final_pairs.reverse()
-        return self.final_pairs
-        
+        self.cross_encoding_model= cross_encoding_model if cross_encoding_model is not None else get_cross_encoder(model_name, max_length, backend, threads)
+        # int8 scores differ slightly from torch ones, so each backend caches its own
+        self.model_key=(backend_key(model_name, backend), max_length, max_passage_words)
+        self.max_passage_words=max_passage_words
+        self.batch_size=batch_size
+        self.cache=cache
+
+    def truncate(self, doc_text):
+        # Cheap word-level cut before tokenization; the model still truncates to max_length tokens
+        if self.max_passage_words is None:
+            return doc_text
+        return ' '.join(doc_text.split()[:self.max_passage_words])
+
+    def score_pairs(self):
+        """Scores every retrieved doc against the query, predicting all cache misses in one batched call."""
+        scores = np.empty(len(self.pairs), dtype=np.float32)
+        with tracer.span('rerank.cache_lookup', pairs=len(self.pairs)):
+            keys = [(self.model_key, self.query, hashlib.md5(doc_text.encode()).hexdigest()) for doc_text in self.pairs]
+            misses = []
+            for i, key in enumerate(keys):
+                score = self.cache.get(key) if self.cache is not None else None
+                if score is None:
+                    misses.append(i)
+                else:
+                    scores[i] = score
+        tracer.count('rerank.cache_hits', len(self.pairs) - len(misses))
+        tracer.count('rerank.cache_misses', len(misses))
+
+        if misses:
+            # Length-sorted so each predict batch pads to similar lengths
+            misses.sort(key=lambda i: len(self.pairs[i]))
+            with tracer.span('rerank.predict', pairs=len(misses), batch_size=self.batch_size):
+                predicted = self.cross_encoding_model.predict(
+                    [[self.query, self.truncate(self.pairs[i])] for i in misses],
+                    batch_size=self.batch_size,
+                    show_progress_bar=False
+                )
+            for i, score in zip(misses, np.asarray(predicted, dtype=np.float32).reshape(-1)):
+                scores[i] = score
+                if self.cache is not None:
+                    self.cache.put(keys[i], float(score))
+        return scores
+
+    def run_cross_encoder(self, top_n=None):
+        """
+        Reranks the retrieved docs by cross-encoder score.
+
+        Args:
+        top_n (int): Keep only the best top_n docs, e.g. rerank 100 first-stage candidates down to 10.
+
+        Returns:
+        list: [query, doc_text, score] triples sorted by descending score.
+        """
+        with tracer.span('rerank', pairs=len(self.pairs), top_n=top_n):
+            scores = self.score_pairs()
+            with tracer.span('rerank.sort'):
+                order = np.argsort(-scores, kind='stable')[:top_n]
+                self.final_pairs = [[self.query, self.pairs[i], scores[i]] for i in order]
+            return self.final_pairs
+
 def dict_to_list(lst):
-    return ['. '.join(d['Context Before']) + d['Main Sentence'] + '. '.join(d['Context After']) for d in lst]
+    with tracer.span('rerank.dict_to_list', results=len(lst)):
+        # Merged passages (search with passages=True) are already one text each
+        return [d['Passage'] if 'Passage' in d else '. '.join(d['Context Before']) + d['Main Sentence'] + '. '.join(d['Context After'])
+                for d in lst]
@@ -2,114 +2,256 @@ import os
 import re
 import json
 import glob
+import time
+import hashlib
 import faiss
 # import torch
 import numpy as np
 import configparser
-import pandas as pd
 
-from tqdm import tqdm
-from autofaiss import build_index
+from collections import OrderedDict
 
-from sentence_transformers import SentenceTransformer
+from corpus_store import CORPUS_FOLDER, CorpusStore, build_context_offsets, live_file_ranges
+from crawl_manifest import open_manifest
+from embedding_store import EMBEDDINGS_FOLDER, EmbeddingShards
+from encoders import backend_key, check_backend, load_sentence_model, token_lengths
+from search_filter import filtered_search_params, select_vectors
+from passages import merge_windows
+from query_cache import index_version
+from segmenter import SEGMENTS_FOLDER, Segmenter
+from tracing import tracer
+
+PREPROCESS_PATTERN = re.compile(r'[^\w\s,.]')
+EMBEDDING_DTYPES = ('float32', 'float16')
+INDEX_LOAD_MODES = ('memory', 'mmap')
+DATAFRAME_COLUMNS = ['filename', 'text', 'position', 'text_hash', 'deleted']
+DATAFRAME_DTYPES = {'position': 'int64', 'deleted': 'bool'}
+
+def read_faiss_index(index_path, load_mode='memory'):
+    """Reads a faiss index onto the heap ('memory') or memory-mapped read-only ('mmap')."""
+    if load_mode != 'mmap':
+        return faiss.read_index(index_path)
+    index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    # IO_FLAG_MMAP maps the inverted lists of IVF indexes; flat and graph indexes map their codes with IO_FLAG_MMAP_IFC
+    if faiss.try_extract_index_ivf(index) is None and hasattr(faiss, 'IO_FLAG_MMAP_IFC'):
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    return index
+
+def apply_search_params(index, search_params):
+    """Sets "name=value,..." faiss search parameters, skipping those the index type does not have (nprobe on HNSW, ...)."""
+    parameter_space = faiss.ParameterSpace()
+    for param in search_params.split(','):
+        name, _, value = param.strip().partition('=')
+        try:
+            parameter_space.set_index_parameter(index, name, float(value))
+        except RuntimeError:
+            print(f"Search parameter {name} does not apply to {type(index).__name__}, skipped")
 
 class AutoFaissSentenceSearch:
-    def __init__(self,sentence_model, index_folder, max_index_memory_usage='10MB'):
+    def __init__(self,sentence_model, index_folder, max_index_memory_usage='10MB', batch_size=64, embedding_dtype='float32', compact_threshold=0.25,
+                 embed_workers=1, shard_rows=1000000, dedup=False, near_duplicates=False, near_duplicate_threshold=0.8,
+                 model_name=None, file_filter=None, index_key=None, index_load_mode='memory', search_params=None,
+                 segmentation='none', segment_workers=1, query_cache=None, rescan_database=False, encoder_backend='torch',
+                 encoder_threads=None, scan_changed_folders_only=False):
         self.index_folder = os.path.abspath(index_folder)
         
         if not os.path.exists(self.index_folder):
             os.makedirs(self.index_folder)
             
+        if embedding_dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"embedding_dtype must be one of {EMBEDDING_DTYPES}, got {embedding_dtype!r}")
+        if index_load_mode not in INDEX_LOAD_MODES:
+            raise ValueError(f"index_load_mode must be one of {INDEX_LOAD_MODES}, got {index_load_mode!r}")
+        check_backend(encoder_backend)
+
         self.max_index_memory_usage = max_index_memory_usage
-        self.sentence_model = SentenceTransformer(sentence_model)
+        self.batch_size = int(batch_size)
+        self.embedding_dtype = embedding_dtype
+        self.compact_threshold = compact_threshold
+        self.embed_workers = embed_workers
+        self.shard_rows = shard_rows
+        self.dedup = dedup
+        self.near_duplicates = near_duplicates
+        self.near_duplicate_threshold = near_duplicate_threshold
+        # Only pages whose relative path passes file_filter are indexed, e.g. the pages of one shard
+        self.file_filter = file_filter
+        # A faiss index factory string (e.g. "IVF4096,PQ32" or "HNSW32,SQ8") overrides the index type
+        # autofaiss would pick for max_index_memory_usage
+        self.index_key = index_key or None
+        self.index_load_mode = index_load_mode
+        self.search_params = search_params or None
+        # How page paragraphs are split into indexed sentences ('spacy', 'nltk', 'rules' or 'none');
+        # segmented pages are cached by file hash under index_folder/segments
+        self.segmentation = segmentation
+        self.segment_workers = segment_workers
+        self.segmenter_instance = None
+        # Pages are listed from the crawl manifest of rag_database, which every build first brings in line
+        # with the page folders. scan_changed_folders_only scans just the folders whose mtime changed,
+        # missing pages edited in place; rescan_database overrides it with a full scan
+        self.rescan_database = rescan_database
+        self.scan_changed_folders_only = scan_changed_folders_only
+        # An already loaded SentenceTransformer can be passed in to share it between instances;
+        # model_name then names it for embedding hashes and for loading it in encode workers.
+        # encoder_backend says how it is (or was) loaded: 'int8' vectors are hashed and cached apart from 'torch' ones
+        self.encoder_backend = encoder_backend
+        if isinstance(sentence_model, str):
+            self.sentence_model_name = backend_key(sentence_model, encoder_backend)
+            self.sentence_model_path = sentence_model
+            self.sentence_model = load_sentence_model(sentence_model, encoder_backend, encoder_threads)
+        else:
+            self.sentence_model_name = backend_key(model_name or getattr(sentence_model, 'model_name', type(sentence_model).__name__),
+                                                   encoder_backend)
+            self.sentence_model_path = model_name
+            self.sentence_model = sentence_model
         self.index = None
+        self.df = None
+        self.corpus = None
+        self.processed_files = {}
+        self.encode_stats = {}
+        # Compiled search filters, most recently used last
+        self.selections = OrderedDict()
+        self.max_selections = 64
+        self.embeddings = None
+        # Query embeddings and results, shared with other instances and processes through a QueryCache
+        self.query_cache = query_cache
+        self.index_version = None
+
+    @property
+    def segmenter(self):
+        # Created on first use, so search-only instances never check for spaCy or NLTK
+        if self.segmenter_instance is None:
+            self.segmenter_instance = Segmenter(self.segmentation, self.segment_workers,
+                                                os.path.join(self.index_folder, SEGMENTS_FOLDER))
+        return self.segmenter_instance
+
+    @property
+    def manifest(self):
+        database_dir = os.path.join(os.getcwd(), 'rag_database')
+        return open_manifest(database_dir) if os.path.isdir(database_dir) else None
 
     def preprocess_text(self, text):
         # Your existing preprocessing code
-        return re.sub(r'[^\w\s,.]', '', text)
+        return PREPROCESS_PATTERN.sub('', text)
+
+    def token_lengths(self, texts):
+        return token_lengths(self.sentence_model, texts)
 
     def load_processed_files(self, path):
+        """
+        Returns {relative file path: md5 of its contents} for every file already in the index.
+        Lines written before content hashes were recorded map to an empty hash.
+        """
+        processed_files = {}
         if os.path.exists(path):
             with open(path, "r") as file:
-                return set(file.read().splitlines())
-        return set()
+                for line in file.read().splitlines():
+                    if line:
+                        filename, _, file_hash = line.partition("\t")
+                        processed_files[filename] = file_hash
+        return processed_files
 
     def save_processed_files(self, processed_files, path):
-        with open(path, "w") as file:
-            for filename in processed_files:
-                file.write(f"{filename}\n")
-
-    def create_dataframe_from_json(self, processed_files_path):
-        processed_files = self.load_processed_files(processed_files_path)
-        new_data = []
-        new_data_found = False
-    
-        # Directories
-        current_working_directory = os.getcwd()
-        wiki_dir = os.path.join(current_working_directory,'rag_database','wikipedia')
-        bing_dir = os.path.join(current_working_directory,'rag_database','bing_search')
-    
-        # Process Wikipedia files
-        for filename in sorted(os.listdir(wiki_dir)):
-            if filename.endswith('.json'):# and filename not in processed_files:
-                new_data_found = True
-                with open(os.path.join(wiki_dir, filename), 'r') as file:
-                    json_data = json.load(file)
-                    position = 0  # Reset position counter for each file
-                    if 'Title' in json_data:
-                        new_data.append({'filename': filename, 'text': json_data['Title'], 'position': position})
-                        position += 1
-                    if 'Description' in json_data:
-                        new_data.append({'filename': filename, 'text': json_data['Description'], 'position': position})
-                        position += 1
-                    for line in json_data.get('PageText', []):
-                        new_data.append({'filename': filename, 'text': line, 'position': position})
-                        position += 1
-                processed_files.add(filename)
-    
-        # Process Bing files
-        for hash_dir in os.listdir(bing_dir):
-            hash_dir_path = os.path.join(bing_dir, hash_dir)
-            if os.path.isdir(hash_dir_path):
-                for filename in sorted(os.listdir(hash_dir_path)):
-                    if filename.endswith('.json'):# and filename not in processed_files:
-                        new_data_found = True
-                        with open(os.path.join(hash_dir_path, filename), 'r') as file:
-                            json_data = json.load(file)
-                            position = 0  # Reset position counter for each file
-                            if 'Title' in json_data:
-                                new_data.append({'filename': filename, 'text': json_data['Title'], 'position': position})
-                                position += 1
-                            if 'Description' in json_data:
-                                new_data.append({'filename': filename, 'text': json_data['Description'], 'position': position})
-                                position += 1
-                            for line in json_data.get('PageText', []):
-                                new_data.append({'filename': filename, 'text': line, 'position': position})
-                                position += 1
-                        processed_files.add(filename)
-    
-        if new_data_found:
-            new_df = pd.DataFrame(new_data, columns=['filename', 'text', 'position'])
-            if hasattr(self, 'df') and self.df is not None:
-                self.df = pd.concat([self.df, new_df], ignore_index=True)
-            else:
+        with open(f"{path}.tmp", "w") as file:
+            for filename, file_hash in sorted(processed_files.items()):
+                file.write(f"{filename}\t{file_hash}\n")
+        os.replace(f"{path}.tmp", path)
+
+    def discover_json_files(self):
+        """
+        Returns {relative path: absolute path} for every page under rag_database, as recorded in its
+        crawl manifest. Bing pages keep their query hash directory so the same link saved by two
+        queries stays distinct.
+        """
+        manifest = self.manifest
+        if manifest is None:
+            return {}
+        manifest.sync(self.rescan_database, self.scan_changed_folders_only)
+        json_files = {filename: os.path.join(manifest.database_dir, filename) for filename in manifest.page_paths()}
+        if self.file_filter is not None:
+            json_files = {filename: path for filename, path in json_files.items() if self.file_filter(filename)}
+        return json_files
+
+    def read_json_file(self, json_path):
+        with open(json_path, 'rb') as file:
+            content = file.read()
+        return hashlib.md5(content).hexdigest(), json.loads(content)
+
+    def json_to_sentences(self, json_data):
+        sentences = []
+        if 'Title' in json_data:
+            sentences.append(json_data['Title'])
+        if 'Description' in json_data:
+            sentences.append(json_data['Description'])
+        sentences.extend(json_data.get('PageText', []))
+        return sentences
+
+    def text_hash(self, preprocessed_text):
+        # Content address of an embedding: same preprocessed text and model, same vector
+        return hashlib.md5(f"{self.sentence_model_name}\0{preprocessed_text}".encode()).hexdigest()
+
+    def create_dataframe_from_json(self, processed_files_path, previous_df=None):
+        """
+        Builds the sentence DataFrame for the current rag_database contents with the parse and segment
+        stages of IngestPipeline. build_index streams these stages straight into the index; this keeps
+        their output in memory, e.g. to inspect or benchmark them.
+
+        Args:
+        processed_files_path (str): Path of the processed files manifest.
+        previous_df (DataFrame): Rows already in the index. When given, only new or changed files are
+            read and appended after them; rows of changed or removed files are tombstoned.
+
+        Returns:
+        DataFrame: Rows with filename, text, position, text_hash and deleted columns.
+        """
+        import pandas as pd
+        from ingest_pipeline import IngestPipeline
+        with tracer.span('build.create_dataframe_from_json') as span:
+            processed_files = self.load_processed_files(processed_files_path) if previous_df is not None else {}
+            json_files = self.discover_json_files()
+            pipeline = IngestPipeline(self)
+            new_data = []
+            for filename, file_hash, sentences in self.segmenter.segment_stream(pipeline.parse_files(json_files, processed_files)):
+                for position, text in enumerate(sentences):
+                    new_data.append({'filename': filename, 'text': text, 'position': position,
+                                     'text_hash': self.text_hash(self.preprocess_text(text)), 'deleted': False})
+                processed_files[filename] = file_hash
+
+            # Pin dtypes so an empty batch of new rows cannot turn the columns into objects on concat
+            new_df = pd.DataFrame(new_data, columns=DATAFRAME_COLUMNS).astype(DATAFRAME_DTYPES)
+            if previous_df is None:
                 self.df = new_df
-            self.df.to_pickle(os.path.join(self.index_folder, "dataframe.pkl"))
-        elif not hasattr(self, 'df') or self.df is None:
-            try:
-                self.df = pd.read_pickle(os.path.join(self.index_folder, "dataframe.pkl"))
-            except FileNotFoundError:
-                print("No existing DataFrame found. Please ensure there's at least some initial data.")
-        
-        self.save_processed_files(processed_files, processed_files_path)
-        return self.df
-    
+                stale_files = set()
+            else:
+                # Changed files are re-added below, removed files disappear; both lose their old rows
+                stale_files = set(pipeline.changed_files) | (set(processed_files) - set(json_files))
+                for filename in set(processed_files) - set(json_files):
+                    del processed_files[filename]
+                previous_df = previous_df.copy()
+                previous_df.loc[previous_df['filename'].isin(stale_files), 'deleted'] = True
+                self.df = pd.concat([previous_df, new_df], ignore_index=True)
+
+            print(f"{len(new_df)} new sentences from {new_df['filename'].nunique()} files, {len(stale_files)} files tombstoned")
+            span.set(files=len(json_files), new_sentences=len(new_df), stale_files=len(stale_files))
+            self.processed_files = processed_files
+            return self.df
+
     def generate_embeddings(self, dataframe):
-        embeddings = []
-        for text in tqdm(dataframe['text']):
-            preprocessed_text = self.preprocess_text(text)
-            embedding = self.sentence_model.encode(preprocessed_text, normalize_embeddings=True)
-            embeddings.append(embedding)
+        """Encodes the text column of dataframe with the embed stage of IngestPipeline and returns one (rows, d) array."""
+        from ingest_pipeline import IngestPipeline
+        with tracer.span('build.preprocess', sentences=len(dataframe)):
+            texts = [self.preprocess_text(text) for text in dataframe['text']]
+        start_time = time.perf_counter()
+        embeddings = IngestPipeline(self).encode(texts)
+        elapsed = max(time.perf_counter() - start_time, 1e-9)
+
+        self.encode_stats = {
+            'sentences': len(texts),
+            'seconds': elapsed,
+            'sentences_per_sec': len(texts) / elapsed,
+            'batch_size': self.batch_size,
+            'dtype': self.embedding_dtype
+        }
+        print(f"Encoded {len(texts)} sentences in {elapsed:.2f}s ({len(texts) / elapsed:.1f} sentences/sec)")
         return embeddings
 
     def save_index(self):
@@ -119,84 +261,284 @@ class AutoFaissSentenceSearch:
             print("No index to save.")
 
     def load_index(self):
+        """
+        Reads the faiss index. In 'mmap' mode the index data is memory-mapped read-only instead of
+        copied onto the heap, so search processes on one machine share a single copy of its pages.
+        search_params (e.g. "nprobe=32" or "efSearch=64") are applied after loading.
+        """
         try:
             print(glob.glob(f"{self.index_folder}/*.index"))
-            self.index = faiss.read_index(glob.glob(f"{self.index_folder}/*.index")[0])
+            self.index = read_faiss_index(glob.glob(f"{self.index_folder}/*.index")[0], self.index_load_mode)
             # index = faiss.read_index(glob.glob(f"{args.index_dir}/*.index")[0])
         except FileNotFoundError:
             print("Index file not found.")
+            return
+        if self.search_params:
+            apply_search_params(self.index, self.search_params)
+        self.index_version = index_version(self.index_folder)
 
-    def load_dataframe(self):
+    def read_dataframe(self):
+        corpus_path = os.path.join(self.index_folder, CORPUS_FOLDER)
+        if os.path.exists(os.path.join(corpus_path, "meta.json")):
+            return CorpusStore(corpus_path).to_dataframe()
+
+        # Index folders built before the corpus store existed
         df_path = os.path.join(self.index_folder, "dataframe.pkl")
-        if os.path.exists(df_path):
-            self.df = pd.read_pickle(df_path)
-        else:
+        if not os.path.exists(df_path):
+            return None
+        import pandas as pd
+        df = pd.read_pickle(df_path)
+        # Indexes built before incremental builds carry no tombstones
+        if 'deleted' not in df:
+            df['deleted'] = False
+        return df.astype(DATAFRAME_DTYPES)
+
+    def load_dataframe(self):
+        """
+        Opens the corpus for searching. The columnar store is memory-mapped, so only the rows a
+        query touches are ever read; a legacy dataframe.pkl is loaded whole as before.
+        """
+        corpus_path = os.path.join(self.index_folder, CORPUS_FOLDER)
+        if os.path.exists(os.path.join(corpus_path, "meta.json")):
+            self.corpus = CorpusStore(corpus_path)
+            self.texts = self.corpus.text
+            self.deleted = self.corpus.deleted
+            # faiss ids are vector ids; duplicate rows share one and it resolves to a live row
+            self.index_rows = self.corpus.index_rows
+            self.num_deleted = self.corpus.num_dead_vectors
+            self.block_offsets = self.corpus.block_offsets
+            self.row_blocks = self.corpus.row_blocks
+            self.filenames = self.corpus.filenames
+            self.file_ids = self.corpus.file_ids
+            self.vector_ids = self.corpus.vector_ids
+            self.selections.clear()
+            self.index_version = index_version(self.index_folder)
+            return
+
+        self.df = self.read_dataframe()
+        if self.df is None:
             print("DataFrame file not found.")
+            return
+        self.corpus = None
+        self.texts = self.df['text'].tolist()
+        self.deleted = self.df['deleted'].to_numpy()
+        self.index_rows = np.where(self.deleted, -1, np.arange(len(self.df)))
+        self.num_deleted = int(self.deleted.sum())
+        self.block_offsets, self.row_blocks = build_context_offsets(self.df['filename'].to_numpy(), self.df['position'].to_numpy())
+        import pandas as pd
+        file_ids, filenames = pd.factorize(self.df['filename'])
+        self.filenames = filenames.tolist()
+        self.file_ids = file_ids
+        self.vector_ids = np.arange(len(self.df))
+        self.selections.clear()
+        self.index_version = index_version(self.index_folder)
 
-    def build_index(self):
-        processed_files_path = os.path.join(self.index_folder, "processed_files.txt")
-        self.df = self.create_dataframe_from_json(processed_files_path)
-        
-        embeddings = self.generate_embeddings(self.df)
-        embeddings_array = np.array(embeddings)
+    @property
+    def file_ranges(self):
+        if self.corpus is not None:
+            return self.corpus.file_ranges
+        return live_file_ranges(self.file_ids, self.deleted, len(self.filenames))
 
-        if not os.path.exists(self.index_folder):
-            os.makedirs(self.index_folder)
+    def build_index(self, full_rebuild=False):
+        """
+        Brings the index in line with rag_database through the streaming IngestPipeline. Only new or
+        changed files are read and embedded, vectors for text seen before are reused, and the new rows
+        are appended to the embedding shards, the corpus store and the faiss index. A full autofaiss
+        build happens on the first run, when full_rebuild is set, or when tombstoned rows exceed
+        compact_threshold of the index.
+        """
+        # Build-only dependencies (pandas, torch workers, autofaiss) stay off the search path
+        from ingest_pipeline import IngestPipeline
+        pipeline = IngestPipeline(self, embed_workers=self.embed_workers, shard_rows=self.shard_rows)
+        pipeline.run(full_rebuild)
+        self.load_dataframe()
+        print(f"Index built and saved to {os.path.join(self.index_folder, 'knn.index')}")
 
-        # Define the paths for saving the embeddings and index files
-        embeddings_path = os.path.join(self.index_folder, "embeddings.npy")
+    def build_autofaiss_index(self):
         index_path = os.path.join(self.index_folder, "knn.index")
         index_infos_path = os.path.join(self.index_folder, "infos.json")
 
-        # Save the embeddings to a file
-        np.save(embeddings_path, embeddings_array)
+        # Build and save the index using AutoFaiss, streaming the embedding shards from disk
+        from autofaiss import build_index
+        build_kwargs = {'index_key': self.index_key} if self.index_key else {}
+        with tracer.span('build.autofaiss', index_key=self.index_key):
+            build_index(
+                embeddings=os.path.join(self.index_folder, EMBEDDINGS_FOLDER),
+                index_path=index_path,
+                index_infos_path=index_infos_path,
+                max_index_memory_usage=self.max_index_memory_usage,
+                **build_kwargs
+            )
 
-        # Build and save the index using AutoFaiss
-        build_index(
-            embeddings=self.index_folder,
-            index_path=index_path,
-            index_infos_path=index_infos_path,
-            max_index_memory_usage=self.max_index_memory_usage
-        )
+    def index_stats(self):
+        return {'index_folder': self.index_folder, 'sentences': len(self.texts), 'vectors': self.index.ntotal}
 
-        self.df.to_pickle(os.path.join(self.index_folder, "dataframe.pkl"))
-        
-        print(f"Index built and saved to {index_path}")
+    def context_window(self, row, context_size):
+        """Returns (context_before, main_sentence, context_after) for a row, bounded by its file's run of rows."""
+        block = self.row_blocks[row]
+        start = max(int(self.block_offsets[block]), row - context_size)
+        end = min(int(self.block_offsets[block + 1]), row + context_size + 1)
+        return self.texts[start:row], self.texts[row], self.texts[row + 1:end]
 
-        
-        # embeddings_tensor = torch.tensor(np.array(embeddings), dtype=torch.float32)
-        # self.index, _ = build_index(embeddings_tensor.numpy(), save_on_disk=False)
-
-    def search_sentences(self, query, top_k=5, context_size=3):
-        preprocessed_query = self.preprocess_text(query)
-        q_embedding = self.sentence_model.encode(preprocessed_query, normalize_embeddings=True)
-        q_embedding = q_embedding.reshape(1, -1)
-        _, I = self.index.search(q_embedding, top_k)
-
-        results = []
-        for idx in I[0]:
-            file_position = self.df.iloc[idx]['position']
-            filename = self.df.iloc[idx]['filename']
-    
-            # Get context sentences
-            start_pos = max(0, file_position - context_size)
-            end_pos = min(len(self.df), file_position + context_size + 1)
-            context_df = self.df[(self.df['filename'] == filename) & 
-                                 (self.df['position'] >= start_pos) & 
-                                 (self.df['position'] < end_pos)]
-    
-            context_before = context_df[context_df['position'] < file_position]['text'].tolist()
-            context_after = context_df[context_df['position'] > file_position]['text'].tolist()
-            main_sentence = self.df.iloc[idx]['text']
-    
-            sentence_info = {
-                'Main Sentence': main_sentence,
-                'Context Before': context_before,
-                'Context After': context_after
-            }
-            results.append(sentence_info)
-            if len(results) >= top_k:
-                break
-
-        return results
+    def search_sentences(self, query, top_k=5, context_size=3, search_filter=None, passages=False, max_passage_tokens=None):
+        return self.search_sentences_batch([query], top_k=top_k, context_size=context_size, search_filter=search_filter,
+                                           passages=passages, max_passage_tokens=max_passage_tokens)[0]
+
+    def encode_queries(self, queries):
+        with tracer.span('search.preprocess', queries=len(queries)):
+            preprocessed_queries = [self.preprocess_text(query) for query in queries]
+        if self.query_cache is not None:
+            return self.query_cache.encode(self.sentence_model_name, preprocessed_queries, self.encode_preprocessed)
+        return self.encode_preprocessed(preprocessed_queries)
+
+    def encode_preprocessed(self, preprocessed_queries):
+        with tracer.span('search.encode', queries=len(preprocessed_queries)):
+            q_embeddings = self.sentence_model.encode(preprocessed_queries, batch_size=self.batch_size,
+                                                      normalize_embeddings=True, convert_to_numpy=True)
+        return np.ascontiguousarray(q_embeddings, dtype='float32')
+
+    def search_sentences_batch(self, queries, top_k=5, context_size=3, search_filter=None, passages=False, max_passage_tokens=None):
+        """
+        Searches many queries with one encode call and one faiss search over the (Q, d) query matrix.
+
+        Args:
+        queries (list): Query strings.
+        top_k (int): Number of sentences to return per query.
+        context_size (int): Number of sentences to include before and after each match.
+        search_filter (SearchFilter): Only return sentences of matching pages.
+        passages (bool): Merge the context windows of the top_k hits that overlap or touch in the same
+            file into passages, e.g. to rerank each stretch of text once.
+        max_passage_tokens (int): Token budget of a passage, counted with the sentence model's tokenizer.
+
+        Returns:
+        list: One list of search_sentences style result dicts per query, in query order. With passages,
+        one {'Passage', 'Main Sentences', 'Score'} dict per passage, best first-stage score first.
+        """
+        if not len(queries):
+            return []
+        with tracer.span('search', queries=len(queries), top_k=top_k):
+            search = lambda queries: self.search_embeddings(self.encode_queries(queries), top_k, context_size, search_filter=search_filter,
+                                                            passages=passages, max_passage_tokens=max_passage_tokens)
+            if self.query_cache is not None:
+                return self.query_cache.search_batch(self.index_version, self.sentence_model_name, queries, top_k, context_size,
+                                                     search, search_filter,
+                                                     passages=(max_passage_tokens or 0) if passages else None)
+            return search(queries)
+
+    def search_embeddings(self, q_embeddings, top_k=5, context_size=3, with_scores=False, search_filter=None, passages=False,
+                          max_passage_tokens=None):
+        """
+        Searches already encoded queries. With with_scores, every result is a (faiss distance, result dict) pair.
+        """
+        if top_k <= 0:
+            return [[] for _ in range(len(q_embeddings))]
+        if search_filter:
+            return self.search_filtered(q_embeddings, top_k, context_size, with_scores, search_filter, passages, max_passage_tokens)
+        # Over-fetch by the number of vectors without live rows so they can be skipped without running short
+        k = min(top_k + self.num_deleted, self.index.ntotal)
+        with tracer.span('search.index_search', queries=len(q_embeddings), k=k):
+            D, I = self.index.search(q_embeddings, k)
+        with tracer.span('search.context', queries=len(q_embeddings)):
+            rows = self.index_rows[np.maximum(I, 0)]
+            return self.assemble_results(D, rows, (I >= 0) & (rows >= 0), top_k, context_size, with_scores, passages, max_passage_tokens)
+
+    def select(self, search_filter):
+        """Returns the FilterSelection of search_filter, compiling it on first use."""
+        selection = self.selections.get(search_filter.key)
+        if selection is None:
+            with tracer.span('search.compile_filter'):
+                selection = select_vectors(search_filter, self.filenames, self.file_ranges, self.file_ids, self.deleted,
+                                           self.vector_ids, self.index.ntotal)
+            self.selections[search_filter.key] = selection
+            while len(self.selections) > self.max_selections:
+                self.selections.popitem(last=False)
+        self.selections.move_to_end(search_filter.key)
+        return selection
+
+    def search_filtered(self, q_embeddings, top_k, context_size, with_scores, search_filter, passages=False, max_passage_tokens=None):
+        """
+        Searches only the vectors of pages matching search_filter: faiss skips every other vector
+        through an ID selector, so no results are fetched just to be discarded. Queries the index
+        still answers short (an HNSW graph or the probed IVF lists holding too few eligible vectors)
+        are searched exactly over the eligible embeddings, so each query gets min(top_k, eligible) results.
+        """
+        selection = self.select(search_filter)
+        k = min(top_k, len(selection))
+        if not k:
+            return [[] for _ in range(len(q_embeddings))]
+        with tracer.span('search.index_search', queries=len(q_embeddings), k=k, eligible=len(selection)):
+            D, I = self.index.search(q_embeddings, k, params=filtered_search_params(self.index, selection.selector))
+        short = np.flatnonzero((I < 0).any(axis=1))
+        if len(short) and os.path.isdir(os.path.join(self.index_folder, EMBEDDINGS_FOLDER)):
+            with tracer.span('search.exact_search', queries=len(short), eligible=len(selection)):
+                D[short], I[short] = self.exact_search(q_embeddings[short], selection.vectors, k)
+        with tracer.span('search.context', queries=len(q_embeddings)):
+            rows = selection.rows_of(I)
+            return self.assemble_results(D, rows, rows >= 0, top_k, context_size, with_scores, passages, max_passage_tokens)
+
+    def exact_search(self, q_embeddings, vector_ids, k, chunk_rows=65536):
+        """Exact top k of q_embeddings among the stored embeddings of vector_ids, in the index's metric."""
+        if self.embeddings is None:
+            self.embeddings = EmbeddingShards(os.path.join(self.index_folder, EMBEDDINGS_FOLDER))
+        inner_product = self.index.metric_type == faiss.METRIC_INNER_PRODUCT
+        heap = faiss.ResultHeap(len(q_embeddings), k, keep_max=inner_product)
+        for start in range(0, len(vector_ids), chunk_rows):
+            chunk_ids = vector_ids[start:start + chunk_rows]
+            vectors = np.ascontiguousarray(self.embeddings.take(chunk_ids), dtype='float32')
+            D, I = faiss.knn(q_embeddings, vectors, min(k, len(chunk_ids)),
+                             metric=faiss.METRIC_INNER_PRODUCT if inner_product else faiss.METRIC_L2)
+            heap.add_result(D, np.where(I >= 0, chunk_ids[np.maximum(I, 0)], -1))
+        heap.finalize()
+        return heap.D, heap.I
+
+    def assemble_results(self, D, rows, valid, top_k, context_size, with_scores, passages=False, max_passage_tokens=None):
+        # Context bounds for every hit at once; each window is then a pair of list slices
+        rows = np.maximum(rows, 0)
+        blocks = self.row_blocks[rows]
+        starts = np.maximum(self.block_offsets[blocks], rows - context_size)
+        ends = np.minimum(self.block_offsets[blocks + 1], rows + context_size + 1)
+        if passages:
+            return self.assemble_passages(D, rows, valid, blocks, starts, ends, top_k, with_scores, max_passage_tokens)
+
+        batch_results = []
+        for query_scores, query_rows, query_valid, query_starts, query_ends in zip(D.tolist(), rows.tolist(), valid.tolist(),
+                                                                                   starts.tolist(), ends.tolist()):
+            results = []
+            for score, row, is_valid, start, end in zip(query_scores, query_rows, query_valid, query_starts, query_ends):
+                if len(results) >= top_k:
+                    break
+                if not is_valid:
+                    continue
+                sentence_info = {
+                    'Main Sentence': self.texts[row],
+                    'Context Before': self.texts[start:row],
+                    'Context After': self.texts[row + 1:end]
+                }
+                results.append((score, sentence_info) if with_scores else sentence_info)
+            batch_results.append(results)
+        return batch_results
 
+    def assemble_passages(self, D, rows, valid, blocks, starts, ends, top_k, with_scores, max_passage_tokens=None):
+        batch_results = []
+        for query_scores, query_rows, query_valid, query_blocks, query_starts, query_ends in zip(
+                D.tolist(), rows.tolist(), valid.tolist(), blocks.tolist(), starts.tolist(), ends.tolist()):
+            windows = [window for window in zip(range(len(query_rows)), query_blocks, query_starts, query_ends, query_rows, query_valid)
+                       if window[-1]][:max(top_k, 0)]
+            row_tokens = None
+            if max_passage_tokens is not None:
+                # Token counts of every row the windows cover, looked up by prefix sums
+                covered = sorted({row for window in windows for row in range(window[2], window[3])})
+                position = {row: i for i, row in enumerate(covered)}
+                cumulative = np.concatenate([[0], np.cumsum(self.token_lengths([self.texts[row] for row in covered]))]).tolist()
+                row_tokens = lambda start, end: cumulative[position[end - 1] + 1] - cumulative[position[start]]
+            results = []
+            for passage in merge_windows([window[:5] for window in windows], row_tokens, max_passage_tokens):
+                score = query_scores[passage.best]
+                passage_info = {
+                    'Passage': ' '.join(self.texts[passage.start:passage.end]),
+                    'Main Sentences': [self.texts[row] for row in passage.hit_rows],
+                    'Score': score
+                }
+                results.append((score, passage_info) if with_scores else passage_info)
+            batch_results.append(results)
+        return batch_results
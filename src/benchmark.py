@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import hashlib
+import platform
+import resource
+import subprocess
+import configparser
+import faiss
+import numpy as np
+
+from autofaiss_index import AutoFaissSentenceSearch
+from CrossEncoderSearch import CrossencoderSearch, dict_to_list
+from tracing import tracer
+
+# For each metric, whether a larger value is an improvement
+METRIC_DIRECTIONS = {
+    'seconds': False,
+    'sentences_per_sec': True,
+    'queries_per_sec': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'peak_rss_mb': False
+}
+# Differences below these are timer noise on small corpora and never count as regressions
+NOISE_FLOORS = {'seconds': 0.01, 'p50_ms': 0.05, 'p95_ms': 0.05, 'p99_ms': 0.05, 'peak_rss_mb': 5.0}
+
+class HashingEncoder:
+    """
+    Tiny offline stand-in for a SentenceTransformer: each word hashes to a fixed random vector and
+    a sentence embeds as their sum. Deterministic, no downloads, and cheap enough that the benchmark
+    measures the pipeline around the model rather than the model.
+    """
+
+    model_name = 'hashing-encoder'
+    tokenizer = None
+
+    def __init__(self, dimension=64, buckets=4096, seed=0):
+        self.dimension = dimension
+        self.buckets = buckets
+        self.projection = np.random.default_rng(seed).standard_normal((buckets, dimension)).astype(np.float32)
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, convert_to_numpy=True, show_progress_bar=False, **kwargs):
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else sentences
+        embeddings = np.zeros((len(sentences), self.dimension), dtype=np.float32)
+        for row, sentence in enumerate(sentences):
+            buckets = [zlib.crc32(word.encode()) % self.buckets for word in sentence.lower().split()]
+            if buckets:
+                embeddings[row] = self.projection[buckets].sum(axis=0)
+        if normalize_embeddings:
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings[0] if single else embeddings
+
+class OverlapCrossEncoder:
+    """Offline stand-in for a CrossEncoder: scores a pair by the word overlap of query and passage."""
+
+    def predict(self, sentences, batch_size=32, show_progress_bar=False, **kwargs):
+        scores = np.empty(len(sentences), dtype=np.float32)
+        for row, (query, passage) in enumerate(sentences):
+            query_words = set(query.lower().split())
+            passage_words = set(passage.lower().split())
+            scores[row] = len(query_words & passage_words) / max(len(query_words | passage_words), 1)
+        return scores
+
+def generate_corpus(folder, wiki_pages=200, bing_queries=10, results_per_query=20, sentences_per_page=40,
+                    boilerplate_rate=0.1, vocabulary_size=5000, seed=0):
+    """
+    Writes a synthetic rag_database under folder in the layout of the downloaders: Wikipedia pages
+    in wikipedia/, Bing results in bing_search/<query hash>/. Bing pages mix in boilerplate lines and
+    copies of Wikipedia sentences at boilerplate_rate, like scraped pages do.
+
+    Returns:
+    dict: Page and sentence counts.
+    """
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+                  for _ in range(vocabulary_size)]
+    # Zipf-like word frequencies, so some words are much more common than others
+    weights = [1 / (rank + 1) for rank in range(vocabulary_size)]
+
+    def sentence():
+        return ' '.join(rng.choices(vocabulary, weights=weights, k=rng.randint(8, 30)))
+
+    database = os.path.join(folder, 'rag_database')
+    shutil.rmtree(database, ignore_errors=True)
+    wiki_dir = os.path.join(database, 'wikipedia')
+    os.makedirs(wiki_dir)
+    boilerplate = [sentence() for _ in range(20)]
+    wiki_sentences = []
+    sentences = 0
+
+    for page in range(wiki_pages):
+        page_text = [sentence() for _ in range(sentences_per_page)]
+        wiki_sentences.extend(page_text[:5])
+        with open(os.path.join(wiki_dir, f"page_{page}.json"), 'w') as file:
+            json.dump({'Title': f"Page {page}", 'PageText': page_text}, file)
+        sentences += len(page_text) + 1
+
+    for query in range(bing_queries):
+        query_dir = os.path.join(database, 'bing_search', hashlib.md5(f"query {query}".encode()).hexdigest())
+        os.makedirs(query_dir)
+        for result in range(results_per_query):
+            page_text = []
+            for _ in range(sentences_per_page):
+                if rng.random() < boilerplate_rate:
+                    page_text.append(rng.choice(boilerplate if rng.random() < 0.5 or not wiki_sentences else wiki_sentences))
+                else:
+                    page_text.append(sentence())
+            link_hash = hashlib.md5(f"query {query} result {result}".encode()).hexdigest()
+            with open(os.path.join(query_dir, f"{link_hash}.json"), 'w') as file:
+                json.dump({'Title': f"Result {result}", 'Description': sentence(), 'PageText': page_text,
+                           'Position': result + 1, 'Hash': link_hash}, file)
+            sentences += len(page_text) + 2
+
+    return {'wiki_pages': wiki_pages, 'bing_pages': bing_queries * results_per_query, 'sentences': sentences}
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+def latency_stats(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'seconds': float(latencies.sum() / 1000)
+    }
+
+def timed(stages, name, fn, sentences=None, repeats=1):
+    # Repeated stages report their median time
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    seconds = float(np.median(times))
+    stages[name] = {'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}
+    if sentences is not None:
+        stages[name]['sentences_per_sec'] = sentences / max(seconds, 1e-9)
+    print(f"{name}: {seconds:.3f}s")
+    return result
+
+def traced_stages(stages, fn, prefix='build.'):
+    """
+    Runs fn with the tracer on and adds the total time of every stage span under prefix to stages.
+    Pipeline stages overlap on their threads, so their times add up to more than the wall time.
+    """
+    was_enabled = tracer.enabled
+    tracer.reset()
+    tracer.enabled = True
+    try:
+        result = fn()
+    finally:
+        tracer.enabled = was_enabled
+    for name, metrics in sorted(tracer.stages.items()):
+        if name.startswith(prefix):
+            stages[name] = {'seconds': metrics.total, 'calls': metrics.count}
+    tracer.reset()
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(folder='benchmark', wiki_pages=200, bing_queries=10, results_per_query=20, sentences_per_page=40,
+                  num_queries=200, top_k=5, rerank_candidates=100, batch_size=64, model=None, seed=0, repeats=3):
+    """
+    Generates a corpus under folder and times every stage of building and searching it. Builds run
+    once; loads and the query set run repeats times, with latencies pooled over all passes.
+
+    Args:
+    model (str): SentenceTransformer to benchmark; the offline HashingEncoder and OverlapCrossEncoder
+        are used when not given.
+
+    Returns:
+    dict: {'meta': run description, 'stages': {stage: metrics}}.
+    """
+    folder = os.path.abspath(folder)
+    os.makedirs(folder, exist_ok=True)
+    corpus = generate_corpus(folder, wiki_pages, bing_queries, results_per_query, sentences_per_page, seed=seed)
+    index_folder = os.path.join(folder, 'index_folder')
+    shutil.rmtree(index_folder, ignore_errors=True)
+
+    sentence_model = model or HashingEncoder()
+    cross_encoder = None if model else OverlapCrossEncoder()
+    stages = {}
+    # The build discovers rag_database relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        afss = AutoFaissSentenceSearch(sentence_model, index_folder, batch_size=batch_size)
+        df = timed(stages, 'create_dataframe_from_json',
+                   lambda: afss.create_dataframe_from_json(os.path.join(folder, 'processed_files.txt')))
+        timed(stages, 'generate_embeddings', lambda: afss.generate_embeddings(df), len(df))
+        # The IngestPipeline stages of the full build (segment, dedup, generate_embeddings, write_chunk, autofaiss, ...)
+        traced_stages(stages, lambda: timed(stages, 'build_index', lambda: afss.build_index(full_rebuild=True), len(df)))
+        if 'build.generate_embeddings' in stages:
+            encode_seconds = max(stages['build.generate_embeddings']['seconds'], 1e-9)
+            stages['build.generate_embeddings']['sentences_per_sec'] = afss.encode_stats['encoded'] / encode_seconds
+        timed(stages, 'build_index_noop', lambda: afss.build_index())
+
+        search = AutoFaissSentenceSearch(sentence_model, index_folder, batch_size=batch_size)
+        timed(stages, 'load_index', search.load_index, repeats=repeats)
+        timed(stages, 'load_dataframe', search.load_dataframe, repeats=repeats)
+
+        # Queries are corpus sentences with words dropped, so each has near but not exact matches
+        rng = random.Random(seed + 1)
+        queries = []
+        for text in rng.sample(df['text'].tolist(), min(num_queries, len(df))):
+            words = text.split()
+            queries.append(' '.join(word for word in words if rng.random() > 0.3) or words[0])
+
+        latencies = []
+        for _ in range(repeats):
+            for query in queries:
+                start = time.perf_counter()
+                search.search_sentences(query, top_k=top_k)
+                latencies.append(time.perf_counter() - start)
+        stages['search_sentences'] = dict(latency_stats(latencies), peak_rss_mb=peak_rss_mb())
+
+        timed(stages, 'search_sentences_batch', lambda: search.search_sentences_batch(queries, top_k=top_k), repeats=repeats)
+        stages['search_sentences_batch']['queries_per_sec'] = len(queries) / max(stages['search_sentences_batch']['seconds'], 1e-9)
+
+        candidates = search.search_sentences_batch(queries, top_k=rerank_candidates)
+        latencies = []
+        for _ in range(repeats):
+            for query, results in zip(queries, candidates):
+                # No score cache, so every pair is scored as on a cold query
+                start = time.perf_counter()
+                CrossencoderSearch(query, dict_to_list(results), cross_encoding_model=cross_encoder, cache=None).run_cross_encoder(top_k)
+                latencies.append(time.perf_counter() - start)
+        stages['rerank'] = dict(latency_stats(latencies), peak_rss_mb=peak_rss_mb())
+    finally:
+        os.chdir(cwd)
+
+    meta = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'faiss': faiss.__version__,
+        'model': model or HashingEncoder.model_name,
+        'corpus': corpus,
+        'queries': len(queries),
+        'top_k': top_k,
+        'rerank_candidates': rerank_candidates,
+        'batch_size': batch_size,
+        'seed': seed,
+        'repeats': repeats
+    }
+    return {'meta': meta, 'stages': stages}
+
+def compare_results(baseline, current, threshold=0.1):
+    """
+    Compares two benchmark results metric by metric.
+
+    Returns:
+    list: (stage, metric, baseline value, current value, relative change) for every metric that got
+        worse by more than threshold and by more than its noise floor.
+    """
+    regressions = []
+    print(f"{'stage':<28} {'metric':<18} {'baseline':>12} {'current':>12} {'change':>8}")
+    for stage, metrics in current['stages'].items():
+        old_metrics = baseline['stages'].get(stage, {})
+        for metric, value in metrics.items():
+            old_value = old_metrics.get(metric)
+            if old_value is None or metric not in METRIC_DIRECTIONS or not old_value:
+                continue
+            change = (value - old_value) / abs(old_value)
+            worse = -change if METRIC_DIRECTIONS[metric] else change
+            # Throughputs are judged by the noise floor of the stage time they derive from
+            floor_metric = metric if metric in NOISE_FLOORS else 'seconds'
+            difference = abs(value - old_value) if metric in NOISE_FLOORS else abs(metrics.get('seconds', 0) - old_metrics.get('seconds', 0))
+            flag = ' REGRESSION' if worse > threshold and difference > NOISE_FLOORS[floor_metric] else ''
+            print(f"{stage:<28} {metric:<18} {old_value:>12.3f} {value:>12.3f} {change:>+8.1%}{flag}")
+            if flag:
+                regressions.append((stage, metric, old_value, value, change))
+    if baseline['meta'].get('corpus') != current['meta'].get('corpus'):
+        print("Warning: the runs used different corpus sizes")
+    print(f"{len(regressions)} regressions above {threshold:.0%}")
+    return regressions
+
+def load_results(path):
+    with open(path, 'r') as file:
+        return json.load(file)
+
+if __name__ == "__main__":
+
+    # python benchmark.py baseline.json current.json compares two saved runs without running anything
+    if len(sys.argv) == 3:
+        sys.exit(1 if compare_results(load_results(sys.argv[1]), load_results(sys.argv[2])) else 0)
+
+    # Read configuration
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    results = run_benchmark(
+        folder=config['DEFAULT'].get('bench_folder', 'benchmark'),
+        wiki_pages=config['DEFAULT'].getint('bench_wiki_pages', 200),
+        bing_queries=config['DEFAULT'].getint('bench_bing_queries', 10),
+        results_per_query=config['DEFAULT'].getint('bench_results_per_query', 20),
+        sentences_per_page=config['DEFAULT'].getint('bench_sentences_per_page', 40),
+        num_queries=config['DEFAULT'].getint('bench_queries', 200),
+        top_k=config['DEFAULT'].getint('top_k', 5),
+        rerank_candidates=config['DEFAULT'].getint('rerank_candidates', 100),
+        batch_size=config['DEFAULT'].getint('batch_size', 64),
+        model=config['DEFAULT'].get('bench_model', '') or None,
+        repeats=config['DEFAULT'].getint('bench_repeats', 3)
+    )
+    output_path = config['DEFAULT'].get('bench_output', 'benchmark_results.json')
+    with open(output_path, 'w') as file:
+        json.dump(results, file, indent=4)
+    print(f"Results saved to {output_path}")
+
+    baseline_path = config['DEFAULT'].get('bench_baseline', '')
+    if baseline_path:
+        threshold = config['DEFAULT'].getfloat('bench_regression_threshold', 0.1)
+        sys.exit(1 if compare_results(load_results(baseline_path), results, threshold) else 0)
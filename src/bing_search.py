@@ -3,52 +3,201 @@ import hashlib
 import os
 import json
 import time
+import threading
 
 from tqdm import tqdm
 from bs4 import BeautifulSoup
-from urllib.parse import quote_plus
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib.parse import quote_plus, urlparse
+
+from crawl_manifest import CrawlManifest, open_manifest
+
+BING_SEARCH_URL = "https://www.bing.com/search"
+SEARCH_HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/107.0.0.0 Safari/537.36"}
+LINK_HEADERS = {"User-Agent": "Mozilla/5.0"}
 
 def md5_hash(sentence):
     return hashlib.md5(sentence.encode()).hexdigest()
 
 def save_json_to_file(data, directory, filename):
     if not os.path.exists(directory):
-        os.makedirs(directory)
+        os.makedirs(directory, exist_ok=True)
     with open(os.path.join(directory, f'{filename}.json'), 'w') as file:
         json.dump(data, file, indent=4)
 
-def download_text_from_link(url):
-    headers = {"User-Agent": "Mozilla/5.0"}
-    response = requests.get(url, headers=headers)
+class HostRateLimiter:
+    """
+    Per-host politeness: requests to one host start at least min_interval seconds apart and at most
+    max_per_host of them run at once. A Retry-After from the host pushes its next slot back.
+    """
+
+    def __init__(self, min_interval=1.0, max_per_host=2):
+        self.min_interval = min_interval
+        self.max_per_host = max_per_host
+        self.next_slot = {}
+        self.host_slots = {}
+        self.lock = threading.Lock()
+
+    def host_semaphore(self, host):
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.host_slots[host]
+
+    def wait(self, host):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, 0))
+            self.next_slot[host] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def back_off(self, host, seconds):
+        with self.lock:
+            self.next_slot[host] = max(self.next_slot.get(host, 0), time.monotonic() + seconds)
+
+class Crawler:
+    """
+    Thread pool crawler with keep-alive sessions, a global concurrency cap (max_workers) and
+    per-host rate limits.
+    """
+
+    def __init__(self, max_workers=8, per_host_interval=1.0, max_per_host=2, timeout=20):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.rate_limiter = HostRateLimiter(per_host_interval, max_per_host)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.local = threading.local()
+
+    def session(self):
+        # One keep-alive session per worker thread; requests.Session is not safe to share across threads
+        if not hasattr(self.local, 'session'):
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+        return self.local.session
+
+    def get(self, url, headers=None):
+        host = urlparse(url).netloc
+        with self.rate_limiter.host_semaphore(host):
+            self.rate_limiter.wait(host)
+            response = self.session().get(url, headers=headers, timeout=self.timeout)
+        if response.status_code in (429, 503):
+            retry_after = response.headers.get('Retry-After', '')
+            self.rate_limiter.back_off(host, float(retry_after) if retry_after.isdigit() else self.rate_limiter.min_interval * 10)
+        return response
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+def download_text_from_link(url, crawler=None, headers=None):
+    """
+    Returns (response, page text); the text is "Failed to retrieve content" unless the response is a
+    200, and the response None if the request failed. headers are sent on top of LINK_HEADERS.
+    """
+    headers = {**LINK_HEADERS, **(headers or {})}
+    try:
+        if crawler is not None:
+            response = crawler.get(url, headers=headers)
+        else:
+            response = requests.get(url, headers=headers)
+    except RequestException as e:
+        print(f"Request failed: {e}")
+        return None, "Failed to retrieve content"
     if response.status_code == 200:
         soup = BeautifulSoup(response.content, 'html.parser')
         text = soup.get_text(separator='|', strip=True)
-        return text
+        return response, text
     else:
-        return "Failed to retrieve content"
+        return response, "Failed to retrieve content"
 
-def save_search_query_hash(query, hash, directory):
-    log_file_path = os.path.join(directory, 'search_queries_hashes.txt')
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+def save_search_query_hash(query, hash, manifest):
+    # Primary key lookup on the exact query
+    manifest.record_query(query, hash)
 
-    # Check if the query has already been logged
-    if os.path.exists(log_file_path):
-        with open(log_file_path, 'r') as file:
-            if any(query in line for line in file):
-                return
+def download_search_result(item, position, directory_name, crawler=None, manifest=None):
+    """
+    Downloads one result link and saves it as JSON. With a manifest, a link this folder already
+    holds is requested conditionally (If-None-Match / If-Modified-Since); on 304 Not Modified
+    nothing is written and None is returned, and an unchanged page is not rewritten.
+    """
+    link = item.find("a").get("href")
+    second_hash = md5_hash(link)
+    json_file_path = os.path.join(directory_name, f'{second_hash}.json')
+    headers = None
+    if manifest is not None and manifest.has_file(json_file_path):
+        headers = CrawlManifest.conditional_headers(manifest.url_state(link))
+    response, page_text = download_text_from_link(link, crawler, headers)
+    if manifest is not None and response is not None and response.status_code == 304:
+        manifest.record_fetch(link, 304)
+        return None
+    page_text = [i for i in page_text.split("|") if len(i.split(" "))>7]
 
-    with open(log_file_path, 'a') as file:
-        file.write(f"{query}: {hash}\n")
+    caption = item.find("div", {"class": "b_caption"})
+    result = {
+        "Title": item.find("a").text,
+        "Link": link,
+        "Description": caption.text if caption else "",
+        "Position": position,
+        "PageText": page_text,
+        "Hash": second_hash
+    }
+    # Save each successful result as a separate JSON file
+    if manifest is None:
+        save_json_to_file(result, directory_name, second_hash)
+        return result
+    manifest.write_file(json_file_path, json.dumps(result, indent=4).encode(), link)
+    if response is not None:
+        # Validators of error pages would turn the next re-crawl into a 304 for content never saved
+        validators = (response.headers.get('ETag'), response.headers.get('Last-Modified')) if response.status_code == 200 else (None, None)
+        manifest.record_fetch(link, response.status_code, hashlib.md5(response.content).hexdigest(), *validators)
+    return result
 
-def fetch_bing_search_results(query, num_pages=10, results_per_page=10,delay=30):
+def fetch_bing_search_results(query, num_pages=10, results_per_page=10,delay=30,crawler=None,search_url=BING_SEARCH_URL,
+                              manifest=None,recrawl_after=None):
+    """
+    Fetches Bing result pages for a query and saves every result link as JSON.
 
+    Search pages are requested one after another with delay seconds between them, while the links
+    found on each page are downloaded in parallel on the crawler's thread pool.
+
+    Args:
+    query (str): Search query.
+    num_pages (int): Number of result pages to fetch.
+    results_per_page (int): Results per page, used to compute the page offset.
+    delay (float): Seconds to wait between search page requests.
+    crawler (Crawler): Shared crawler; one is created and closed here when not given.
+    search_url (str): Search endpoint, overridable to crawl a local stand-in server.
+    manifest (CrawlManifest): Crawl manifest of rag_database; the process-wide one by default.
+    recrawl_after (float): Re-fetch links saved more than this many seconds ago, conditionally;
+        by default links already saved are skipped.
+
+    Returns:
+    tuple: (text of the last search page, list of saved results)
+    """
     current_working_directory = os.getcwd()
     base_directory = os.path.join(current_working_directory, 'rag_database', 'bing_search')
-    log_directory = os.path.join(current_working_directory, 'rag_database', 'bing_search_logs')
+    if manifest is None:
+        manifest = open_manifest(os.path.join(current_working_directory, 'rag_database'))
+    # Pages saved before the manifest existed or by other tools are recorded first, so they are not
+    # downloaded again; only whether a page exists matters here, so unchanged folders are skipped
+    manifest.sync(changed_folders_only=True)
+
+    own_crawler = crawler is None
+    if own_crawler:
+        crawler = Crawler()
 
     search_results = []
-    headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/107.0.0.0 Safari/537.36"}
+    downloads = []
+    submitted = set()
+    last_page_text = ""
     encoded_query = quote_plus(query)
 
     # Generating first hash
@@ -56,54 +205,54 @@ def fetch_bing_search_results(query, num_pages=10, results_per_page=10,delay=30)
     directory_name = os.path.join(base_directory, first_hash)
 
     # Save search query and hash
-    save_search_query_hash(query, first_hash, log_directory)
+    save_search_query_hash(query, first_hash, manifest)
+
+    pages = list(range(0, num_pages * results_per_page, results_per_page))
+    for page_number, page in enumerate(pages):
+        target_url = f"{search_url}?q={encoded_query}&rdr=1&first={page+1}"
 
-    for page in range(0, num_pages * results_per_page, results_per_page):
-        target_url = f"https://www.bing.com/search?q={encoded_query}&rdr=1&first={page+1}"
-        
         try:
-            response = requests.get(target_url, headers=headers)
+            response = crawler.get(target_url, headers=SEARCH_HEADERS)
             if response.status_code != 200:
                 print(f"Error fetching page: {response.status_code}")
-                continue
-
-            soup = BeautifulSoup(response.text, 'html.parser')
-            complete_data = soup.find_all("li", {"class": "b_algo"})
-
-            if not complete_data:
-                print("No data found on the page.")
-                continue
-
-            for position, item in tqdm(enumerate(complete_data, start=1)):
-                link = item.find("a").get("href")
-                second_hash = md5_hash(link)
-
-                # Check if this link's content has already been downloaded
-                json_file_path = os.path.join(directory_name, f'{second_hash}.json')
-                if not os.path.exists(json_file_path):
-                    page_text = download_text_from_link(link)
-                    page_text = [i for i in page_text.split("|") if len(i.split(" "))>7]
-
-                    # Check if page text was successfully retrieved
-    #                 if page_text != "Failed to retrieve content":
-                    result = {
-                        "Title": item.find("a").text,
-                        "Link": link,
-                        "Description": item.find("div", {"class": "b_caption"}).text,
-                        "Position": position,
-                        "PageText": page_text,
-                        "Hash": second_hash
-                    }
-                    search_results.append(result)
-                    # Save each successful result as a separate JSON file
-                    save_json_to_file(result, directory_name, second_hash)
-        
+            else:
+                last_page_text = response.text
+                soup = BeautifulSoup(response.text, 'html.parser')
+                complete_data = soup.find_all("li", {"class": "b_algo"})
+
+                if not complete_data:
+                    print("No data found on the page.")
+
+                for position, item in enumerate(complete_data, start=1):
+                    anchor = item.find("a")
+                    if anchor is None or not anchor.get("href"):
+                        continue
+
+                    # Check if this link's content has already been downloaded (or is due for a re-crawl)
+                    second_hash = md5_hash(anchor.get("href"))
+                    json_file_path = os.path.join(directory_name, f'{second_hash}.json')
+                    if second_hash not in submitted and manifest.needs_fetch(json_file_path, recrawl_after):
+                        submitted.add(second_hash)
+                        downloads.append(crawler.submit(download_search_result, item, position, directory_name, crawler, manifest))
+
         except RequestException as e:
             print(f"Request failed: {e}")
-            continue
-        
-        # Introduce a delay between requests
-        time.sleep(delay)
-        print("Sleep for 30 seconds")
-    
-    return response.text,search_results
\ No newline at end of file
+
+        # Introduce a delay between search page requests; result downloads keep running meanwhile
+        if page_number < len(pages) - 1 and delay:
+            print(f"Sleep for {delay} seconds")
+            time.sleep(delay)
+
+    for future in tqdm(downloads):
+        try:
+            result = future.result()
+            # None: the page has not changed since it was last fetched
+            if result is not None:
+                search_results.append(result)
+        except Exception as e:
+            print(f"Download failed: {e}")
+
+    if own_crawler:
+        crawler.close()
+
+    return last_page_text,search_results
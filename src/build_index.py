@@ -1,17 +1,33 @@
 import hashlib
 import os
 from autofaiss_index import AutoFaissSentenceSearch
+from sharded_index import ShardedSentenceSearch
+from tracing import configure_tracing
 import configparser
 
 def md5_hash(sentence):
     return hashlib.md5(sentence.encode()).hexdigest()
 
-def build_and_save_index(sentence_model, index_folder, max_index_memory_usage):
-    afss = AutoFaissSentenceSearch(sentence_model=sentence_model, index_folder=index_folder, max_index_memory_usage=max_index_memory_usage)
+def build_and_save_index(sentence_model, index_folder, max_index_memory_usage, batch_size=64, embedding_dtype='float32', full_rebuild=False,
+                         embed_workers=1, shard_rows=1000000, dedup=False, near_duplicates=False, near_duplicate_threshold=0.8, index_key=None,
+                         segmentation='none', segment_workers=1, rescan_database=False,
+                         scan_changed_folders_only=False):
+    afss = AutoFaissSentenceSearch(sentence_model=sentence_model, index_folder=index_folder, max_index_memory_usage=max_index_memory_usage,
+                                   batch_size=batch_size, embedding_dtype=embedding_dtype, embed_workers=embed_workers, shard_rows=shard_rows,
+                                   dedup=dedup, near_duplicates=near_duplicates, near_duplicate_threshold=near_duplicate_threshold,
+                                   index_key=index_key, segmentation=segmentation, segment_workers=segment_workers,
+                                   rescan_database=rescan_database, scan_changed_folders_only=scan_changed_folders_only)
     
-    afss.build_index()
+    afss.build_index(full_rebuild=full_rebuild)
     print("Index built and saved.")
 
+def build_and_save_sharded_index(sentence_model, index_folder, max_index_memory_usage, shard_by, num_shards=4, shards=None,
+                                 full_rebuild=False, **build_kwargs):
+    sharded = ShardedSentenceSearch(sentence_model, index_folder, max_index_memory_usage, shard_by=shard_by, num_shards=num_shards,
+                                    **build_kwargs)
+    sharded.build_index(full_rebuild=full_rebuild, shards=shards)
+    print("Sharded index built and saved.")
+
 if __name__ == "__main__":
 
     # Read configuration
@@ -21,5 +37,32 @@ if __name__ == "__main__":
     model = config['DEFAULT']['model']
     index_folder = config['DEFAULT']['index_folder']
     max_index_memory_usage = config['DEFAULT'].get('max_index_memory_usage', '10MB')
+    batch_size = config['DEFAULT'].getint('batch_size', 64)
+    embedding_dtype = config['DEFAULT'].get('embedding_dtype', 'float32')
+    full_rebuild = config['DEFAULT'].getboolean('full_rebuild', False)
+    embed_workers = config['DEFAULT'].getint('embed_workers', 1)
+    shard_rows = config['DEFAULT'].getint('shard_rows', 1000000)
+    dedup = config['DEFAULT'].getboolean('dedup', False)
+    near_duplicates = config['DEFAULT'].getboolean('near_duplicates', False)
+    near_duplicate_threshold = config['DEFAULT'].getfloat('near_duplicate_threshold', 0.8)
+    segmentation = config['DEFAULT'].get('segmentation', 'none')
+    segment_workers = config['DEFAULT'].getint('segment_workers', 1)
+    shard_by = config['DEFAULT'].get('shard_by', '')
+    num_shards = config['DEFAULT'].getint('num_shards', 4)
+    index_key = config['DEFAULT'].get('index_key', '')
+    rescan_database = config['DEFAULT'].getboolean('rescan_database', False)
+    scan_changed_folders_only = config['DEFAULT'].getboolean('scan_changed_folders_only', False)
+    build_shards = [name.strip() for name in config['DEFAULT'].get('build_shards', '').split(',') if name.strip()]
+    configure_tracing(config['DEFAULT'])
 
-    build_and_save_index(model, index_folder, max_index_memory_usage)
\ No newline at end of file
+    if shard_by:
+        build_and_save_sharded_index(model, index_folder, max_index_memory_usage, shard_by, num_shards, build_shards or None,
+                                     full_rebuild, batch_size=batch_size, embedding_dtype=embedding_dtype, embed_workers=embed_workers,
+                                     shard_rows=shard_rows, dedup=dedup, near_duplicates=near_duplicates,
+                                     near_duplicate_threshold=near_duplicate_threshold, index_key=index_key,
+                                     segmentation=segmentation, segment_workers=segment_workers, rescan_database=rescan_database,
+                                     scan_changed_folders_only=scan_changed_folders_only)
+    else:
+        build_and_save_index(model, index_folder, max_index_memory_usage, batch_size, embedding_dtype, full_rebuild,
+                             embed_workers, shard_rows, dedup, near_duplicates, near_duplicate_threshold, index_key,
+                             segmentation, segment_workers, rescan_database, scan_changed_folders_only)
\ No newline at end of file
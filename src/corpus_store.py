@@ -0,0 +1,369 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import configparser
+import numpy as np
+
+from dedup import NO_SIGNATURE
+from embedding_store import append_rows_to_npy, load_array, swap_folder
+
+CORPUS_FOLDER = 'corpus'
+FORMAT_VERSION = 2
+COLUMNS = ['file_ids', 'positions', 'text', 'text_offsets', 'text_hashes', 'deleted', 'block_offsets', 'row_blocks',
+           'vector_ids', 'index_rows', 'minhash']
+MINHASH_PERM = 32
+
+def build_context_offsets(filenames, positions):
+    """
+    Splits the rows into runs of consecutive positions of one file, CSR style.
+
+    Returns:
+    tuple: (block_offsets, row_blocks) where rows block_offsets[b]:block_offsets[b + 1] form run b
+        and row_blocks[row] is the run holding that row.
+    """
+    filenames = np.asarray(filenames)
+    positions = np.asarray(positions, dtype=np.int64)
+    starts = np.ones(len(positions), dtype=bool)
+    starts[1:] = (filenames[1:] != filenames[:-1]) | (positions[1:] != positions[:-1] + 1)
+    row_blocks = (np.cumsum(starts) - 1).astype(np.int32)
+    block_offsets = np.append(np.flatnonzero(starts), len(positions)).astype(np.int64)
+    return block_offsets, row_blocks
+
+def live_file_ranges(file_ids, deleted, num_files, chunk_rows=1000000):
+    """
+    Returns a (num_files, 2) array with the [start, end) row range of each file's live rows; files
+    without live rows get (0, 0). Files are appended as one contiguous run, so the range holds no
+    rows of other files.
+    """
+    starts = np.full(num_files, np.iinfo(np.int64).max, dtype=np.int64)
+    ends = np.zeros(num_files, dtype=np.int64)
+    for start in range(0, len(file_ids), chunk_rows):
+        live = np.flatnonzero(~np.asarray(deleted[start:start + chunk_rows]))
+        chunk_file_ids = np.asarray(file_ids[start:start + chunk_rows])[live]
+        np.minimum.at(starts, chunk_file_ids, start + live)
+        np.maximum.at(ends, chunk_file_ids, start + live + 1)
+    starts[ends == 0] = 0
+    return np.stack([starts, ends], axis=1)
+
+class TextColumn:
+    """Sentence texts held as one UTF-8 blob plus row offsets; indexing decodes only the rows asked for."""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[row] for row in range(start, stop, step)]
+            if stop <= start:
+                return []
+            offsets = self.offsets[start:stop + 1].tolist()
+            chunk = self.blob[offsets[0]:offsets[-1]].tobytes()
+            base = offsets[0]
+            return [chunk[begin - base:end - base].decode('utf-8') for begin, end in zip(offsets[:-1], offsets[1:])]
+        row = int(key)
+        if row < 0:
+            row += len(self)
+        return self.blob[self.offsets[row]:self.offsets[row + 1]].tobytes().decode('utf-8')
+
+    def tolist(self):
+        return self[:]
+
+class CorpusStore:
+    """
+    Columnar, memory-mapped replacement for dataframe.pkl.
+
+    Filenames are dictionary encoded (filenames.json + int32 file_ids), positions are int32, texts
+    live in one offsets + bytes blob, and every column is a .npy file opened with mmap_mode='r', so
+    opening a store reads only headers and search workers share the page cache.
+
+    Rows with the same or nearly the same text share one vector: vector_ids maps each row to its
+    embedding (and faiss id), index_rows maps each vector back to the first live row that carries
+    it (-1 once all of them are tombstoned), and minhash holds each vector's MinHash signature.
+    Every row keeps its own file and position, so context windows resolve in each source file.
+
+    file_ranges holds the live row range of every file id, for filtered searches.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, 'meta.json'), 'r') as file:
+            self.meta = json.load(file)
+        with open(os.path.join(folder, 'filenames.json'), 'r', encoding='utf-8') as file:
+            self.filenames = json.load(file)
+        self.file_ids = load_array(os.path.join(folder, 'file_ids.npy'))
+        self.positions = load_array(os.path.join(folder, 'positions.npy'))
+        self.text_hashes = load_array(os.path.join(folder, 'text_hashes.npy'))
+        self.deleted = load_array(os.path.join(folder, 'deleted.npy'))
+        self.block_offsets = load_array(os.path.join(folder, 'block_offsets.npy'))
+        self.row_blocks = load_array(os.path.join(folder, 'row_blocks.npy'))
+        self.text = TextColumn(load_array(os.path.join(folder, 'text.npy')),
+                               load_array(os.path.join(folder, 'text_offsets.npy')))
+        self.num_deleted = self.meta['num_deleted']
+        # Stores written before segmentation indexed whole paragraphs
+        self.segmentation = self.meta.get('segmentation', 'none')
+        if self.meta['format_version'] >= 2:
+            self.vector_ids = load_array(os.path.join(folder, 'vector_ids.npy'))
+            self.index_rows = load_array(os.path.join(folder, 'index_rows.npy'))
+            self.minhash = load_array(os.path.join(folder, 'minhash.npy'))
+            self.num_dead_vectors = self.meta['dead_vectors']
+        else:
+            # Stores written before deduplication hold one vector per row
+            self.vector_ids = np.arange(len(self), dtype=np.int32)
+            self.index_rows = np.where(np.asarray(self.deleted), -1, np.arange(len(self), dtype=np.int64))
+            self.minhash = None
+            self.num_dead_vectors = self.num_deleted
+        ranges_path = os.path.join(folder, 'file_ranges.npy')
+        self.ranges = load_array(ranges_path) if os.path.exists(ranges_path) else None
+
+    def __len__(self):
+        return self.meta['rows']
+
+    @property
+    def num_vectors(self):
+        return len(self.index_rows)
+
+    @property
+    def file_ranges(self):
+        if self.ranges is None:
+            # Stores written before filtered search: computed on first use
+            self.ranges = live_file_ranges(self.file_ids, self.deleted, len(self.filenames))
+        return self.ranges
+
+    def filename(self, row):
+        return self.filenames[self.file_ids[row]]
+
+    def to_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame({
+            'filename': np.asarray(self.filenames, dtype=object)[self.file_ids] if len(self) else np.array([], dtype=object),
+            'text': self.text.tolist(),
+            'position': np.asarray(self.positions, dtype=np.int64),
+            'text_hash': np.asarray(self.text_hashes).astype(str).astype(object),
+            'deleted': np.asarray(self.deleted, dtype=bool)
+        })
+
+    @staticmethod
+    def write(folder, df):
+        """Writes df (filename, text, position, text_hash, deleted) as a store, swapping it in place of any existing one."""
+        writer = CorpusWriter(folder)
+        writer.append(df['filename'].tolist(), df['position'].to_numpy(), df['text'].tolist(), df['text_hash'].tolist())
+        writer.tombstone_rows(np.flatnonzero(df['deleted'].to_numpy()))
+        writer.close()
+
+class CorpusWriter:
+    """
+    Streams rows into a new corpus store in chunks, so the full corpus never has to be held in memory.
+
+    With base set, the new store starts as a file-level copy of that store and rows are appended
+    after it. The new store is built next to folder and swapped in by close().
+
+    Rows refer to vectors by id; add_vectors registers new vectors (with their MinHash signatures)
+    in id order, and append without vector_ids gives every row a vector of its own. segmentation
+    records how pages were split into rows (a Segmenter key).
+    """
+
+    def __init__(self, folder, base=None, segmentation='none'):
+        self.folder = folder
+        self.segmentation = segmentation
+        self.tmp_folder = f"{folder}.tmp"
+        shutil.rmtree(self.tmp_folder, ignore_errors=True)
+        os.makedirs(self.tmp_folder)
+
+        if base is not None:
+            for name in COLUMNS:
+                shutil.copyfile(os.path.join(base.folder, f"{name}.npy"), self.column_path(name))
+            # Block offsets carry a closing sentinel, re-added on close
+            np.save(self.column_path('block_offsets'), np.asarray(base.block_offsets[:-1]))
+            self.filenames = list(base.filenames)
+            self.rows = len(base)
+            self.text_bytes = int(base.text.offsets[-1])
+            self.num_blocks = len(base.block_offsets) - 1
+            self.last_row = (int(base.file_ids[-1]), int(base.positions[-1])) if len(base) else None
+            self.num_vectors = base.num_vectors
+        else:
+            empty = {'file_ids': np.int32, 'positions': np.int32, 'text': np.uint8, 'text_hashes': 'S32',
+                     'deleted': bool, 'block_offsets': np.int64, 'row_blocks': np.int32, 'vector_ids': np.int32}
+            for name, dtype in empty.items():
+                np.save(self.column_path(name), np.empty(0, dtype=dtype))
+            np.save(self.column_path('minhash'), np.empty((0, MINHASH_PERM), dtype=np.uint32))
+            np.save(self.column_path('text_offsets'), np.zeros(1, dtype=np.int64))
+            self.filenames = []
+            self.rows = 0
+            self.text_bytes = 0
+            self.num_blocks = 0
+            self.last_row = None
+            self.num_vectors = 0
+        self.file_lookup = {filename: file_id for file_id, filename in enumerate(self.filenames)}
+        self.base_rows = self.rows
+        # Counts the builds committed to folder, so every commit gets a new meta.json even if the row counts repeat
+        try:
+            with open(os.path.join(folder, 'meta.json'), 'r') as file:
+                self.build = json.load(file).get('build', 0) + 1
+        except (OSError, ValueError):
+            self.build = 1
+
+    def column_path(self, name):
+        return os.path.join(self.tmp_folder, f"{name}.npy")
+
+    def add_vectors(self, signatures):
+        """Registers len(signatures) new vectors; the first gets id num_vectors."""
+        append_rows_to_npy(self.column_path('minhash'), np.asarray(signatures, dtype=np.uint32).reshape(-1, MINHASH_PERM))
+        self.num_vectors += len(signatures)
+
+    def append(self, filenames, positions, texts, text_hashes, vector_ids=None):
+        if not len(texts):
+            return
+        if vector_ids is None:
+            vector_ids = self.num_vectors + np.arange(len(texts))
+            self.add_vectors(np.full((len(texts), MINHASH_PERM), NO_SIGNATURE, dtype=np.uint32))
+        file_ids = np.empty(len(filenames), dtype=np.int32)
+        for row, filename in enumerate(filenames):
+            file_id = self.file_lookup.get(filename)
+            if file_id is None:
+                file_id = self.file_lookup[filename] = len(self.filenames)
+                self.filenames.append(filename)
+            file_ids[row] = file_id
+        positions = np.asarray(positions, dtype=np.int32)
+
+        # A chunk can start in the middle of a file's run of rows; it then continues the open block
+        starts = np.ones(len(positions), dtype=bool)
+        starts[1:] = (file_ids[1:] != file_ids[:-1]) | (positions[1:] != positions[:-1] + 1)
+        if self.last_row is not None:
+            starts[0] = (int(file_ids[0]), int(positions[0]) - 1) != self.last_row
+        row_blocks = self.num_blocks - 1 + np.cumsum(starts)
+        block_offsets = self.rows + np.flatnonzero(starts)
+
+        encoded = [text.encode('utf-8') for text in texts]
+        text_offsets = self.text_bytes + np.cumsum([len(text) for text in encoded], dtype=np.int64)
+
+        append_rows_to_npy(self.column_path('file_ids'), file_ids)
+        append_rows_to_npy(self.column_path('positions'), positions)
+        append_rows_to_npy(self.column_path('text'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        append_rows_to_npy(self.column_path('text_offsets'), text_offsets)
+        append_rows_to_npy(self.column_path('text_hashes'), np.asarray(text_hashes, dtype='S32'))
+        append_rows_to_npy(self.column_path('deleted'), np.zeros(len(texts), dtype=bool))
+        append_rows_to_npy(self.column_path('row_blocks'), row_blocks.astype(np.int32))
+        append_rows_to_npy(self.column_path('block_offsets'), block_offsets.astype(np.int64))
+        append_rows_to_npy(self.column_path('vector_ids'), np.asarray(vector_ids, dtype=np.int32))
+
+        self.rows += len(texts)
+        self.text_bytes = int(text_offsets[-1])
+        self.num_blocks += int(starts.sum())
+        self.last_row = (int(file_ids[-1]), int(positions[-1]))
+
+    def tombstone_files(self, filenames, chunk_rows=1000000):
+        """Tombstones the rows of filenames that came from the base store; appended rows are left alone."""
+        file_ids = [self.file_lookup[filename] for filename in filenames if filename in self.file_lookup]
+        if not file_ids or not self.base_rows:
+            return
+        all_file_ids = np.load(self.column_path('file_ids'), mmap_mode='r')
+        deleted = np.load(self.column_path('deleted'), mmap_mode='r+')
+        for start in range(0, self.base_rows, chunk_rows):
+            end = min(start + chunk_rows, self.base_rows)
+            deleted[start:end] |= np.isin(all_file_ids[start:end], file_ids)
+        deleted.flush()
+        del deleted, all_file_ids
+
+    def tombstone_rows(self, rows):
+        if not len(rows):
+            return
+        deleted = np.load(self.column_path('deleted'), mmap_mode='r+')
+        deleted[np.asarray(rows, dtype=np.int64)] = True
+        deleted.flush()
+        del deleted
+
+    def live_index_rows(self, chunk_rows=1000000):
+        """Returns the first live row of every vector, or -1 for vectors whose rows are all tombstoned."""
+        index_rows = np.full(self.num_vectors, -1, dtype=np.int64)
+        if not self.rows:
+            return index_rows
+        deleted = np.load(self.column_path('deleted'), mmap_mode='r')
+        vector_ids = np.load(self.column_path('vector_ids'), mmap_mode='r')
+        # Walk backwards so the earliest row of each vector is the one written last
+        for end in range(self.rows, 0, -chunk_rows):
+            start = max(0, end - chunk_rows)
+            live = np.flatnonzero(~deleted[start:end])[::-1]
+            index_rows[vector_ids[start:end][live]] = start + live
+        del deleted, vector_ids
+        return index_rows
+
+    def close(self):
+        append_rows_to_npy(self.column_path('block_offsets'), np.array([self.rows], dtype=np.int64))
+        num_deleted = int(np.load(self.column_path('deleted'), mmap_mode='r').sum()) if self.rows else 0
+        index_rows = self.live_index_rows()
+        np.save(self.column_path('index_rows'), index_rows)
+        if self.rows:
+            file_ranges = live_file_ranges(np.load(self.column_path('file_ids'), mmap_mode='r'),
+                                           np.load(self.column_path('deleted'), mmap_mode='r'), len(self.filenames))
+        else:
+            file_ranges = np.zeros((len(self.filenames), 2), dtype=np.int64)
+        np.save(self.column_path('file_ranges'), file_ranges)
+        with open(os.path.join(self.tmp_folder, 'filenames.json'), 'w', encoding='utf-8') as file:
+            json.dump(self.filenames, file)
+        with open(os.path.join(self.tmp_folder, 'meta.json'), 'w') as file:
+            json.dump({'format_version': FORMAT_VERSION, 'rows': self.rows, 'num_deleted': num_deleted,
+                       'vectors': self.num_vectors, 'dead_vectors': int((index_rows < 0).sum()),
+                       'segmentation': self.segmentation, 'build': self.build}, file)
+        swap_folder(self.tmp_folder, self.folder)
+
+def compare_with_pickle(index_folder, sample_rows=1000):
+    """
+    Times writing and loading the corpus as a pickled DataFrame and as a CorpusStore, including
+    reading sample_rows random sentences after load.
+
+    Returns:
+    dict: Seconds for each step and on-disk size in bytes, per format.
+    """
+    import pandas as pd
+    df = CorpusStore(os.path.join(os.path.abspath(index_folder), CORPUS_FOLDER)).to_dataframe()
+    rows = np.random.default_rng(0).integers(0, len(df), size=min(sample_rows, len(df)))
+    report = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pickle_path = os.path.join(tmp_dir, 'dataframe.pkl')
+        start = time.perf_counter()
+        df.to_pickle(pickle_path)
+        write_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded = pd.read_pickle(pickle_path)
+        load_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        texts = loaded['text']
+        [texts.iloc[row] for row in rows]
+        report['pickle'] = {'write_seconds': write_seconds, 'load_seconds': load_seconds,
+                            'sample_seconds': time.perf_counter() - start, 'bytes': os.path.getsize(pickle_path)}
+
+        store_path = os.path.join(tmp_dir, CORPUS_FOLDER)
+        start = time.perf_counter()
+        CorpusStore.write(store_path, df)
+        write_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        store = CorpusStore(store_path)
+        load_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        [store.text[row] for row in rows]
+        report['corpus_store'] = {'write_seconds': write_seconds, 'load_seconds': load_seconds,
+                                  'sample_seconds': time.perf_counter() - start,
+                                  'bytes': sum(entry.stat().st_size for entry in os.scandir(store_path))}
+        del store
+
+    for name, stats in report.items():
+        print(f"{name:>12}: write {stats['write_seconds']:.3f}s, load {stats['load_seconds']:.3f}s, "
+              f"{len(rows)} lookups {stats['sample_seconds']:.3f}s, {stats['bytes'] / 1e6:.1f} MB")
+    return report
+
+if __name__ == "__main__":
+
+    # Read configuration
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    compare_with_pickle(config['DEFAULT']['index_folder'])
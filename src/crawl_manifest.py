@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+
+MANIFEST_FILE = 'manifest.sqlite3'
+# Where save_search_query_hash logged queries before the manifest; imported once
+QUERY_LOG = os.path.join('bing_search_logs', 'search_queries_hashes.txt')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS queries (query TEXT PRIMARY KEY, hash TEXT NOT NULL, created_at REAL)',
+    'CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, content_hash TEXT, etag TEXT, last_modified TEXT, '
+    'status INTEGER, fetched_at REAL)',
+    'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, content_hash TEXT NOT NULL, size INTEGER, mtime_ns INTEGER, '
+    'url TEXT, updated_at REAL)',
+    'CREATE TABLE IF NOT EXISTS ingested (index_folder TEXT, path TEXT, content_hash TEXT, embedding_version TEXT, '
+    'ingested_at REAL, PRIMARY KEY (index_folder, path))',
+    'CREATE TABLE IF NOT EXISTS indexes (index_folder TEXT PRIMARY KEY, checksum TEXT, embedding_version TEXT, built_at REAL)',
+    'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)'
+)
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def open_manifest(database_dir):
+    """
+    Returns the process-wide CrawlManifest of a rag_database folder, opening it on first use and
+    again whenever its database file was deleted or replaced since.
+    """
+    database_dir = os.path.abspath(database_dir)
+    with _manifests_lock:
+        manifest = _manifests.get(database_dir)
+        if manifest is None or not manifest.is_current():
+            # A stale manifest is left open: whoever still holds it finishes on the old file
+            manifest = _manifests[database_dir] = CrawlManifest(database_dir)
+        return manifest
+
+def ingest_checksum(processed_files):
+    """Fingerprint of an index's processed files, to tell whether its ingest records are current."""
+    digest = hashlib.md5()
+    for filename, file_hash in sorted(processed_files.items()):
+        digest.update(f"{filename}\t{file_hash}\n".encode())
+    return digest.hexdigest()
+
+class CrawlManifest:
+    """
+    SQLite record of everything crawled into and ingested from a rag_database folder:
+
+    - queries: Bing query -> the hash naming its result folder
+    - urls: page URL -> content hash, ETag, Last-Modified, HTTP status and fetch time, for conditional re-crawls
+    - files: page JSON path (relative to rag_database) -> content hash, size and mtime
+    - ingested: (index folder, file) -> content hash and embedding version it was indexed with
+
+    The downloaders record every page they write, so builds list pages and find the changed ones
+    with indexed queries instead of walking and hashing the whole folder. scan() brings the files
+    table in line with the folder for pages written any other way; sync() runs it before every
+    build, over every page folder or only the ones whose mtime changed since the last scan.
+    """
+
+    def __init__(self, database_dir):
+        self.database_dir = os.path.abspath(database_dir)
+        os.makedirs(self.database_dir, exist_ok=True)
+        self.lock = threading.RLock()
+        self.path = os.path.join(self.database_dir, MANIFEST_FILE)
+        self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.file_id = self.database_file_id()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        if self.get_state('query_log_imported') is None:
+            self.import_query_log()
+
+    def database_file_id(self):
+        stat = os.stat(self.path)
+        return stat.st_dev, stat.st_ino
+
+    def is_current(self):
+        """Whether the database file at path is still the one this manifest has open."""
+        try:
+            return self.database_file_id() == self.file_id
+        except FileNotFoundError:
+            return False
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def fetch(self, sql, params=()):
+        # One connection serves every crawler thread; statements on it are serialized
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def fetch_value(self, sql, params=()):
+        rows = self.fetch(sql, params)
+        return rows[0][0] if rows else None
+
+    def get_state(self, key):
+        return self.fetch_value('SELECT value FROM state WHERE key = ?', (key,))
+
+    def import_query_log(self):
+        log_path = os.path.join(self.database_dir, QUERY_LOG)
+        with self.transaction() as connection:
+            if os.path.exists(log_path):
+                with open(log_path, 'r') as file:
+                    for line in file.read().splitlines():
+                        query, separator, query_hash = line.rpartition(': ')
+                        if separator:
+                            connection.execute('INSERT OR IGNORE INTO queries VALUES (?, ?, ?)', (query, query_hash, time.time()))
+            connection.execute("INSERT OR REPLACE INTO state VALUES ('query_log_imported', ?)", (str(time.time()),))
+
+    def relative_path(self, path):
+        return os.path.relpath(os.path.abspath(path), self.database_dir).replace(os.sep, '/')
+
+    # Crawling
+
+    def record_query(self, query, query_hash):
+        with self.lock:
+            self.connection.execute('INSERT OR IGNORE INTO queries VALUES (?, ?, ?)', (query, query_hash, time.time()))
+
+    def query_hash(self, query):
+        return self.fetch_value('SELECT hash FROM queries WHERE query = ?', (query,))
+
+    def url_state(self, url):
+        """Returns {'content_hash', 'etag', 'last_modified', 'status', 'fetched_at'} of a fetched URL, or None."""
+        rows = self.fetch('SELECT content_hash, etag, last_modified, status, fetched_at FROM urls WHERE url = ?', (url,))
+        return dict(zip(('content_hash', 'etag', 'last_modified', 'status', 'fetched_at'), rows[0])) if rows else None
+
+    def record_fetch(self, url, status, content_hash=None, etag=None, last_modified=None):
+        """Records a fetch of url. A 304 Not Modified keeps the stored content hash and validators."""
+        with self.lock:
+            if status == 304:
+                self.connection.execute('UPDATE urls SET status = ?, fetched_at = ? WHERE url = ?', (status, time.time(), url))
+            else:
+                self.connection.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?, ?)',
+                                        (url, content_hash, etag, last_modified, status, time.time()))
+
+    @staticmethod
+    def conditional_headers(state):
+        """If-None-Match / If-Modified-Since headers from the validators of an earlier fetch."""
+        headers = {}
+        if state and state['etag']:
+            headers['If-None-Match'] = state['etag']
+        if state and state['last_modified']:
+            headers['If-Modified-Since'] = state['last_modified']
+        return headers
+
+    def has_file(self, path):
+        return self.fetch_value('SELECT 1 FROM files WHERE path = ?', (self.relative_path(path),)) is not None
+
+    def file_hash(self, path):
+        return self.fetch_value('SELECT content_hash FROM files WHERE path = ?', (self.relative_path(path),))
+
+    def needs_fetch(self, path, recrawl_after=None):
+        """
+        Whether the page saved at path should be downloaded: it is not recorded yet, or with
+        recrawl_after (seconds) its URL was last fetched longer ago than that.
+        """
+        if not self.has_file(path):
+            return True
+        if recrawl_after is None:
+            return False
+        fetched_at = self.fetch_value('SELECT urls.fetched_at FROM files JOIN urls ON urls.url = files.url WHERE files.path = ?',
+                                      (self.relative_path(path),))
+        return fetched_at is None or time.time() - fetched_at >= recrawl_after
+
+    def write_file(self, path, content, url=None):
+        """
+        Writes content (bytes) to path and records it. Content identical to what the manifest already
+        holds for path is not rewritten, so unchanged pages never look changed to a build.
+
+        Returns:
+        bool: Whether the file was written.
+        """
+        content_hash = hashlib.md5(content).hexdigest()
+        if content_hash == self.file_hash(path) and os.path.exists(path):
+            if url is not None:
+                # Pages found by a scan learn which URL they came from
+                with self.lock:
+                    self.connection.execute('UPDATE files SET url = ? WHERE path = ?', (url, self.relative_path(path)))
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'wb') as file:
+            file.write(content)
+        os.replace(f"{path}.tmp", path)
+        self.record_file(path, content_hash, url)
+        return True
+
+    def record_file(self, path, content_hash, url=None):
+        stat = os.stat(path)
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                                    (self.relative_path(path), content_hash, stat.st_size, stat.st_mtime_ns, url, time.time()))
+
+    # Ingesting
+
+    def scan(self, folders=None):
+        """
+        Brings the files table in line with the page folders: pages whose size or mtime changed are
+        re-hashed, new pages are added and vanished ones dropped. Only changed pages are read.
+
+        Args:
+        folders (set): Page folders (relative paths, as in page_folders) to scan; all of them when not given.
+
+        Returns:
+        dict: Counts of added, changed and removed files.
+        """
+        # Taken before the walk, so pages added while it runs change the mtimes the next sync compares
+        page_folders = self.page_folders()
+        if folders is None:
+            folders = set(page_folders)
+            in_scope = lambda path: True
+        else:
+            in_scope = lambda path: path.rpartition('/')[0] in folders
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in self.fetch('SELECT path, size, mtime_ns FROM files')}
+        seen = set()
+        stats = {'added': 0, 'changed': 0, 'removed': 0}
+        with self.transaction() as connection:
+            for path, stat in self.walk_pages(sorted(folders)):
+                seen.add(path)
+                if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                with open(os.path.join(self.database_dir, path), 'rb') as file:
+                    content_hash = hashlib.md5(file.read()).hexdigest()
+                stats['changed' if path in known else 'added'] += 1
+                connection.execute('INSERT INTO files VALUES (?, ?, ?, ?, NULL, ?) ON CONFLICT (path) DO UPDATE SET '
+                                   'content_hash = excluded.content_hash, size = excluded.size, mtime_ns = excluded.mtime_ns, '
+                                   'updated_at = excluded.updated_at',
+                                   (path, content_hash, stat.st_size, stat.st_mtime_ns, time.time()))
+            removed = [(path,) for path in known if path not in seen and in_scope(path)]
+            connection.executemany('DELETE FROM files WHERE path = ?', removed)
+            stats['removed'] = len(removed)
+            connection.execute("INSERT OR REPLACE INTO state VALUES ('scanned_at', ?)", (str(time.time()),))
+            connection.execute("INSERT OR REPLACE INTO state VALUES ('page_folders', ?)", (json.dumps(page_folders),))
+        return stats
+
+    def page_folders(self):
+        """
+        Returns {relative path: mtime_ns} of the wikipedia folder and every Bing query folder. Adding,
+        deleting or replacing a page changes the mtime of its folder; editing it in place does not.
+        """
+        folders = {}
+        wiki_dir = os.path.join(self.database_dir, 'wikipedia')
+        if os.path.isdir(wiki_dir):
+            folders['wikipedia'] = os.stat(wiki_dir).st_mtime_ns
+        bing_dir = os.path.join(self.database_dir, 'bing_search')
+        if os.path.isdir(bing_dir):
+            for hash_dir in os.scandir(bing_dir):
+                if hash_dir.is_dir():
+                    folders[f"bing_search/{hash_dir.name}"] = hash_dir.stat().st_mtime_ns
+        return folders
+
+    def walk_pages(self, folders):
+        """Yields (relative path, stat) of every page JSON in the given page folders."""
+        for folder in folders:
+            folder_path = os.path.join(self.database_dir, folder)
+            if os.path.isdir(folder_path):
+                for entry in os.scandir(folder_path):
+                    if entry.name.endswith('.json') and entry.is_file():
+                        yield f"{folder}/{entry.name}", entry.stat()
+
+    def sync(self, rescan=False, changed_folders_only=False):
+        """
+        Scans every page folder: one stat per page, re-hashing only pages whose size or mtime changed.
+
+        With changed_folders_only, only the folders whose mtime differs from the last scan are scanned,
+        at one stat per folder. That picks up pages added or deleted by other tools, but not pages
+        edited in place. A manifest that was never scanned (pages from before it), or rescan, still
+        scans everything.
+        """
+        with self.lock:
+            if rescan or not changed_folders_only or self.get_state('scanned_at') is None:
+                stats = self.scan()
+            else:
+                scanned = json.loads(self.get_state('page_folders') or '{}')
+                current = self.page_folders()
+                changed = {folder for folder in scanned.keys() | current.keys() if scanned.get(folder) != current.get(folder)}
+                if not changed:
+                    return
+                stats = self.scan(changed)
+            if any(stats.values()):
+                print(f"Manifest scan of {self.database_dir}: {stats['added']} added, {stats['changed']} changed, "
+                      f"{stats['removed']} removed")
+
+    def page_paths(self):
+        """Relative paths of every recorded page, sorted."""
+        return [path for (path,) in self.fetch('SELECT path FROM files ORDER BY path')]
+
+    def changed_files(self, index_folder, processed_files):
+        """
+        Returns {relative path: content hash} of recorded pages that index_folder has not ingested
+        at their current content hash. The ingest records are first reset from processed_files if
+        they disagree with it (an index folder rebuilt, restored or built before the manifest).
+        """
+        checksum = ingest_checksum(processed_files)
+        if self.fetch_value('SELECT checksum FROM indexes WHERE index_folder = ?', (index_folder,)) != checksum:
+            self.record_ingested(index_folder, processed_files, processed_files, [], None, replace=True)
+        return dict(self.fetch(
+            'SELECT files.path, files.content_hash FROM files LEFT JOIN ingested '
+            'ON ingested.index_folder = ? AND ingested.path = files.path '
+            'WHERE ingested.path IS NULL OR ingested.content_hash != files.content_hash', (index_folder,)))
+
+    def record_ingested(self, index_folder, processed_files, updated_files, removed_files, embedding_version, replace=False):
+        """
+        Records the files a build of index_folder ingested (updated_files, {path: content hash}) and
+        dropped (removed_files), and the checksum of its processed_files. With replace, every earlier
+        record of index_folder is dropped first.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            if replace:
+                connection.execute('DELETE FROM ingested WHERE index_folder = ?', (index_folder,))
+            connection.executemany('INSERT OR REPLACE INTO ingested VALUES (?, ?, ?, ?, ?)',
+                                   [(index_folder, path, file_hash, embedding_version, now) for path, file_hash in updated_files.items()])
+            connection.executemany('DELETE FROM ingested WHERE index_folder = ? AND path = ?',
+                                   [(index_folder, path) for path in removed_files])
+            connection.execute('INSERT OR REPLACE INTO indexes VALUES (?, ?, ?, ?)',
+                               (index_folder, ingest_checksum(processed_files), embedding_version, now))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,152 @@
+import re
+import zlib
+import numpy as np
+
+WORD_PATTERN = re.compile(r'\w+')
+# Signature of a text without words; never matched against anything
+NO_SIGNATURE = np.iinfo(np.uint32).max
+
+class MinHasher:
+    """
+    MinHash signatures over lowercased word shingles, split into LSH bands.
+
+    Two texts share a band key with probability about J ** (num_perm / bands) per band, where J is
+    the Jaccard similarity of their shingle sets; the fraction of equal signature entries estimates J.
+    """
+
+    def __init__(self, num_perm=32, bands=8, shingle_size=3, seed=1):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing: odd multipliers, upper 32 bits of the wrapped 64 bit product
+        self.multipliers = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self.increments = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+        self.band_multipliers = rng.integers(1, 2 ** 63, size=num_perm // bands, dtype=np.uint64) | np.uint64(1)
+
+    def signature(self, text):
+        words = WORD_PATTERN.findall(text.lower())
+        if not words:
+            return np.full(self.num_perm, NO_SIGNATURE, dtype=np.uint32)
+        # Texts shorter than a shingle become a single shingle, so they only match themselves
+        size = min(self.shingle_size, len(words))
+        shingles = {' '.join(words[start:start + size]) for start in range(len(words) - size + 1)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        permuted = (self.multipliers[:, None] * hashes[None, :] + self.increments[:, None]) >> np.uint64(32)
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def signatures(self, texts):
+        signatures = np.empty((len(texts), self.num_perm), dtype=np.uint32)
+        for row, text in enumerate(texts):
+            signatures[row] = self.signature(text)
+        return signatures
+
+    def band_keys(self, signatures):
+        """Returns a (rows, bands) uint64 key per band of each signature."""
+        signatures = np.asarray(signatures, dtype=np.uint64).reshape(len(signatures), self.bands, -1)
+        return (signatures * self.band_multipliers).sum(axis=2, dtype=np.uint64)
+
+def has_signature(signatures):
+    return (np.asarray(signatures) != NO_SIGNATURE).any(axis=-1)
+
+class Deduplicator:
+    """
+    Maps each sentence onto a vector: the vector of an earlier sentence with the same text hash,
+    else (with near_duplicates) the vector of an earlier sentence whose MinHash similarity is at
+    least threshold, else a new vector id.
+
+    With store set, the vectors of that corpus store (its text hashes and MinHash signatures) are
+    matched as well, so incremental builds deduplicate against what is already indexed.
+    """
+
+    def __init__(self, hasher, threshold=0.8, near_duplicates=True, store=None):
+        self.hasher = hasher
+        self.threshold = threshold
+        self.near_duplicates = near_duplicates
+        self.exact = {}
+        self.band_tables = [{} for _ in range(hasher.bands)]
+        self.signatures = {}
+        self.base_exact = None
+        self.base_bands = None
+        self.base_signatures = None
+
+        if store is not None and len(store):
+            import pandas as pd
+            text_hashes = np.asarray(store.text_hashes)
+            first_rows = np.flatnonzero(~pd.Series(text_hashes).duplicated().to_numpy())
+            self.base_exact = (pd.Index(text_hashes[first_rows]), np.asarray(store.vector_ids)[first_rows])
+            if near_duplicates and store.minhash is not None:
+                self.base_signatures = store.minhash
+                vector_ids = np.flatnonzero(has_signature(store.minhash))
+                keys = hasher.band_keys(np.asarray(store.minhash)[vector_ids])
+                self.base_bands = []
+                for band in range(hasher.bands):
+                    first = np.flatnonzero(~pd.Series(keys[:, band]).duplicated().to_numpy())
+                    self.base_bands.append((pd.Index(keys[first, band]), vector_ids[first]))
+
+    def similar(self, signature, other):
+        return np.count_nonzero(signature == other) >= self.threshold * len(signature)
+
+    def assign(self, hashes, signatures, next_vector):
+        """
+        Args:
+        hashes (list): Text hash of each sentence.
+        signatures (ndarray): (rows, num_perm) MinHash signatures, or None to match exact duplicates only.
+        next_vector (int): Id the next new vector gets.
+
+        Returns:
+        tuple: (vector id of each row, rows that start a new vector in id order, exact duplicates, near duplicates)
+        """
+        vector_ids = np.empty(len(hashes), dtype=np.int64)
+        new_rows = []
+        exact_duplicates = near_duplicates = 0
+
+        base_exact = np.full(len(hashes), -1, dtype=np.int64)
+        if self.base_exact is not None and len(hashes):
+            lookup, base_vector_ids = self.base_exact
+            found = lookup.get_indexer(np.asarray(hashes, dtype='S32'))
+            base_exact[found >= 0] = base_vector_ids[found[found >= 0]]
+
+        match_near = self.near_duplicates and signatures is not None
+        if match_near:
+            keys = self.hasher.band_keys(signatures)
+            with_signature = has_signature(signatures)
+            base_candidates = np.full(keys.shape, -1, dtype=np.int64)
+            if self.base_bands is not None:
+                for band, (lookup, band_vector_ids) in enumerate(self.base_bands):
+                    found = lookup.get_indexer(keys[:, band])
+                    base_candidates[found >= 0, band] = band_vector_ids[found[found >= 0]]
+
+        for row, text_hash in enumerate(hashes):
+            vector_id = int(base_exact[row]) if base_exact[row] >= 0 else self.exact.get(text_hash, -1)
+            if vector_id >= 0:
+                exact_duplicates += 1
+            elif match_near and with_signature[row]:
+                vector_id = self.find_near(signatures[row], keys[row], base_candidates[row])
+                if vector_id >= 0:
+                    near_duplicates += 1
+            if vector_id < 0:
+                vector_id = next_vector
+                next_vector += 1
+                new_rows.append(row)
+                if match_near and with_signature[row]:
+                    self.signatures[vector_id] = signatures[row]
+                    for band, key in enumerate(keys[row].tolist()):
+                        self.band_tables[band].setdefault(key, vector_id)
+            self.exact.setdefault(text_hash, vector_id)
+            vector_ids[row] = vector_id
+        return vector_ids, np.asarray(new_rows, dtype=np.int64), exact_duplicates, near_duplicates
+
+    def find_near(self, signature, keys, base_candidates):
+        checked = set()
+        for band, key in enumerate(keys.tolist()):
+            for vector_id, signatures in ((int(base_candidates[band]), self.base_signatures),
+                                          (self.band_tables[band].get(key, -1), self.signatures)):
+                if vector_id < 0 or vector_id in checked:
+                    continue
+                checked.add(vector_id)
+                if self.similar(signature, signatures[vector_id]):
+                    return vector_id
+        return -1
@@ -1,20 +1,29 @@
+import os
 from wikipedia_fetcher import WikipediaPageFetcher
-from bing_search import fetch_bing_search_results
+from bing_search import Crawler, fetch_bing_search_results
+from crawl_manifest import open_manifest
 import configparser
 
-def download_wikipedia_content(wiki_search_terms):
-    wiki_fetcher = WikipediaPageFetcher(user_agent='MyProjectName (merlin@example.com)')
-    for wiki_search_term in wiki_search_terms.split(','):
-        wiki_page = wiki_fetcher.get_wikipedia_page_content(wiki_search_term.strip())
-        if wiki_page:
-            print(wiki_fetcher.save_content_to_file(wiki_page))
-        else:
-            print("Wikipedia page not found for:", wiki_search_term)
+def download_wikipedia_content(wiki_search_terms, wiki_titles_file='', wiki_workers=8, manifest=None, recrawl_after=None):
+    wiki_fetcher = WikipediaPageFetcher(user_agent='MyProjectName (merlin@example.com)', manifest=manifest)
+    titles = [wiki_search_term.strip() for wiki_search_term in wiki_search_terms.split(',')]
+    # A titles file (one title per line) adds bulk lists of pages to the configured terms
+    if wiki_titles_file:
+        with open(wiki_titles_file, 'r', encoding='utf-8') as file:
+            titles.extend(file.read().splitlines())
+    wiki_fetcher.fetch_pages_bulk(titles, max_workers=wiki_workers, recrawl_after=recrawl_after)
 
-def download_bing_content(bing_search_terms):
-    for bing_search_term in bing_search_terms.split(','):
-        print(f"Downloading Bing search results for: {bing_search_term}")
-        fetch_bing_search_results(bing_search_term.strip())
+def download_bing_content(bing_search_terms, crawl_workers=8, per_host_interval=1.0, search_page_delay=30, manifest=None,
+                          recrawl_after=None):
+    # One crawler for all terms so connections and per-host limits are shared
+    crawler = Crawler(max_workers=crawl_workers, per_host_interval=per_host_interval)
+    try:
+        for bing_search_term in bing_search_terms.split(','):
+            print(f"Downloading Bing search results for: {bing_search_term}")
+            fetch_bing_search_results(bing_search_term.strip(), delay=search_page_delay, crawler=crawler, manifest=manifest,
+                                      recrawl_after=recrawl_after)
+    finally:
+        crawler.close()
 
 if __name__ == "__main__":
     config = configparser.ConfigParser()
@@ -22,6 +31,15 @@ if __name__ == "__main__":
     
     wiki_terms = config['DEFAULT']['wiki_terms']
     bing_terms = config['DEFAULT']['bing_terms']
+    wiki_titles_file = config['DEFAULT'].get('wiki_titles_file', '')
+    wiki_workers = config['DEFAULT'].getint('wiki_workers', 8)
+    crawl_workers = config['DEFAULT'].getint('crawl_workers', 8)
+    per_host_interval = config['DEFAULT'].getfloat('per_host_interval', 1.0)
+    search_page_delay = config['DEFAULT'].getfloat('search_page_delay', 30)
+    # Pages already downloaded are fetched again (conditionally) once they are this old; 0 never re-fetches them
+    recrawl_after_days = config['DEFAULT'].getfloat('recrawl_after_days', 0)
+    recrawl_after = recrawl_after_days * 86400 if recrawl_after_days > 0 else None
 
-    download_wikipedia_content(wiki_terms)
-    download_bing_content(bing_terms)
\ No newline at end of file
+    manifest = open_manifest(os.path.join(os.getcwd(), 'rag_database'))
+    download_wikipedia_content(wiki_terms, wiki_titles_file, wiki_workers, manifest, recrawl_after)
+    download_bing_content(bing_terms, crawl_workers, per_host_interval, search_page_delay, manifest, recrawl_after)
\ No newline at end of file
@@ -0,0 +1,153 @@
+import os
+import glob
+import shutil
+import numpy as np
+
+EMBEDDINGS_FOLDER = 'embeddings'
+SHARD_PATTERN = 'part-{:05d}.npy'
+
+def save_npy(path, array):
+    # Write next to the target and swap it in, so readers never see a partial file
+    with open(f"{path}.tmp", 'wb') as file:
+        np.save(file, array)
+    os.replace(f"{path}.tmp", path)
+
+def load_array(path):
+    # np.load cannot memory-map a zero-length payload
+    array = np.load(path, mmap_mode='r')
+    return array if array.size else np.load(path)
+
+def append_rows_to_npy(path, rows):
+    """
+    Appends rows to a .npy file in place along its first axis. The rows are written at the end of
+    the file and only the shape in the header is rewritten; the file is copied only if the new
+    shape does not fit in the existing header padding.
+    """
+    if not os.path.exists(path):
+        save_npy(path, rows)
+        return
+
+    with open(path, 'r+b') as file:
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+        data_offset = file.tell()
+        if fortran_order or len(shape) != rows.ndim or tuple(shape[1:]) != tuple(rows.shape[1:]):
+            raise ValueError(f"Cannot append rows of shape {rows.shape} to {path} with shape {shape}")
+
+        new_shape = (shape[0] + len(rows),) + tuple(shape[1:])
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype), new_shape)
+        header_start = 10 if version == (1, 0) else 12
+        padding = data_offset - header_start - len(header) - 1
+        if padding >= 0:
+            # Data first, header last: a crash in between leaves the old header describing valid rows
+            file.seek(data_offset + shape[0] * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize)
+            file.write(np.ascontiguousarray(rows, dtype=dtype).tobytes())
+            file.truncate()
+            file.flush()
+            file.seek(header_start)
+            file.write((header + ' ' * padding + '\n').encode('latin1'))
+            return
+
+    existing = np.load(path, mmap_mode='r')
+    combined = np.lib.format.open_memmap(f"{path}.tmp", mode='w+', dtype=existing.dtype, shape=new_shape)
+    combined[:len(existing)] = existing
+    combined[len(existing):] = rows
+    combined.flush()
+    del combined, existing
+    os.replace(f"{path}.tmp", path)
+
+def swap_folder(tmp_folder, folder):
+    # Readers that already mapped files of the old folder keep them alive until they close
+    old_folder = f"{folder}.old"
+    shutil.rmtree(old_folder, ignore_errors=True)
+    if os.path.exists(folder):
+        os.rename(folder, old_folder)
+    os.rename(tmp_folder, folder)
+    shutil.rmtree(old_folder, ignore_errors=True)
+
+def migrate_embeddings(index_folder):
+    """Moves a single legacy embeddings.npy into the shard folder as its first shard."""
+    legacy_path = os.path.join(index_folder, "embeddings.npy")
+    shard_folder = os.path.join(index_folder, EMBEDDINGS_FOLDER)
+    if os.path.exists(legacy_path) and not os.path.isdir(shard_folder):
+        os.makedirs(shard_folder)
+        os.replace(legacy_path, os.path.join(shard_folder, SHARD_PATTERN.format(0)))
+
+class EmbeddingShards:
+    """Embeddings split across part-NNNNN.npy files, memory-mapped and addressed as one array of rows."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.paths = sorted(glob.glob(os.path.join(folder, 'part-*.npy')))
+        self.arrays = [load_array(path) for path in self.paths]
+        self.offsets = np.zeros(len(self.arrays) + 1, dtype=np.int64)
+        np.cumsum([len(array) for array in self.arrays], out=self.offsets[1:])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def dtype(self):
+        return self.arrays[0].dtype if self.arrays else None
+
+    @property
+    def dimension(self):
+        return self.arrays[0].shape[1] if self.arrays else None
+
+    def take(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        taken = np.empty((len(rows), self.dimension), dtype=self.dtype)
+        shards = np.searchsorted(self.offsets, rows, side='right') - 1
+        for shard in np.unique(shards):
+            mask = shards == shard
+            local_rows = rows[mask] - self.offsets[shard]
+            # Sorted reads keep memory-mapped access sequential
+            order = np.argsort(local_rows)
+            taken[np.flatnonzero(mask)[order]] = self.arrays[shard][local_rows[order]]
+        return taken
+
+    def iter_chunks(self, chunk_rows=65536):
+        for offset, array in zip(self.offsets, self.arrays):
+            for start in range(0, len(array), chunk_rows):
+                yield int(offset) + start, np.asarray(array[start:start + chunk_rows])
+
+class ShardWriter:
+    """
+    Appends embedding rows to shards of at most shard_rows rows. New shards carry a .tmp suffix
+    (invisible to readers and autofaiss) until commit renames them.
+    """
+
+    def __init__(self, folder, shard_rows=1000000, dtype='float32'):
+        self.folder = folder
+        self.shard_rows = shard_rows
+        self.dtype = dtype
+        os.makedirs(folder, exist_ok=True)
+        for stale_path in glob.glob(os.path.join(folder, 'part-*.npy.tmp')):
+            os.remove(stale_path)
+        self.next_shard = len(glob.glob(os.path.join(folder, 'part-*.npy')))
+        self.current_path = None
+        self.current_rows = 0
+        self.written_paths = []
+        self.rows = 0
+
+    def append(self, vectors):
+        vectors = np.asarray(vectors, dtype=self.dtype)
+        while len(vectors):
+            if self.current_path is None or self.current_rows >= self.shard_rows:
+                self.current_path = os.path.join(self.folder, SHARD_PATTERN.format(self.next_shard) + '.tmp')
+                self.written_paths.append(self.current_path)
+                self.next_shard += 1
+                self.current_rows = 0
+            take = min(len(vectors), self.shard_rows - self.current_rows)
+            append_rows_to_npy(self.current_path, vectors[:take])
+            self.current_rows += take
+            self.rows += take
+            vectors = vectors[take:]
+
+    def commit(self):
+        for path in self.written_paths:
+            os.replace(path, path[:-len('.tmp')])
+        self.written_paths = []
@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import glob
+import time
+import random
+import configparser
+import multiprocessing
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+REPORT_FILE = 'encoder_report.json'
+# Modules a search process used to import before its first query; only the model libraries are still needed
+HEAVY_MODULES = ('torch', 'sentence_transformers', 'pandas', 'autofaiss', 'tqdm')
+
+def sample_queries(index_folder, num_queries=200, seed=1):
+    """Corpus sentences with words dropped, so each query has near but not exact matches, as in benchmark.py."""
+    from corpus_store import CORPUS_FOLDER, CorpusStore
+    texts = []
+    for meta_path in sorted(glob.glob(os.path.join(index_folder, CORPUS_FOLDER, 'meta.json')) +
+                            glob.glob(os.path.join(index_folder, 'shards', '*', CORPUS_FOLDER, 'meta.json'))):
+        store = CorpusStore(os.path.dirname(meta_path))
+        texts.extend(store.text[row] for row in np.flatnonzero(~np.asarray(store.deleted)))
+    rng = random.Random(seed)
+    queries = []
+    for text in rng.sample(texts, min(num_queries, len(texts))):
+        words = text.split()
+        if words:
+            queries.append(' '.join(word for word in words if rng.random() > 0.3) or words[0])
+    return queries
+
+def latency_ms(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {'p50_ms': float(np.percentile(latencies, 50)), 'p95_ms': float(np.percentile(latencies, 95))}
+
+def measure_backend(backend, model, index_folder, queries, top_k, rerank_candidates, cross_encoder_model, cross_encoder_max_length,
+                    threads, index_load_mode, search_params):
+    """
+    Runs in a fresh process, so the import and load times are those of a cold CLI run: startup is
+    everything up to the first query's results. Returns the timings and each query's result texts.
+    """
+    start = time.perf_counter()
+    from sharded_index import open_search
+    from CrossEncoderSearch import CrossencoderSearch, dict_to_list, get_cross_encoder
+    from encoders import load_sentence_model
+    import_seconds = time.perf_counter() - start
+    imported = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    start = time.perf_counter()
+    sentence_model = load_sentence_model(model, backend, threads)
+    model_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    afss = open_search(sentence_model, index_folder, index_load_mode=index_load_mode, search_params=search_params,
+                       encoder_backend=backend)
+    open_seconds = time.perf_counter() - start
+
+    candidates = max(top_k, rerank_candidates) if cross_encoder_model else top_k
+    latencies = []
+    hits = []
+    for query in queries:
+        start = time.perf_counter()
+        hits.append(afss.search_sentences(query, top_k=candidates))
+        latencies.append(time.perf_counter() - start)
+    first_query_seconds = latencies[0]
+    result = {
+        'import_seconds': import_seconds,
+        'imported': imported,
+        'model_seconds': model_seconds,
+        'open_seconds': open_seconds,
+        'first_query_seconds': first_query_seconds,
+        'startup_seconds': import_seconds + model_seconds + open_seconds + first_query_seconds,
+        'search': latency_ms(latencies[1:] or latencies),
+        'search_hits': [[hit['Main Sentence'] for hit in results[:top_k]] for results in hits]
+    }
+
+    if cross_encoder_model:
+        start = time.perf_counter()
+        cross_encoder = get_cross_encoder(cross_encoder_model, cross_encoder_max_length, backend, threads)
+        result['cross_encoder_seconds'] = time.perf_counter() - start
+        latencies = []
+        reranked = []
+        for query, results in zip(queries, hits):
+            # No score cache, so every pair is scored as on a cold query
+            start = time.perf_counter()
+            pairs = CrossencoderSearch(query, dict_to_list(results), cross_encoding_model=cross_encoder, cache=None).run_cross_encoder(top_k)
+            latencies.append(time.perf_counter() - start)
+            reranked.append([passage for _, passage, _ in pairs])
+        result['rerank'] = latency_ms(latencies)
+        result['rerank_hits'] = reranked
+
+    # What the query path no longer imports up front; a search-only host may not have the build libraries
+    start = time.perf_counter()
+    try:
+        import pandas, autofaiss, tqdm, ingest_pipeline
+        result['deferred_import_seconds'] = time.perf_counter() - start
+    except ImportError as e:
+        result['deferred_import_error'] = str(e)
+    return result
+
+def agreement(hits, baseline_hits):
+    """Mean fraction of each query's baseline top-k that hits also returns, in any order."""
+    overlaps = [len(set(found) & set(expected)) / len(expected) for found, expected in zip(hits, baseline_hits) if expected]
+    return float(np.mean(overlaps)) if overlaps else 1.0
+
+def encoder_report(index_folder, model, backends=('torch', 'int8'), num_queries=200, top_k=5, rerank_candidates=100,
+                   cross_encoder_model=None, cross_encoder_max_length=512, threads=None, index_load_mode='memory', search_params=None):
+    """
+    Compares encoder backends on the query path of index_folder: the startup of a cold search process
+    (imports, model load, index open and first query), per-query search and rerank latency, and
+    how far each backend's top_k agrees with the first backend's (the current 'torch' path by default).
+
+    Every backend runs in its own spawned process on the same num_queries queries sampled from the
+    corpus. Reranking is measured when cross_encoder_model is given, over rerank_candidates
+    first-stage results per query.
+
+    Returns:
+    list: One dict per backend, also written to index_folder/encoder_report.json.
+    """
+    index_folder = os.path.abspath(index_folder)
+    queries = sample_queries(index_folder, num_queries)
+    report = []
+    for backend in backends:
+        print(f"Measuring {backend}")
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            try:
+                result = executor.submit(measure_backend, backend, model, index_folder, queries, top_k, rerank_candidates,
+                                         cross_encoder_model, cross_encoder_max_length, threads, index_load_mode, search_params).result()
+            except Exception as e:
+                result = {'error': str(e)}
+        result['backend'] = backend
+        report.append(result)
+
+    baseline = next((result for result in report if 'error' not in result), None)
+    for result in report:
+        if 'error' in result or baseline is None:
+            continue
+        result['search_agreement'] = agreement(result['search_hits'], baseline['search_hits'])
+        if 'rerank_hits' in result:
+            result['rerank_agreement'] = agreement(result['rerank_hits'], baseline['rerank_hits'])
+
+    with open(os.path.join(index_folder, REPORT_FILE), 'w') as file:
+        json.dump({'model': model, 'cross_encoder_model': cross_encoder_model, 'queries': queries, 'top_k': top_k,
+                   'threads': threads, 'backends': report}, file, indent=4)
+
+    print(f"{'backend':<8} {'import s':>9} {'model s':>8} {'open s':>7} {'startup s':>10} {'search p50':>11} {'p95 ms':>7} "
+          f"{'rerank p50':>11} {'p95 ms':>7} {'top-' + str(top_k) + ' agree':>12} {'rerank agree':>13}")
+    for result in report:
+        if 'error' in result:
+            print(f"{result['backend']:<8} failed: {result['error']}")
+            continue
+        rerank = result.get('rerank', {})
+        print(f"{result['backend']:<8} {result['import_seconds']:>9.3f} {result['model_seconds']:>8.3f} {result['open_seconds']:>7.3f} "
+              f"{result['startup_seconds']:>10.3f} {result['search']['p50_ms']:>11.2f} {result['search']['p95_ms']:>7.2f} "
+              f"{rerank.get('p50_ms', float('nan')):>11.2f} {rerank.get('p95_ms', float('nan')):>7.2f} "
+              f"{result['search_agreement']:>12.3f} {result.get('rerank_agreement', float('nan')):>13.3f}")
+    if baseline is not None:
+        if 'deferred_import_seconds' in baseline:
+            deferred = f"{baseline['deferred_import_seconds']:.3f}s"
+        else:
+            deferred = f"not measured ({baseline['deferred_import_error']})"
+        print(f"Loaded before the first query: {', '.join(baseline['imported']) or 'none'}; deferred build-only imports: {deferred}")
+    return report
+
+if __name__ == "__main__":
+
+    # Read configuration
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    index_folder = config['DEFAULT']['index_folder']
+    model = config['DEFAULT']['model']
+    backends = [backend.strip() for backend in config['DEFAULT'].get('report_encoder_backends', 'torch,int8').split(',') if backend.strip()]
+    num_queries = config['DEFAULT'].getint('report_queries', 200)
+    top_k = config['DEFAULT'].getint('top_k', 5)
+    rerank_candidates = config['DEFAULT'].getint('rerank_candidates', 100)
+    cross_encoder_rerank = config['DEFAULT'].getboolean('cross_encoder_rerank', False)
+    cross_encoder_max_length = config['DEFAULT'].getint('cross_encoder_max_length', 512)
+    encoder_threads = config['DEFAULT'].getint('encoder_threads', 0) or None
+    index_load_mode = config['DEFAULT'].get('index_load_mode', 'memory')
+    search_params = config['DEFAULT'].get('search_params', '')
+
+    # Imported here, not at the top: spawned workers re-import this module and their import time is measured
+    from CrossEncoderSearch import CROSS_ENCODER_MODEL
+    encoder_report(index_folder, model, backends, num_queries, top_k, rerank_candidates,
+                   CROSS_ENCODER_MODEL if cross_encoder_rerank else None, cross_encoder_max_length, encoder_threads,
+                   index_load_mode, search_params)
@@ -0,0 +1,90 @@
+import numpy as np
+
+# 'torch' loads models as they are; 'int8' dynamically quantizes their Linear layers to int8 for CPU
+ENCODER_BACKENDS = ('torch', 'int8')
+
+def check_backend(backend):
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"encoder_backend must be one of {ENCODER_BACKENDS}, got {backend!r}")
+
+def backend_key(model_name, backend='torch'):
+    """Names a model as loaded with backend, e.g. for cache keys: int8 embeddings and scores differ slightly from torch ones."""
+    return model_name if backend == 'torch' else f"{model_name}:{backend}"
+
+def set_threads(threads):
+    """Caps the threads torch runs one encode on; 0 or None keeps its default of one per core."""
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+
+def quantize(module):
+    """
+    Replaces the Linear layers of module, in place, with dynamically quantized int8 ones: weights
+    are stored in int8 and activations quantized per batch, so CPU matrix multiplies run on int8
+    kernels. The embedding layers and layer norms stay in float32.
+    """
+    import torch
+    module.to('cpu')
+    module.eval()
+    torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return module
+
+def load_sentence_model(model_name, backend='torch', threads=None):
+    """Loads a SentenceTransformer for encoding queries with backend, running on threads torch threads."""
+    check_backend(backend)
+    set_threads(threads)
+    from sentence_transformers import SentenceTransformer
+    if backend == 'int8':
+        return quantize(SentenceTransformer(model_name, device='cpu'))
+    return SentenceTransformer(model_name)
+
+def load_cross_encoder(model_name, max_length=512, backend='torch', threads=None):
+    """Loads a CrossEncoder for reranking with backend, running on threads torch threads."""
+    check_backend(backend)
+    set_threads(threads)
+    from sentence_transformers import CrossEncoder
+    if backend == 'int8':
+        cross_encoder = CrossEncoder(model_name, max_length=max_length, device='cpu')
+        # The transformer sits in .model; the CrossEncoder around it holds the tokenizer and settings
+        quantize(getattr(cross_encoder, 'model', cross_encoder))
+        return cross_encoder
+    return CrossEncoder(model_name, max_length=max_length)
+
+def token_lengths(model, texts):
+    """
+    Returns the token count of each text, used to group similar lengths into the same batch.
+    Falls back to character counts when the model exposes no tokenizer.
+    """
+    tokenizer = getattr(model, 'tokenizer', None)
+    if tokenizer is None:
+        return np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+    lengths = np.empty(len(texts), dtype=np.int64)
+    chunk_size = 10000
+    for start in range(0, len(texts), chunk_size):
+        input_ids = tokenizer(texts[start:start + chunk_size], add_special_tokens=False, return_attention_mask=False)['input_ids']
+        lengths[start:start + len(input_ids)] = [len(ids) for ids in input_ids]
+    return lengths
+
+def encode_sorted(model, texts, batch_size=64, dtype='float32', progress=False):
+    """
+    Encodes preprocessed texts in token-length order so every batch pads to roughly the same
+    length, scattering each batch straight back into its rows of one preallocated array.
+    """
+    embeddings = np.empty((len(texts), model.get_sentence_embedding_dimension()), dtype=dtype)
+    if not len(texts):
+        return embeddings
+    order = np.argsort(token_lengths(model, texts), kind='stable')
+    batch_starts = range(0, len(order), batch_size)
+    if progress:
+        from tqdm import tqdm
+        batch_starts = tqdm(batch_starts)
+    for start in batch_starts:
+        batch_rows = order[start:start + batch_size]
+        embeddings[batch_rows] = model.encode(
+            [texts[row] for row in batch_rows],
+            batch_size=batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+    return embeddings
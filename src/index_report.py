@@ -0,0 +1,189 @@
+import os
+import re
+import json
+import time
+import resource
+import configparser
+import multiprocessing
+import faiss
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from autofaiss_index import apply_search_params, read_faiss_index
+from embedding_store import EMBEDDINGS_FOLDER, EmbeddingShards
+
+REPORT_FOLDER = 'index_report'
+
+def read_rss():
+    """Returns (private, file-backed) resident memory in bytes. File-backed pages of a memory-mapped index are shared."""
+    try:
+        with open('/proc/self/status', 'r') as file:
+            status = dict(line.split(':', 1) for line in file if ':' in line)
+        return int(status['RssAnon'].split()[0]) * 1024, int(status['RssFile'].split()[0]) * 1024
+    except (OSError, KeyError):
+        # No /proc: peak RSS is the closest available figure
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, 0
+
+def exact_neighbors(shards, queries, k, chunk_rows=65536):
+    """Exact inner product top k of queries over every embedding, one shard chunk at a time."""
+    best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+    for start, chunk in shards.iter_chunks(chunk_rows):
+        scores, ids = faiss.knn(queries, np.ascontiguousarray(chunk, dtype='float32'), min(k, len(chunk)),
+                                metric=faiss.METRIC_INNER_PRODUCT)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        ids = np.concatenate([best_ids, ids + start], axis=1)
+        top = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(ids, top, axis=1)
+    return best_ids
+
+def build_index_variant(shards, index_key, index_path, train_rows=100000, chunk_rows=65536):
+    """Builds index_key (a faiss index factory string) over the embedding shards and writes it to index_path."""
+    index = faiss.index_factory(shards.dimension, index_key, faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        sample = np.random.default_rng(0).choice(len(shards), size=min(train_rows, len(shards)), replace=False)
+        index.train(np.ascontiguousarray(shards.take(np.sort(sample)), dtype='float32'))
+    for _, chunk in shards.iter_chunks(chunk_rows):
+        index.add(np.ascontiguousarray(chunk, dtype='float32'))
+    faiss.write_index(index, index_path)
+
+def ivf_nprobe(index):
+    """Returns the nprobe of an IVF index (also inside a pre-transform or refine wrapper), or None for other index types."""
+    try:
+        return faiss.extract_index_ivf(index).nprobe
+    except RuntimeError:
+        return None
+
+def measure_option(index_path, load_mode, search_params, queries_path, truth_path, k, nprobes=()):
+    """
+    Runs in a fresh process so resident memory reflects this option alone. IVF indexes are measured
+    with search_params as given and then with every nprobe in nprobes; each returned dict records
+    the nprobe it was searched with (None for index types without one).
+    """
+    queries = np.load(queries_path)
+    truth = np.load(truth_path)
+    rss_before = read_rss()
+
+    start = time.perf_counter()
+    index = read_faiss_index(index_path, load_mode)
+    load_seconds = time.perf_counter() - start
+    if search_params:
+        apply_search_params(index, search_params)
+
+    settings = [ivf_nprobe(index)]
+    if settings[0] is not None:
+        settings = sorted(set(settings) | set(nprobes))
+
+    # One query per call, as the search path sees them; the first few warm up caches
+    faiss.omp_set_num_threads(1)
+    results = []
+    for nprobe in settings:
+        if nprobe is not None:
+            faiss.extract_index_ivf(index).nprobe = nprobe
+        found = np.empty((len(queries), k), dtype=np.int64)
+        latencies = []
+        for row in range(len(queries)):
+            start = time.perf_counter()
+            _, ids = index.search(queries[row:row + 1], k)
+            latencies.append(time.perf_counter() - start)
+            found[row] = ids[0]
+        latencies = np.asarray(latencies[min(5, len(latencies) - 1):]) * 1000
+        recall = np.mean([len(np.intersect1d(found_ids[found_ids >= 0], true_ids)) / k for found_ids, true_ids in zip(found, truth)])
+        results.append({
+            'nprobe': nprobe,
+            'recall_at_k': float(recall),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99))
+        })
+    rss_after = read_rss()
+
+    for result in results:
+        result.update({
+            'load_seconds': load_seconds,
+            'rss_private_mb': (rss_after[0] - rss_before[0]) / 1e6,
+            'rss_shared_mb': (rss_after[1] - rss_before[1]) / 1e6,
+            'index_mb': os.path.getsize(index_path) / 1e6
+        })
+    return results
+
+def index_report(index_folder, index_keys=(), load_modes=('memory', 'mmap'), k=10, num_queries=200, search_params=None,
+                 nprobes=(1, 8, 32, 128)):
+    """
+    Compares index options for the embeddings of index_folder: the current knn.index plus one index
+    per faiss factory string in index_keys, each loaded in every load mode.
+
+    Recall@k is measured against an exact flat inner product search over all embeddings, using
+    num_queries embeddings sampled from the index as queries. Latency is per single-query search
+    on one thread. Resident memory is measured in a separate process per option and split into
+    private memory and shared, file-backed memory (the pages of a memory-mapped index).
+
+    IVF indexes trade recall for latency through nprobe, so each is measured at the nprobe that
+    search_params gives it and at every value in nprobes, one row per nprobe.
+
+    Returns:
+    list: One dict per option and nprobe, also written to index_folder/index_report/report.json.
+    """
+    index_folder = os.path.abspath(index_folder)
+    shards = EmbeddingShards(os.path.join(index_folder, EMBEDDINGS_FOLDER))
+    report_folder = os.path.join(index_folder, REPORT_FOLDER)
+    os.makedirs(report_folder, exist_ok=True)
+
+    sample = np.sort(np.random.default_rng(1).choice(len(shards), size=min(num_queries, len(shards)), replace=False))
+    queries = np.ascontiguousarray(shards.take(sample), dtype='float32')
+    k = min(k, len(shards))
+    queries_path = os.path.join(report_folder, 'queries.npy')
+    truth_path = os.path.join(report_folder, 'truth.npy')
+    np.save(queries_path, queries)
+    np.save(truth_path, exact_neighbors(shards, queries, k))
+
+    options = [('current', os.path.join(index_folder, 'knn.index'))]
+    for index_key in index_keys:
+        index_path = os.path.join(report_folder, re.sub(r'[^\w]+', '_', index_key) + '.index')
+        print(f"Building {index_key}")
+        build_index_variant(shards, index_key, index_path)
+        options.append((index_key, index_path))
+
+    report = []
+    for name, index_path in options:
+        for load_mode in load_modes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                try:
+                    results = executor.submit(measure_option, index_path, load_mode, search_params, queries_path, truth_path, k,
+                                              nprobes).result()
+                except Exception as e:
+                    results = [{'error': str(e)}]
+            for result in results:
+                result.update({'index': name, 'load_mode': load_mode})
+                report.append(result)
+
+    with open(os.path.join(report_folder, 'report.json'), 'w') as file:
+        json.dump(report, file, indent=4)
+
+    print(f"{'index':<20} {'mode':<7} {'nprobe':>6} {'recall@' + str(k):>9} {'p50 ms':>8} {'p99 ms':>8} {'private MB':>11} {'shared MB':>10} {'file MB':>8}")
+    for result in report:
+        if 'error' in result:
+            print(f"{result['index']:<20} {result['load_mode']:<7} failed: {result['error']}")
+            continue
+        nprobe = result['nprobe'] if result['nprobe'] is not None else '-'
+        print(f"{result['index']:<20} {result['load_mode']:<7} {nprobe:>6} {result['recall_at_k']:>9.3f} {result['p50_ms']:>8.3f} "
+              f"{result['p99_ms']:>8.3f} {result['rss_private_mb']:>11.1f} {result['rss_shared_mb']:>10.1f} {result['index_mb']:>8.1f}")
+    return report
+
+if __name__ == "__main__":
+
+    # Read configuration
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    index_folder = config['DEFAULT']['index_folder']
+    # Factory strings contain commas, so options are separated by semicolons
+    index_keys = [key.strip() for key in config['DEFAULT'].get('report_index_keys', '').split(';') if key.strip()]
+    num_queries = config['DEFAULT'].getint('report_queries', 200)
+    top_k = config['DEFAULT'].getint('top_k', 5)
+    search_params = config['DEFAULT'].get('search_params', '')
+    # IVF indexes are also measured at each of these nprobe values, on top of the one search_params sets
+    nprobes = [int(value) for value in config['DEFAULT'].get('report_nprobe', '1,8,32,128').split(',') if value.strip()]
+
+    index_report(index_folder, index_keys, k=top_k, num_queries=num_queries, search_params=search_params, nprobes=nprobes)
@@ -0,0 +1,412 @@
+import os
+import time
+import queue
+import threading
+import collections
+import multiprocessing
+import faiss
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+from corpus_store import CORPUS_FOLDER, FORMAT_VERSION, MINHASH_PERM, CorpusStore, CorpusWriter
+from dedup import NO_SIGNATURE, Deduplicator, MinHasher
+from embedding_store import EMBEDDINGS_FOLDER, EmbeddingShards, ShardWriter, migrate_embeddings, swap_folder
+from encoders import encode_sorted, load_sentence_model
+from tracing import tracer
+
+_worker_model = None
+
+def _init_worker(model_name, threads, backend='torch'):
+    global _worker_model
+    # Each process gets its share of the cores instead of every torch pool claiming all of them
+    _worker_model = load_sentence_model(model_name, backend, threads)
+
+def _encode_in_worker(texts, batch_size, dtype):
+    return encode_sorted(_worker_model, texts, batch_size, dtype)
+
+class StageError:
+    def __init__(self, error):
+        self.error = error
+
+_DONE = object()
+
+def start_stage(items, output_queue, stop):
+    """Runs the items generator on a thread, feeding a bounded queue; blocks when the consumer falls behind."""
+    def put(item):
+        while not stop.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(StageError(e))
+            return
+        put(_DONE)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def drain(input_queue):
+    while True:
+        item = input_queue.get()
+        if item is _DONE:
+            return
+        if isinstance(item, StageError):
+            raise item.error
+        yield item
+
+class IngestPipeline:
+    """
+    Streaming, bounded-memory build from rag_database to the index:
+
+        discover + parse JSON  ->  preprocess + hash + MinHash  ->  dedup + embed (process pool)  ->  append shards/corpus
+
+    Stages are connected by bounded queues, so at most queue_size chunks of chunk_rows sentences are
+    in flight at once. Embeddings are appended to part-NNNNN.npy shards of at most shard_rows rows
+    and the corpus store is written in chunks, so neither is ever held whole in memory.
+
+    Builds are incremental as before: only new or changed files are read, vectors of already
+    embedded text are reused from the shards, rows of changed or removed files are tombstoned,
+    and the new vectors are added to the existing faiss index. Which files are new or changed comes
+    from the crawl manifest of rag_database, which records the content hash of every page and the
+    hash each index folder ingested it at, so unchanged pages are not even opened.
+
+    With afss.dedup set, sentences whose text hash (or, with afss.near_duplicates, MinHash
+    similarity) matches an earlier sentence are not embedded again: their rows are stored with the
+    vector id of that sentence, so the shards and the faiss index hold one vector per distinct text.
+    """
+
+    def __init__(self, afss, embed_workers=1, shard_rows=1000000, chunk_rows=4096, queue_size=8):
+        self.afss = afss
+        self.embed_workers = embed_workers or os.cpu_count()
+        self.shard_rows = shard_rows
+        self.chunk_rows = chunk_rows
+        self.queue_size = queue_size
+        self.index_folder = afss.index_folder
+        self.corpus_path = os.path.join(self.index_folder, CORPUS_FOLDER)
+        self.shard_folder = os.path.join(self.index_folder, EMBEDDINGS_FOLDER)
+        self.index_path = os.path.join(self.index_folder, "knn.index")
+        self.processed_files_path = os.path.join(self.index_folder, "processed_files.txt")
+        self.changed_files = []
+        self.stats = collections.Counter()
+        self.use_workers = False
+        self.executor = None
+        self.next_vector = 0
+        self.hasher = MinHasher(MINHASH_PERM) if afss.dedup and afss.near_duplicates else None
+        # Vectors are encoded straight into the dtype of the shards they are written to
+        self.dtype = afss.embedding_dtype
+
+    def open_previous_build(self):
+        """Returns (corpus store, embedding shards) of the last build, or (None, None) if they are missing or disagree."""
+        migrate_embeddings(self.index_folder)
+        if not os.path.exists(os.path.join(self.corpus_path, "meta.json")):
+            # Index folders from before the corpus store: convert the pickle once
+            df = self.afss.read_dataframe()
+            if df is None or 'text_hash' not in df:
+                return None, None
+            CorpusStore.write(self.corpus_path, df)
+        store = CorpusStore(self.corpus_path)
+        shards = EmbeddingShards(self.shard_folder) if os.path.isdir(self.shard_folder) else None
+        if shards is None or len(shards) != store.num_vectors or not len(store):
+            return None, None
+        return store, shards
+
+    def parse_files(self, json_files, processed_files):
+        for filename, json_path in json_files.items():
+            file_hash, json_data = self.afss.read_json_file(json_path)
+            if processed_files.get(filename) == file_hash:
+                continue
+            if filename in processed_files:
+                self.changed_files.append(filename)
+            # Paragraphs; the segmentation stage splits them into sentences
+            yield filename, file_hash, self.afss.json_to_sentences(json_data)
+
+    def chunk_sentences(self, parsed_files):
+        chunk = self.new_chunk()
+        for filename, file_hash, sentences in parsed_files:
+            for position, text in enumerate(sentences):
+                preprocessed = self.afss.preprocess_text(text)
+                chunk['filenames'].append(filename)
+                chunk['positions'].append(position)
+                chunk['texts'].append(text)
+                chunk['preprocessed'].append(preprocessed)
+                chunk['hashes'].append(self.afss.text_hash(preprocessed))
+                if len(chunk['texts']) >= self.chunk_rows:
+                    yield self.sign_chunk(chunk)
+                    chunk = self.new_chunk()
+            # A file counts as processed once the chunk holding its last row is written
+            chunk['files'].append((filename, file_hash))
+        if chunk['texts'] or chunk['files']:
+            yield self.sign_chunk(chunk)
+
+    def new_chunk(self):
+        return {'filenames': [], 'positions': [], 'texts': [], 'preprocessed': [], 'hashes': [], 'files': []}
+
+    def sign_chunk(self, chunk):
+        with tracer.span('build.minhash', rows=len(chunk['texts'])):
+            chunk['signatures'] = self.hasher.signatures(chunk['preprocessed']) if self.hasher is not None else None
+        return chunk
+
+    def worker_pool(self):
+        # Started on the first cache miss, so builds that only reuse vectors never spawn workers
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.embed_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.afss.sentence_model_path, max(1, os.cpu_count() // self.embed_workers), self.afss.encoder_backend)
+            )
+        return self.executor
+
+    def start_embedding(self, chunk, cache, deduplicator):
+        if deduplicator is not None:
+            with tracer.span('build.dedup', rows=len(chunk['hashes'])):
+                vector_ids, new_rows, exact_duplicates, near_duplicates = deduplicator.assign(
+                    chunk['hashes'], chunk['signatures'], self.next_vector)
+            self.stats['exact_duplicates'] += exact_duplicates
+            self.stats['near_duplicates'] += near_duplicates
+        else:
+            new_rows = np.arange(len(chunk['hashes']))
+            vector_ids = self.next_vector + new_rows
+        self.next_vector += len(new_rows)
+
+        # Only rows that start a new vector are looked up in the cache or encoded
+        hashes = np.asarray(chunk['hashes'], dtype='S32')[new_rows]
+        vectors = np.empty((len(hashes), self.afss.sentence_model.get_sentence_embedding_dimension()), dtype=self.dtype)
+
+        cached_vectors = np.full(len(hashes), -1, dtype=np.int64)
+        if cache is not None and len(hashes):
+            with tracer.span('build.cache_lookup', rows=len(hashes)):
+                lookup, first_vectors, shards = cache
+                found = lookup.get_indexer(hashes)
+                cached_vectors[found >= 0] = first_vectors[found[found >= 0]]
+                hits = np.flatnonzero(cached_vectors >= 0)
+                if len(hits):
+                    vectors[hits] = shards.take(cached_vectors[hits])
+
+        misses = np.flatnonzero(cached_vectors < 0)
+        inverse = None
+        encoded = None
+        if len(misses):
+            # Each distinct text in the chunk is encoded once
+            _, first_seen, inverse = np.unique(hashes[misses], return_index=True, return_inverse=True)
+            texts = [chunk['preprocessed'][row] for row in new_rows[misses[first_seen]]]
+            if self.use_workers:
+                encoded = self.worker_pool().submit(_encode_in_worker, texts, self.afss.batch_size, self.dtype)
+            else:
+                encoded = self.encode(texts)
+        self.stats['reused'] += len(hashes) - len(misses)
+        self.stats['encoded'] += 0 if inverse is None else int(inverse.max()) + 1
+        return chunk, vector_ids, new_rows, vectors, misses, inverse, encoded
+
+    def encode(self, texts):
+        """The embed stage in this process: preprocessed texts to one array of vectors, in token-length sorted batches."""
+        with tracer.span('build.generate_embeddings', sentences=len(texts), batch_size=self.afss.batch_size):
+            return encode_sorted(self.afss.sentence_model, texts, self.afss.batch_size, self.dtype)
+
+    def write_chunk(self, pending, corpus_writer, shard_writer, index, processed_files):
+        chunk, vector_ids, new_rows, vectors, misses, inverse, encoded = pending
+        if len(misses):
+            if not isinstance(encoded, np.ndarray):
+                # Time the embedding workers were still busy when the writer got to this chunk
+                with tracer.span('build.wait_embeddings', sentences=len(misses)):
+                    encoded = encoded.result()
+            vectors[misses] = encoded[inverse.reshape(-1)]
+
+        if chunk['signatures'] is not None:
+            signatures = chunk['signatures'][new_rows]
+        else:
+            signatures = np.full((len(new_rows), MINHASH_PERM), NO_SIGNATURE, dtype=np.uint32)
+        with tracer.span('build.write_chunk', rows=len(chunk['texts']), vectors=len(vectors)):
+            shard_writer.append(vectors)
+            corpus_writer.add_vectors(signatures)
+            corpus_writer.append(chunk['filenames'], chunk['positions'], chunk['texts'], chunk['hashes'], vector_ids)
+            if index is not None and len(vectors):
+                # The stored vectors, widened as a full rebuild reads them from the shards, so both index the same values
+                index.add(np.ascontiguousarray(vectors, dtype='float32'))
+        for filename, file_hash in chunk['files']:
+            processed_files[filename] = file_hash
+        self.stats['rows'] += len(chunk['texts'])
+        self.stats['vectors'] += len(vectors)
+        self.stats['files'] += len(chunk['files'])
+
+    def run(self, full_rebuild=False):
+        with tracer.span('build', full_rebuild=full_rebuild) as span:
+            start_time = time.perf_counter()
+            store, shards = self.open_previous_build()
+            cache = None
+            if store is not None:
+                first_rows = np.flatnonzero(~pd.Series(np.asarray(store.text_hashes)).duplicated().to_numpy())
+                cache = (pd.Index(np.asarray(store.text_hashes)[first_rows]), np.asarray(store.vector_ids)[first_rows], shards)
+
+            segmenter = self.afss.segmenter
+            segmenter.stats.clear()
+            if store is not None and not full_rebuild and store.segmentation != segmenter.key:
+                print(f"Segmentation changed from {store.segmentation} to {segmenter.key}: rebuilding the index")
+            index = None
+            # Stores from before deduplication carry no signatures to append to; they get one full build
+            if (not full_rebuild and store is not None and store.meta['format_version'] == FORMAT_VERSION
+                    and store.segmentation == segmenter.key and os.path.exists(self.index_path)):
+                index = faiss.read_index(self.index_path)
+                if index.ntotal != store.num_vectors:
+                    index = None
+            incremental = index is not None
+            self.next_vector = store.num_vectors if incremental else 0
+            deduplicator = None
+            if self.afss.dedup:
+                deduplicator = Deduplicator(self.hasher or MinHasher(MINHASH_PERM), self.afss.near_duplicate_threshold,
+                                            self.afss.near_duplicates, store if incremental else None)
+
+            processed_files = self.afss.load_processed_files(self.processed_files_path) if incremental else {}
+            json_files = self.afss.discover_json_files()
+            removed_files = set(processed_files) - set(json_files)
+            manifest = self.afss.manifest
+            parse_files = json_files
+            if incremental and manifest is not None:
+                changed = manifest.changed_files(self.index_folder, processed_files)
+                parse_files = {filename: path for filename, path in json_files.items() if filename in changed}
+                print(f"Manifest: {len(parse_files)} of {len(json_files)} files new or changed")
+
+            if incremental and not parse_files and not removed_files:
+                # Nothing to add or tombstone: the corpus, shards and knn.index are left as they are, so a
+                # no-op build copies nothing and keeps the index version search caches are keyed by
+                del cache, shards, store, deduplicator
+                stale_files = set()
+                print(f"No new, changed or removed pages: {self.index_path} is up to date")
+            else:
+                if incremental:
+                    corpus_writer = CorpusWriter(self.corpus_path, base=store, segmentation=segmenter.key)
+                    self.dtype = shards.dtype
+                    shard_writer = ShardWriter(self.shard_folder, self.shard_rows, shards.dtype)
+                else:
+                    corpus_writer = CorpusWriter(self.corpus_path, segmentation=segmenter.key)
+                    shard_writer = ShardWriter(f"{self.shard_folder}.tmp", self.shard_rows, self.afss.embedding_dtype)
+
+                # Worker processes load the model by name, so a preloaded model instance is encoded in-process
+                self.use_workers = self.embed_workers > 1 and self.afss.sentence_model_path is not None
+
+                stop = threading.Event()
+                parsed_queue = queue.Queue(maxsize=self.queue_size * 4)
+                segmented_queue = queue.Queue(maxsize=self.queue_size * 4)
+                chunk_queue = queue.Queue(maxsize=self.queue_size)
+                start_stage(self.parse_files(parse_files, processed_files), parsed_queue, stop)
+                start_stage(segmenter.segment_stream(drain(parsed_queue)), segmented_queue, stop)
+                start_stage(self.chunk_sentences(drain(segmented_queue)), chunk_queue, stop)
+
+                max_in_flight = max(2, 2 * (self.embed_workers if self.use_workers else 1))
+                pending = collections.deque()
+                try:
+                    for chunk in drain(chunk_queue):
+                        pending.append(self.start_embedding(chunk, cache, deduplicator))
+                        while len(pending) >= max_in_flight:
+                            self.write_chunk(pending.popleft(), corpus_writer, shard_writer, index, processed_files)
+                    while pending:
+                        self.write_chunk(pending.popleft(), corpus_writer, shard_writer, index, processed_files)
+                finally:
+                    stop.set()
+                    if self.executor is not None:
+                        self.executor.shutdown(cancel_futures=True)
+                        self.executor = None
+                del cache, shards, store, deduplicator
+
+                stale_files = set(self.changed_files) | removed_files
+                corpus_writer.tombstone_files(stale_files)
+                for filename in removed_files:
+                    del processed_files[filename]
+
+                shard_writer.commit()
+                if incremental:
+                    # Tombstones live in the corpus; knn.index only changes when vectors were added
+                    if self.stats['vectors']:
+                        faiss.write_index(index, f"{self.index_path}.tmp")
+                        os.replace(f"{self.index_path}.tmp", self.index_path)
+                    corpus_writer.close()
+                    print(f"Appended {self.stats['vectors']} vectors to {self.index_path}")
+                    store = CorpusStore(self.corpus_path)
+                    if len(store) and max(store.num_deleted / len(store),
+                                          store.num_dead_vectors / max(store.num_vectors, 1)) > self.afss.compact_threshold:
+                        self.compact(store)
+                else:
+                    swap_folder(f"{self.shard_folder}.tmp", self.shard_folder)
+                    corpus_writer.close()
+                    self.afss.build_autofaiss_index()
+            self.afss.save_processed_files(processed_files, self.processed_files_path)
+            if manifest is not None:
+                ingested = {filename: processed_files[filename] for filename in parse_files if filename in processed_files}
+                manifest.record_ingested(self.index_folder, processed_files, ingested, removed_files,
+                                         f"{self.afss.sentence_model_name}:{segmenter.key}", replace=not incremental)
+            if segmenter.cache is not None:
+                # Segmentations of pages that changed or disappeared are never read again
+                segmenter.cache.prune(processed_files.values())
+
+            elapsed = max(time.perf_counter() - start_time, 1e-9)
+            self.afss.encode_stats = {
+                'sentences': self.stats['rows'],
+                'encoded': self.stats['encoded'],
+                'reused': self.stats['reused'],
+                'vectors': self.stats['vectors'],
+                'exact_duplicates': self.stats['exact_duplicates'],
+                'near_duplicates': self.stats['near_duplicates'],
+                'seconds': elapsed,
+                'sentences_per_sec': self.stats['rows'] / elapsed,
+                'batch_size': self.afss.batch_size,
+                'dtype': self.afss.embedding_dtype
+            }
+            print(f"{self.stats['rows']} sentences from {self.stats['files']} files in {elapsed:.2f}s "
+                  f"({self.stats['rows'] / elapsed:.1f} sentences/sec): {self.stats['encoded']} encoded, "
+                  f"{self.stats['reused']} reused, {len(stale_files)} files tombstoned")
+            if segmenter.mode != 'none':
+                print(f"Segmentation ({segmenter.key}): {segmenter.stats['paragraphs']} paragraphs into "
+                      f"{segmenter.stats['sentences']} sentences, {segmenter.stats['segmented_pages']} pages segmented, "
+                      f"{segmenter.stats['cached_pages']} from cache")
+            duplicates = self.stats['exact_duplicates'] + self.stats['near_duplicates']
+            if duplicates:
+                saved_bytes = duplicates * self.afss.sentence_model.get_sentence_embedding_dimension() * np.dtype(self.afss.embedding_dtype).itemsize
+                print(f"Deduplication: {self.stats['exact_duplicates']} exact and {self.stats['near_duplicates']} near duplicates "
+                      f"share existing vectors ({self.stats['rows']} rows, {self.stats['vectors']} new vectors), saving "
+                      f"{duplicates} encodes and {saved_bytes / 1e6:.1f} MB of embeddings and index vectors")
+            span.set(incremental=incremental, **self.stats)
+            return self.stats
+
+    def compact(self, store):
+        """Drops tombstoned rows and vectors no live row uses, and rebuilds the faiss index without re-encoding."""
+        with tracer.span('build.compact', rows=store.num_deleted, vectors=store.num_dead_vectors):
+            print(f"Compacting index: dropping {store.num_deleted} tombstoned rows and {store.num_dead_vectors} unused vectors")
+            shards = EmbeddingShards(self.shard_folder)
+            corpus_writer = CorpusWriter(self.corpus_path, segmentation=store.segmentation)
+            shard_writer = ShardWriter(f"{self.shard_folder}.tmp", self.shard_rows, shards.dtype)
+
+            live_vectors = np.flatnonzero(np.asarray(store.index_rows) >= 0)
+            new_vector_ids = np.full(store.num_vectors, -1, dtype=np.int64)
+            new_vector_ids[live_vectors] = np.arange(len(live_vectors))
+            for start in range(0, len(live_vectors), self.chunk_rows):
+                vector_ids = live_vectors[start:start + self.chunk_rows]
+                shard_writer.append(shards.take(vector_ids))
+                corpus_writer.add_vectors(store.minhash[vector_ids])
+
+            for start in range(0, len(store), self.chunk_rows):
+                end = min(start + self.chunk_rows, len(store))
+                keep = np.flatnonzero(~np.asarray(store.deleted[start:end]))
+                if not len(keep):
+                    continue
+                rows = start + keep
+                texts = store.text[start:end]
+                corpus_writer.append([store.filenames[file_id] for file_id in store.file_ids[rows]],
+                                     store.positions[rows], [texts[row] for row in keep], store.text_hashes[rows],
+                                     new_vector_ids[store.vector_ids[rows]])
+            del shards
+            shard_writer.commit()
+            swap_folder(f"{self.shard_folder}.tmp", self.shard_folder)
+            corpus_writer.close()
+            self.afss.build_autofaiss_index()
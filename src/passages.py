@@ -0,0 +1,85 @@
+class Passage:
+    """A run of rows [start, end) of one file holding hits, (rank, row) pairs; best is the rank of its best hit."""
+
+    def __init__(self, start, end, hits):
+        self.start = start
+        self.end = end
+        self.hits = hits
+
+    @property
+    def best(self):
+        return min(rank for rank, _ in self.hits)
+
+    @property
+    def best_row(self):
+        return min(self.hits)[1]
+
+    @property
+    def hit_rows(self):
+        return sorted(row for _, row in self.hits)
+
+def merge_windows(windows, row_tokens=None, max_tokens=None):
+    """
+    Merges context windows that overlap or touch within the same file into passages.
+
+    Args:
+    windows (list): (rank, block, start, end, row) per hit, where [start, end) is the context window
+        of row within file block.
+    row_tokens (callable): Maps (start, end) to the token count of rows start to end; needed with max_tokens.
+    max_tokens (int): Windows are only merged while the passage stays within this many tokens. Past
+        it, the next passage starts where the current one ends, so no row appears twice. A passage
+        still over the budget is cut to the rows nearest its best hit, and hits cut off move to
+        passages of their own.
+
+    Returns:
+    list: Passages ordered by their best hit's rank.
+    """
+    passages = []
+    current, current_block = None, None
+    for rank, block, start, end, row in sorted(windows, key=lambda window: (window[1], window[2], window[0])):
+        if current_block == block and start <= current.end:
+            end = max(end, current.end)
+            if max_tokens is None or row_tokens(current.start, end) <= max_tokens:
+                current.end = end
+            elif row < current.end:
+                # The hit is already in the passage; extend it only as far as the budget allows
+                while current.end < end and row_tokens(current.start, current.end + 1) <= max_tokens:
+                    current.end += 1
+            else:
+                passages.append(current)
+                current = Passage(current.end, end, [(rank, row)])
+                continue
+            current.hits.append((rank, row))
+        else:
+            if current is not None:
+                passages.append(current)
+            current = Passage(start, end, [(rank, row)])
+            current_block = block
+    if current is not None:
+        passages.append(current)
+
+    if max_tokens is not None:
+        passages = [piece for passage in passages for piece in fit(passage, row_tokens, max_tokens)]
+    passages.sort(key=lambda passage: passage.best)
+    return passages
+
+def fit(passage, row_tokens, max_tokens):
+    """
+    Cuts rows from whichever end of passage is farther from its best hit until it fits max_tokens.
+    Returns it followed by passages, fitted the same way, for the hits cut off on either side.
+    """
+    start, end, best_row = passage.start, passage.end, passage.best_row
+    while passage.end - passage.start > 1 and row_tokens(passage.start, passage.end) > max_tokens:
+        if passage.end - 1 - best_row >= best_row - passage.start:
+            passage.end -= 1
+        else:
+            passage.start += 1
+    before = [hit for hit in passage.hits if hit[1] < passage.start]
+    after = [hit for hit in passage.hits if hit[1] >= passage.end]
+    passage.hits = [hit for hit in passage.hits if passage.start <= hit[1] < passage.end]
+    pieces = [passage]
+    if before:
+        pieces.extend(fit(Passage(start, passage.start, before), row_tokens, max_tokens))
+    if after:
+        pieces.extend(fit(Passage(passage.end, end, after), row_tokens, max_tokens))
+    return pieces
@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from corpus_store import CORPUS_FOLDER
+from tracing import tracer
+
+QUERY_CACHE_FILE = 'query_cache.sqlite3'
+# The corpus meta carries a build counter and is read by content; knn.index is only rewritten when vectors
+# change and dataframe.pkl is the legacy corpus, so their sizes and modification times are enough
+CONTENT_VERSION_FILES = (os.path.join(CORPUS_FOLDER, 'meta.json'),)
+VERSION_FILES = ('knn.index', 'dataframe.pkl')
+
+def normalize_query(query):
+    """Collapses whitespace: queries that differ only in spacing share cache entries."""
+    return ' '.join(query.split())
+
+def index_version(index_folder):
+    """Returns a fingerprint of the index and corpus in index_folder that changes whenever a build commits new ones."""
+    parts = []
+    for name in CONTENT_VERSION_FILES:
+        try:
+            with open(os.path.join(index_folder, name), 'rb') as file:
+                parts.append(f"{name}:{hashlib.md5(file.read()).hexdigest()}")
+        except OSError:
+            continue
+    for name in VERSION_FILES:
+        try:
+            stat = os.stat(os.path.join(index_folder, name))
+        except OSError:
+            continue
+        parts.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.md5('\n'.join(parts).encode()).hexdigest()[:16]
+
+class MemoryStore:
+    """Thread-safe LRU of values that expire ttl seconds after they were stored (never with ttl=None)."""
+
+    def __init__(self, max_entries=10000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, expires=None):
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class DiskStore:
+    """
+    LRU/TTL store in an SQLite table, shared by every process that opens the same file. Values are
+    pickled; entries past max_entries (least recently used first) and expired ones are trimmed
+    every trim_every puts.
+    """
+
+    def __init__(self, path, table, max_entries=100000, trim_every=256):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.trim_every = trim_every
+        self.puts = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} '
+                                '(key TEXT PRIMARY KEY, value BLOB, expires REAL, used REAL)')
+        self.connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_used ON {table} (used)')
+
+    def get(self, key):
+        """Returns (value, expires) or None."""
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(f'SELECT value, expires FROM {self.table} WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] < now:
+                self.connection.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                return None
+            self.connection.execute(f'UPDATE {self.table} SET used = ? WHERE key = ?', (now, key))
+        return pickle.loads(row[0]), row[1]
+
+    def put(self, key, value, expires=None):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.connection.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)', (key, blob, expires, time.time()))
+            self.puts += 1
+            if self.puts % self.trim_every == 0:
+                self.trim()
+
+    def trim(self):
+        self.connection.execute(f'DELETE FROM {self.table} WHERE expires < ?', (time.time(),))
+        self.connection.execute(f'DELETE FROM {self.table} WHERE key IN '
+                                f'(SELECT key FROM {self.table} ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute(f'DELETE FROM {self.table}')
+
+class CacheLevel:
+    """An in-memory LRU in front of an optional DiskStore; disk hits are copied into memory."""
+
+    def __init__(self, name, max_entries, ttl, path=None):
+        self.name = name
+        self.ttl = ttl or None
+        self.memory = MemoryStore(max_entries, self.ttl)
+        self.disk = DiskStore(path, name, max_entries=max_entries * 10) if path else None
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                value, expires = entry
+                self.memory.put(key, value, expires)
+        tracer.count(f"cache.{self.name}_{'hits' if value is not None else 'misses'}")
+        return value
+
+    def put(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        self.memory.put(key, value, expires)
+        if self.disk is not None:
+            self.disk.put(key, value, expires)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+class QueryCache:
+    """
+    Two-level cache for the search path.
+
+    The embedding level maps (model, normalized preprocessed query) to its query vector, so repeated
+    queries skip preprocessing and encoding. The results level maps (index version, model, query,
+    top_k, context_size, rerank, filter) to final results. The index version is a fingerprint of the loaded
+    index and corpus files, so results of an index that a build has since replaced are never
+    returned. Both levels are LRUs of max_entries with entries expiring after ttl seconds
+    (never with ttl=None). With folder set, both are also stored in an SQLite file shared by every
+    search process using that folder.
+    """
+
+    def __init__(self, max_entries=10000, ttl=None, folder=None):
+        path = os.path.join(folder, QUERY_CACHE_FILE) if folder else None
+        self.embeddings = CacheLevel('embedding', max_entries, ttl, path)
+        self.results = CacheLevel('result', max_entries, ttl, path)
+
+    @staticmethod
+    def results_key(version, model_name, query, top_k, context_size, rerank=False, search_filter=None, passages=None):
+        """
+        model_name names the query encoder with its backend, as in encode(); results of the same index
+        searched with int8 and torch query vectors can differ. rerank is False, or the number of
+        first-stage candidates the cross-encoder reranked; passages is None for sentence results, else
+        the passage token budget (0 for none).
+        """
+        filter_key = [sorted(values) if values is not None else None for values in search_filter.key] if search_filter else None
+        key = json.dumps([version, model_name, normalize_query(query), top_k, context_size, int(rerank), filter_key, passages])
+        return hashlib.md5(key.encode()).hexdigest()
+
+    def encode(self, model_name, preprocessed_queries, encode):
+        """
+        Returns the (Q, d) float32 embeddings of preprocessed_queries, calling encode(queries) once
+        for the distinct queries not in the cache.
+        """
+        keys = [hashlib.md5(f"{model_name}\0{normalize_query(query)}".encode()).hexdigest() for query in preprocessed_queries]
+        vectors = [self.embeddings.get(key) for key in keys]
+        misses = list(OrderedDict.fromkeys(query for query, vector in zip(preprocessed_queries, vectors) if vector is None))
+        if misses:
+            encoded = dict(zip(misses, encode(misses)))
+            for i, (key, query) in enumerate(zip(keys, preprocessed_queries)):
+                if vectors[i] is None:
+                    vectors[i] = encoded[query]
+                    self.embeddings.put(key, vectors[i])
+        return np.ascontiguousarray(np.stack(vectors), dtype='float32')
+
+    def search_batch(self, version, model_name, queries, top_k, context_size, search, search_filter=None, passages=None):
+        """Returns one result list per query, calling search(queries) once for the distinct queries not in the cache."""
+        keys = [self.results_key(version, model_name, query, top_k, context_size, search_filter=search_filter, passages=passages)
+                for query in queries]
+        batch_results = [self.results.get(key) for key in keys]
+        misses = list(OrderedDict.fromkeys(query for query, results in zip(queries, batch_results) if results is None))
+        if misses:
+            searched = dict(zip(misses, search(misses)))
+            for i, (key, query) in enumerate(zip(keys, queries)):
+                if batch_results[i] is None:
+                    batch_results[i] = searched[query]
+                    self.results.put(key, batch_results[i])
+        return batch_results
+
+    def clear(self):
+        self.embeddings.clear()
+        self.results.clear()
+
+def configure_query_cache(section):
+    """Returns the QueryCache set up by the query_cache_* keys of a config section, or None when disabled."""
+    max_entries = section.getint('query_cache_entries', 10000)
+    if max_entries <= 0:
+        return None
+    return QueryCache(max_entries, section.getfloat('query_cache_ttl', 0) or None, section.get('query_cache_folder', '') or None)
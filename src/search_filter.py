@@ -0,0 +1,85 @@
+import faiss
+import numpy as np
+
+class SearchFilter:
+    """
+    Restricts a search to pages of the given sources ('wikipedia', 'bing_search'), Bing query
+    hashes (the directory names under rag_database/bing_search) and/or files (paths relative to
+    rag_database, e.g. 'wikipedia/<hash>.json'). A page must match every argument that is given.
+    """
+
+    def __init__(self, sources=None, query_hashes=None, files=None):
+        self.sources = frozenset(sources) if sources else None
+        self.query_hashes = frozenset(query_hashes) if query_hashes else None
+        self.files = frozenset(files) if files else None
+
+    @property
+    def key(self):
+        return (self.sources, self.query_hashes, self.files)
+
+    def __bool__(self):
+        return any(value is not None for value in self.key)
+
+    def matches(self, filename):
+        parts = filename.split('/')
+        if self.sources is not None and parts[0] not in self.sources:
+            return False
+        if self.query_hashes is not None and (parts[0] != 'bing_search' or parts[1] not in self.query_hashes):
+            return False
+        return self.files is None or filename in self.files
+
+class FilterSelection:
+    """
+    The vectors a SearchFilter leaves eligible in one index, as a faiss IDSelectorBitmap over vector
+    ids. rows[i] is the first matching live row carrying vectors[i], so a hit resolves to a row of
+    a matching page even when a duplicate of its text lives in another page.
+    """
+
+    def __init__(self, vectors, rows, ntotal):
+        self.vectors = vectors
+        self.rows = rows
+        bits = np.zeros(ntotal, dtype=bool)
+        bits[vectors] = True
+        # The selector reads this buffer; it has to live as long as the selection
+        self.bitmap = np.packbits(bits, bitorder='little')
+        self.selector = faiss.IDSelectorBitmap(ntotal, faiss.swig_ptr(self.bitmap))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def rows_of(self, ids):
+        """Maps faiss result ids (all eligible, -1 for none) to corpus rows, -1 for none."""
+        positions = np.minimum(np.searchsorted(self.vectors, np.maximum(ids, 0)), len(self.vectors) - 1)
+        return np.where(ids >= 0, self.rows[positions], -1)
+
+def select_vectors(search_filter, filenames, file_ranges, file_ids, deleted, vector_ids, ntotal):
+    """Compiles search_filter against a corpus using its per-file live row ranges."""
+    file_ranges = np.asarray(file_ranges, dtype=np.int64).reshape(-1, 2)
+    candidates = np.flatnonzero(file_ranges[:, 1] > file_ranges[:, 0])
+    matching = np.array([file_id for file_id in candidates.tolist() if search_filter.matches(filenames[file_id])], dtype=np.int64)
+    if not len(matching):
+        return FilterSelection(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), ntotal)
+    matching = matching[np.argsort(file_ranges[matching, 0])]
+    starts, ends = file_ranges[matching, 0], file_ranges[matching, 1]
+    rows = np.concatenate([np.arange(start, end) for start, end in zip(starts.tolist(), ends.tolist())])
+    expected_files = np.repeat(matching, ends - starts)
+    rows = rows[(np.asarray(file_ids[rows]) == expected_files) & ~np.asarray(deleted[rows], dtype=bool)]
+    vectors, first = np.unique(np.asarray(vector_ids[rows], dtype=np.int64), return_index=True)
+    return FilterSelection(vectors, rows[first], ntotal)
+
+def filtered_search_params(index, selector):
+    """Search parameters that restrict index to selector, keeping the index's own nprobe / efSearch."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        params = faiss.SearchParametersPreTransform()
+        index_params = filtered_search_params(index.index, selector)
+        params.index_params = index_params
+        params.sel = selector
+        # SWIG does not keep the nested parameters alive on its own
+        params.referenced_objects = [index_params]
+        return params
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe, max_codes=index.max_codes)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
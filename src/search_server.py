@@ -0,0 +1,258 @@
+import asyncio
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+from CrossEncoderSearch import CROSS_ENCODER_MODEL, CrossencoderSearch, dict_to_list, get_cross_encoder
+from encoders import load_sentence_model
+from query_cache import QueryCache, configure_query_cache
+from search_filter import SearchFilter
+from sharded_index import open_search
+from tracing import configure_tracing, tracer
+
+class FilterFields(BaseModel):
+    # Restrict results to these sources, Bing query hashes and/or files (paths relative to rag_database)
+    sources: Optional[List[str]] = None
+    query_hashes: Optional[List[str]] = None
+    files: Optional[List[str]] = None
+
+    def search_filter(self):
+        return SearchFilter(self.sources, self.query_hashes, self.files)
+
+class PassageFields(FilterFields):
+    # Merge overlapping context windows of one file into passages, of at most max_passage_tokens tokens
+    passages: bool = False
+    max_passage_tokens: Optional[int] = None
+
+class SearchRequest(PassageFields):
+    query: str
+    top_k: int = 5
+    context_size: int = 3
+    rerank: bool = False
+    rerank_candidates: int = 100
+
+class SearchBatchRequest(PassageFields):
+    queries: List[str]
+    top_k: int = 5
+    context_size: int = 3
+
+class RerankRequest(BaseModel):
+    query: str
+    passages: List[str]
+    top_n: Optional[int] = None
+
+class ReloadRequest(BaseModel):
+    index_folder: Optional[str] = None
+
+class SearchService:
+    """
+    Keeps the sentence encoder, faiss index, corpus and cross-encoder in memory between requests.
+
+    Concurrent search requests are queued and drained in micro-batches: the first request opens a
+    window of batch_window_ms, everything that arrives within it (up to max_batch_size) is searched
+    with one search_sentences_batch call.
+    """
+
+    def __init__(self, sentence_model, index_folder, max_index_memory_usage='10MB',
+                 cross_encoder_model=CROSS_ENCODER_MODEL, cross_encoder_max_length=512, batch_window_ms=5, max_batch_size=64,
+                 index_load_mode='memory', search_params=None, query_cache=None, encoder_backend='torch', encoder_threads=None):
+        self.max_index_memory_usage = max_index_memory_usage
+        self.index_load_mode = index_load_mode
+        self.search_params = search_params
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+        # Both models run with encoder_backend, e.g. 'int8' for quantized CPU inference
+        self.encoder_backend = encoder_backend
+        self.sentence_model = load_sentence_model(sentence_model, encoder_backend, encoder_threads)
+        self.cross_encoder_model = cross_encoder_model
+        self.cross_encoder_max_length = cross_encoder_max_length
+        self.cross_encoder = get_cross_encoder(cross_encoder_model, cross_encoder_max_length, encoder_backend, encoder_threads)
+        self.index_folder = index_folder
+        # Outlives reloads: results are keyed by index version, query embeddings stay valid
+        self.query_cache = query_cache
+        self.afss = self.load_search(index_folder)
+
+        # Searches run on one thread so batches never contend for the index; reranks get their own
+        self.search_executor = ThreadPoolExecutor(max_workers=1)
+        self.rerank_executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.batch_task = None
+
+    def load_search(self, index_folder):
+        return open_search(self.sentence_model, index_folder, self.max_index_memory_usage, self.index_load_mode, self.search_params,
+                           self.query_cache, self.encoder_backend)
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.batch_task = asyncio.create_task(self.batch_loop())
+
+    async def stop(self):
+        if self.batch_task is not None:
+            self.batch_task.cancel()
+        self.search_executor.shutdown(wait=False)
+        self.rerank_executor.shutdown(wait=False)
+
+    async def search(self, query, top_k=5, context_size=3, search_filter=None, passages=False, max_passage_tokens=None):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, top_k, context_size, search_filter or SearchFilter(), (passages, max_passage_tokens), future))
+        return await future
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.run_batch(batch)
+
+    async def run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        afss = self.afss
+        groups = {}
+        filters = {}
+        for query, top_k, context_size, search_filter, passage_mode, future in batch:
+            # Queries with the same filter share its compiled selection and one faiss search
+            filters[search_filter.key] = search_filter
+            groups.setdefault((top_k, context_size, search_filter.key, passage_mode), []).append((query, future))
+
+        tracer.count('server.batches')
+        tracer.count('server.batched_queries', len(batch))
+        for (top_k, context_size, filter_key, passage_mode), requests in groups.items():
+            queries = [query for query, _ in requests]
+            try:
+                batch_results = await loop.run_in_executor(self.search_executor, afss.search_sentences_batch,
+                                                           queries, top_k, context_size, filters[filter_key], *passage_mode)
+            except Exception as e:
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), results in zip(requests, batch_results):
+                if not future.done():
+                    future.set_result(results)
+
+    async def search_batch(self, queries, top_k=5, context_size=3, search_filter=None, passages=False, max_passage_tokens=None):
+        # Callers that already hold a batch skip the queue
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.search_executor, self.afss.search_sentences_batch,
+                                          queries, top_k, context_size, search_filter, passages, max_passage_tokens)
+
+    async def search_reranked(self, query, top_k=5, context_size=3, rerank_candidates=100, search_filter=None, passages=False,
+                              max_passage_tokens=None):
+        """
+        Reranks a deeper first-stage candidate list down to top_k, caching the reranked results. With
+        passages, overlapping candidate windows are merged first, so each stretch of text is scored once.
+        """
+        candidates = max(top_k, rerank_candidates)
+        afss = self.afss
+        key = None
+        if self.query_cache is not None:
+            key = QueryCache.results_key(afss.index_version, afss.sentence_model_name, query, top_k, context_size, candidates,
+                                         search_filter, (max_passage_tokens or 0) if passages else None)
+            cached = self.query_cache.results.get(key)
+            if cached is not None:
+                return cached
+        results = await self.search(query, candidates, context_size, search_filter, passages, max_passage_tokens)
+        reranked = await self.rerank(query, dict_to_list(results), top_k)
+        if key is not None:
+            self.query_cache.results.put(key, reranked)
+        return reranked
+
+    async def rerank(self, query, passages, top_n=None):
+        def run():
+            ce = CrossencoderSearch(query, passages, cross_encoding_model=self.cross_encoder,
+                                    model_name=self.cross_encoder_model, max_length=self.cross_encoder_max_length,
+                                    backend=self.encoder_backend)
+            return [[pair_query, passage, float(score)] for pair_query, passage, score in ce.run_cross_encoder(top_n)]
+        return await asyncio.get_running_loop().run_in_executor(self.rerank_executor, run)
+
+    async def reload(self, index_folder=None):
+        """Loads an index folder next to the live one and swaps it in; searches keep running meanwhile."""
+        index_folder = index_folder or self.index_folder
+        afss = await asyncio.get_running_loop().run_in_executor(None, self.load_search, index_folder)
+        self.afss = afss
+        self.index_folder = index_folder
+        return afss.index_stats()
+
+def create_app(service):
+    @asynccontextmanager
+    async def lifespan(app):
+        await service.start()
+        yield
+        await service.stop()
+
+    app = FastAPI(title="MIRAGE search", lifespan=lifespan)
+
+    @app.get("/health")
+    async def health():
+        stats = service.afss.index_stats()
+        return {'status': 'ok', 'index_folder': stats['index_folder'], 'vectors': stats['vectors']}
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics():
+        # Stage timings and counters in the Prometheus text format; empty unless tracing is on
+        return tracer.prometheus_text()
+
+    @app.post("/search")
+    async def search(request: SearchRequest):
+        if request.rerank:
+            return await service.search_reranked(request.query, request.top_k, request.context_size, request.rerank_candidates,
+                                                 request.search_filter(), request.passages, request.max_passage_tokens)
+        return await service.search(request.query, request.top_k, request.context_size, request.search_filter(),
+                                    request.passages, request.max_passage_tokens)
+
+    @app.post("/search_batch")
+    async def search_batch(request: SearchBatchRequest):
+        return await service.search_batch(request.queries, request.top_k, request.context_size, request.search_filter(),
+                                          request.passages, request.max_passage_tokens)
+
+    @app.post("/rerank")
+    async def rerank(request: RerankRequest):
+        return await service.rerank(request.query, request.passages, request.top_n)
+
+    @app.post("/reload")
+    async def reload(request: ReloadRequest):
+        return await service.reload(request.index_folder)
+
+    return app
+
+if __name__ == "__main__":
+
+    # Read configuration
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    model = config['DEFAULT']['model']
+    index_folder = config['DEFAULT']['index_folder']
+    max_index_memory_usage = config['DEFAULT'].get('max_index_memory_usage', '10MB')
+    host = config['DEFAULT'].get('server_host', '127.0.0.1')
+    port = config['DEFAULT'].getint('server_port', 8000)
+    batch_window_ms = config['DEFAULT'].getfloat('batch_window_ms', 5)
+    max_batch_size = config['DEFAULT'].getint('max_batch_size', 64)
+    cross_encoder_max_length = config['DEFAULT'].getint('cross_encoder_max_length', 512)
+    # Server workers started with mmap share the index pages instead of each holding a copy
+    index_load_mode = config['DEFAULT'].get('index_load_mode', 'memory')
+    search_params = config['DEFAULT'].get('search_params', '')
+    encoder_backend = config['DEFAULT'].get('encoder_backend', 'torch')
+    encoder_threads = config['DEFAULT'].getint('encoder_threads', 0) or None
+    configure_tracing(config['DEFAULT'])
+    query_cache = configure_query_cache(config['DEFAULT'])
+
+    service = SearchService(model, index_folder, max_index_memory_usage, cross_encoder_max_length=cross_encoder_max_length,
+                            batch_window_ms=batch_window_ms, max_batch_size=max_batch_size,
+                            index_load_mode=index_load_mode, search_params=search_params, query_cache=query_cache,
+                            encoder_backend=encoder_backend, encoder_threads=encoder_threads)
+    uvicorn.run(create_app(service), host=host, port=port)
@@ -1,31 +1,119 @@
-from autofaiss_index import AutoFaissSentenceSearch
 from CrossEncoderSearch import CrossencoderSearch, dict_to_list
+from query_cache import QueryCache, configure_query_cache
+from search_filter import SearchFilter
+from sharded_index import open_search
+from tracing import chrome_trace, configure_tracing
+from contextlib import nullcontext
 import configparser
 
-def load_index_and_search(query, sentence_model,index_folder,max_index_memory_usage):
-    afss = AutoFaissSentenceSearch(sentence_model=sentence_model, index_folder=index_folder, max_index_memory_usage=max_index_memory_usage)
-    afss.load_index()
-    afss.load_dataframe() 
-    search_results = afss.search_sentences(query)
+def load_search(sentence_model, index_folder, max_index_memory_usage, index_load_mode='memory', search_params=None, query_cache=None,
+                encoder_backend='torch', encoder_threads=None):
+    # Sharded index folders are searched across all of their shards
+    return open_search(sentence_model, index_folder, max_index_memory_usage, index_load_mode, search_params, query_cache,
+                       encoder_backend, encoder_threads)
+
+def load_index_and_search(query, sentence_model,index_folder,max_index_memory_usage,top_k=5,index_load_mode='memory',search_params=None,
+                          search_filter=None, query_cache=None, passages=False, max_passage_tokens=None, encoder_backend='torch',
+                          encoder_threads=None):
+    afss = load_search(sentence_model, index_folder, max_index_memory_usage, index_load_mode, search_params, query_cache,
+                       encoder_backend, encoder_threads)
+    search_results = afss.search_sentences(query, top_k=top_k, search_filter=search_filter, passages=passages,
+                                           max_passage_tokens=max_passage_tokens)
     return search_results
 
+def read_queries(queries_file):
+    with open(queries_file, 'r', encoding='utf-8') as file:
+        return [line.strip() for line in file if line.strip()]
+
+def load_index_and_search_batch(queries, sentence_model, index_folder, max_index_memory_usage, top_k=5, index_load_mode='memory',
+                                search_params=None, search_filter=None, query_cache=None, passages=False, max_passage_tokens=None,
+                                encoder_backend='torch', encoder_threads=None):
+    afss = load_search(sentence_model, index_folder, max_index_memory_usage, index_load_mode, search_params, query_cache,
+                       encoder_backend, encoder_threads)
+    return afss.search_sentences_batch(queries, top_k=top_k, search_filter=search_filter, passages=passages,
+                                       max_passage_tokens=max_passage_tokens)
+
+def rerank_search_batch(queries, afss, top_k=5, rerank_candidates=100, context_size=3, search_filter=None, query_cache=None, passages=False,
+                        max_passage_tokens=None, cross_encoder_max_length=512, encoder_backend='torch', encoder_threads=None):
+    """
+    Searches rerank_candidates first-stage results per query and reranks them down to top_k with the
+    cross-encoder. With a query cache, reranked results are cached under the same keys as the
+    search server's, so queries already reranked skip both stages.
+
+    Returns:
+    list: One list of [query, doc_text, score] triples per query.
+    """
+    candidates = max(top_k, rerank_candidates)
+    keys = [None] * len(queries)
+    batch_results = [None] * len(queries)
+    if query_cache is not None:
+        keys = [QueryCache.results_key(afss.index_version, afss.sentence_model_name, query, top_k, context_size, candidates,
+                                       search_filter, (max_passage_tokens or 0) if passages else None) for query in queries]
+        batch_results = [query_cache.results.get(key) for key in keys]
+    misses = [i for i, results in enumerate(batch_results) if results is None]
+    if misses:
+        searched = afss.search_sentences_batch([queries[i] for i in misses], top_k=candidates, context_size=context_size,
+                                               search_filter=search_filter, passages=passages, max_passage_tokens=max_passage_tokens)
+        for i, results in zip(misses, searched):
+            ce = CrossencoderSearch(queries[i], dict_to_list(results), max_length=cross_encoder_max_length,
+                                    backend=encoder_backend, threads=encoder_threads)
+            batch_results[i] = [[pair_query, passage, float(score)] for pair_query, passage, score in ce.run_cross_encoder(top_n=top_k)]
+            if keys[i] is not None:
+                query_cache.results.put(keys[i], batch_results[i])
+    return batch_results
+
 if __name__ == "__main__":
 
     # Read configuration
     config = configparser.ConfigParser()
     config.read('config.txt')
-    
+
     query = config['DEFAULT']['query']
     model = config['DEFAULT']['model']
     index_folder = config['DEFAULT']['index_folder']
     max_index_memory_usage = config['DEFAULT'].get('max_index_memory_usage', '10MB')
-    
-    results = load_index_and_search(query, model, index_folder, max_index_memory_usage)
-    input=dict_to_list(results)
-
-    if(config['DEFAULT']['cross_encoder_rerank']):
-        ce = CrossencoderSearch(query,input)
-        outputs = ce.run_cross_encoder()
-        print(outputs)
-    else:
-        print(results)
+    queries_file = config['DEFAULT'].get('queries_file', '')
+    cross_encoder_rerank = config['DEFAULT'].getboolean('cross_encoder_rerank', False)
+    top_k = config['DEFAULT'].getint('top_k', 5)
+    rerank_candidates = config['DEFAULT'].getint('rerank_candidates', 100)
+    cross_encoder_max_length = config['DEFAULT'].getint('cross_encoder_max_length', 512)
+    index_load_mode = config['DEFAULT'].get('index_load_mode', 'memory')
+    search_params = config['DEFAULT'].get('search_params', '')
+    chrome_trace_file = config['DEFAULT'].get('chrome_trace', '')
+    # 'int8' runs the sentence model and cross-encoder with int8-quantized weights on CPU; 0 threads keeps torch's default
+    encoder_backend = config['DEFAULT'].get('encoder_backend', 'torch')
+    encoder_threads = config['DEFAULT'].getint('encoder_threads', 0) or None
+    # Overlapping context windows of one file become one passage, so the cross-encoder scores each stretch of text once
+    merge_passages = config['DEFAULT'].getboolean('merge_passages', False)
+    max_passage_tokens = config['DEFAULT'].getint('max_passage_tokens', 0) or None
+    # Comma separated; results come only from pages matching every list that is set
+    search_filter = SearchFilter(*[[value.strip() for value in config['DEFAULT'].get(key, '').split(',') if value.strip()]
+                                   for key in ('filter_sources', 'filter_query_hashes', 'filter_files')])
+    configure_tracing(config['DEFAULT'])
+    # Only worth it across runs with query_cache_folder set: this process searches each query once
+    query_cache = configure_query_cache(config['DEFAULT'])
+
+    # chrome_trace records every stage of this run, from loading the index to reranking, as one timeline
+    with chrome_trace(chrome_trace_file) if chrome_trace_file else nullcontext():
+        # One query per line in queries_file runs them all as a single batch
+        queries = read_queries(queries_file) if queries_file else [query]
+        if cross_encoder_rerank:
+            # A deeper first-stage candidate list is cut down to top_k by the cross-encoder
+            afss = load_search(model, index_folder, max_index_memory_usage, index_load_mode, search_params, query_cache,
+                               encoder_backend, encoder_threads)
+            batch_results = rerank_search_batch(queries, afss, top_k, rerank_candidates, search_filter=search_filter,
+                                                query_cache=query_cache, passages=merge_passages,
+                                                max_passage_tokens=max_passage_tokens,
+                                                cross_encoder_max_length=cross_encoder_max_length,
+                                                encoder_backend=encoder_backend, encoder_threads=encoder_threads)
+        elif queries_file:
+            batch_results = load_index_and_search_batch(queries, model, index_folder, max_index_memory_usage, top_k,
+                                                        index_load_mode, search_params, search_filter, query_cache,
+                                                        merge_passages, max_passage_tokens, encoder_backend, encoder_threads)
+        else:
+            batch_results = [load_index_and_search(query, model, index_folder, max_index_memory_usage, top_k,
+                                                   index_load_mode, search_params, search_filter, query_cache,
+                                                   merge_passages, max_passage_tokens, encoder_backend, encoder_threads)]
+
+        for results in batch_results:
+            print(results)
@@ -0,0 +1,231 @@
+import os
+import re
+import json
+import importlib.util
+import collections
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+from tracing import tracer
+
+SEGMENTATION_MODES = ('spacy', 'nltk', 'rules', 'none')
+SEGMENTS_FOLDER = 'segments'
+
+# End of sentence punctuation (with closing quotes or brackets), whitespace, then the next sentence's first character
+SENTENCE_END = re.compile(r'([.!?…]+["\'”’)\]]*)\s+(?=["\'“‘(\[]?[A-Z0-9])')
+# Lowercased words a period after them usually does not end a sentence after
+ABBREVIATIONS = frozenset({
+    'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'mt', 'ft', 'gen', 'col', 'lt', 'sgt', 'capt', 'gov', 'sen',
+    'rep', 'rev', 'hon', 'vs', 'v', 'no', 'nos', 'vol', 'pp', 'p', 'fig', 'ca', 'approx', 'est', 'inc', 'ltd', 'co',
+    'corp', 'dept', 'univ', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec',
+    'e.g', 'i.e', 'u.s', 'u.k', 'u.n', 'a.m', 'p.m', 'al'
+})
+
+def split_sentences(text):
+    """
+    Rule-based sentence splitter: breaks at line ends and at ., ! or ? followed by whitespace and
+    an uppercase letter, digit or opening quote, except after common abbreviations and initials.
+    """
+    sentences = []
+    for line in text.splitlines():
+        start = 0
+        for match in SENTENCE_END.finditer(line):
+            if match.group(1).startswith('.'):
+                words = line[start:match.start(1)].split()
+                last_word = words[-1].lstrip('("\'“‘[').lower() if words else ''
+                if last_word in ABBREVIATIONS or (len(last_word) == 1 and last_word.isalpha()):
+                    continue
+            sentence = line[start:match.end(1)].strip()
+            if sentence:
+                sentences.append(sentence)
+            start = match.end()
+        sentence = line[start:].strip()
+        if sentence:
+            sentences.append(sentence)
+    return sentences
+
+def resolve_mode(mode, spacy_model='en_core_web_sm'):
+    """Returns mode if its library (and for spaCy, model package) is installed, else 'rules'."""
+    if mode not in SEGMENTATION_MODES:
+        raise ValueError(f"segmentation must be one of {SEGMENTATION_MODES}, got {mode!r}")
+    if mode == 'spacy':
+        if importlib.util.find_spec('spacy') is None or importlib.util.find_spec(spacy_model) is None:
+            print(f"spaCy or its {spacy_model} model is not installed; segmenting with the rule-based splitter")
+            return 'rules'
+    elif mode == 'nltk':
+        try:
+            import nltk
+            nltk.data.find('tokenizers/punkt')
+        except (ImportError, LookupError):
+            print("NLTK or its punkt data is not installed; segmenting with the rule-based splitter")
+            return 'rules'
+    return mode
+
+def load_splitter(mode, spacy_model='en_core_web_sm', batch_size=64):
+    """Returns a function mapping a list of paragraphs to one list of sentences per paragraph."""
+    if mode == 'spacy':
+        import spacy
+        # Only sentence boundaries are needed: the statistical senter is far cheaper than the parser
+        nlp = spacy.load(spacy_model, exclude=['parser', 'ner', 'lemmatizer', 'attribute_ruler', 'tagger'])
+        if 'senter' in nlp.disabled:
+            nlp.enable_pipe('senter')
+        elif 'senter' not in nlp.pipe_names:
+            nlp.add_pipe('sentencizer')
+        return lambda paragraphs: [[sent.text.strip() for sent in doc.sents if sent.text.strip()]
+                                   for doc in nlp.pipe(paragraphs, batch_size=batch_size)]
+    if mode == 'nltk':
+        from nltk.tokenize import sent_tokenize
+        return lambda paragraphs: [[sentence.strip() for line in paragraph.splitlines() for sentence in sent_tokenize(line)
+                                    if sentence.strip()] for paragraph in paragraphs]
+    if mode == 'rules':
+        return lambda paragraphs: [split_sentences(paragraph) for paragraph in paragraphs]
+    # Every paragraph stays one row, empty ones too, so positions match an unsegmented index
+    return lambda paragraphs: [[paragraph] for paragraph in paragraphs]
+
+def segment_pages(split, pages):
+    """Segments a batch of pages (lists of paragraphs) with one splitter call over all their paragraphs."""
+    paragraphs = [paragraph for page in pages for paragraph in page]
+    segmented = iter(split(paragraphs))
+    return [[sentence for _ in page for sentence in next(segmented)] for page in pages]
+
+_worker_split = None
+
+def _init_worker(mode, spacy_model, batch_size):
+    global _worker_split
+    _worker_split = load_splitter(mode, spacy_model, batch_size)
+
+def _segment_in_worker(pages):
+    return segment_pages(_worker_split, pages)
+
+class SegmentCache:
+    """Segmented pages keyed by the content hash of their source file, one JSON file each under folder."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, file_hash):
+        return os.path.join(self.folder, file_hash[:2], f"{file_hash}.json")
+
+    def get(self, file_hash):
+        try:
+            with open(self.path(file_hash), 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, file_hash, sentences):
+        path = self.path(file_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as file:
+            json.dump(sentences, file)
+        os.replace(f"{path}.tmp", path)
+
+    def prune(self, file_hashes):
+        """Deletes the entries of every file hash not in file_hashes."""
+        if not os.path.isdir(self.folder):
+            return
+        keep = set(file_hashes)
+        for prefix in os.listdir(self.folder):
+            prefix_folder = os.path.join(self.folder, prefix)
+            for name in os.listdir(prefix_folder):
+                if name[:-len('.json')] not in keep:
+                    os.remove(os.path.join(prefix_folder, name))
+
+class Segmenter:
+    """
+    Splits page paragraphs into sentences before they are indexed.
+
+    Modes: 'spacy' runs nlp.pipe with the en_core_web_sm sentence recognizer, 'nltk' the punkt
+    tokenizer, 'rules' the regex splitter in split_sentences, and 'none' keeps every paragraph as one row.
+    A mode whose library is missing falls back to 'rules'. With workers > 1, batches of
+    batch_pages pages are segmented in that many processes. With cache_folder set, the sentences of
+    every page are cached by its file hash, so unchanged pages are never segmented again.
+    """
+
+    def __init__(self, mode='rules', workers=1, cache_folder=None, spacy_model='en_core_web_sm', batch_size=64, batch_pages=32):
+        self.mode = resolve_mode(mode, spacy_model)
+        self.spacy_model = spacy_model
+        self.workers = workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.batch_pages = batch_pages
+        self.cache = SegmentCache(os.path.join(cache_folder, self.key.replace(':', '-'))) if cache_folder and self.mode != 'none' else None
+        self.split = None
+        self.stats = collections.Counter()
+
+    @property
+    def key(self):
+        """Names the segmentation an index was built with; pages segmented differently do not mix."""
+        return f"spacy:{self.spacy_model}" if self.mode == 'spacy' else self.mode
+
+    def segment(self, file_hash, paragraphs):
+        """Segments one page in this process."""
+        sentences = self.cache.get(file_hash) if self.cache is not None else None
+        if sentences is None:
+            sentences = self.segment_local([paragraphs])[0]
+            if self.cache is not None:
+                self.cache.put(file_hash, sentences)
+        return sentences
+
+    def segment_stream(self, pages):
+        """
+        Segments (key, file_hash, paragraphs) items into (key, file_hash, sentences) items, in order.
+        Cached pages pass straight through; the others are segmented in batches, several batches at
+        once across the worker processes.
+        """
+        executor = None
+        pending = collections.deque()
+        max_in_flight = 2 * self.workers
+        try:
+            for batch in self.batches(pages):
+                misses = [item for item in batch if item[2] is None]
+                # The regex splitter is cheaper than shipping pages to another process, so it always runs here
+                if misses and self.workers > 1 and self.mode in ('spacy', 'nltk'):
+                    if executor is None:
+                        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                       initializer=_init_worker, initargs=(self.mode, self.spacy_model, self.batch_size))
+                    future = executor.submit(_segment_in_worker, [paragraphs for _, _, _, paragraphs in misses])
+                else:
+                    future = self.segment_local([paragraphs for _, _, _, paragraphs in misses]) if misses else []
+                pending.append((batch, misses, future))
+                while len(pending) >= max_in_flight:
+                    yield from self.finish_batch(*pending.popleft())
+            while pending:
+                yield from self.finish_batch(*pending.popleft())
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    def batches(self, pages):
+        batch = []
+        for key, file_hash, paragraphs in pages:
+            sentences = self.cache.get(file_hash) if self.cache is not None and file_hash else None
+            batch.append([key, file_hash, sentences, paragraphs])
+            if len(batch) >= self.batch_pages:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def segment_local(self, pages):
+        if self.split is None:
+            self.split = load_splitter(self.mode, self.spacy_model, self.batch_size)
+        with tracer.span('build.segment', pages=len(pages), mode=self.mode):
+            return segment_pages(self.split, pages)
+
+    def finish_batch(self, batch, misses, future):
+        if isinstance(future, list):
+            segmented = future
+        else:
+            with tracer.span('build.wait_segments', pages=len(misses)):
+                segmented = future.result()
+        for item, sentences in zip(misses, segmented):
+            item[2] = sentences
+            if self.cache is not None and item[1]:
+                self.cache.put(item[1], sentences)
+        self.stats['cached_pages'] += len(batch) - len(misses)
+        self.stats['segmented_pages'] += len(misses)
+        for key, file_hash, sentences, paragraphs in batch:
+            self.stats['paragraphs'] += len(paragraphs)
+            self.stats['sentences'] += len(sentences)
+            yield key, file_hash, sentences
@@ -0,0 +1,194 @@
+import os
+import json
+import shutil
+import hashlib
+import heapq
+import faiss
+
+from concurrent.futures import ThreadPoolExecutor
+
+from autofaiss_index import AutoFaissSentenceSearch
+from encoders import load_sentence_model
+from tracing import tracer
+
+SHARDS_FOLDER = 'shards'
+SHARDS_MANIFEST = 'shards.json'
+SHARD_SCHEMES = ('source', 'hash')
+SOURCES = ('wikipedia', 'bing_search')
+
+def shard_names(shard_by, num_shards):
+    if shard_by == 'source':
+        return list(SOURCES)
+    return [f"hash-{shard:02d}" for shard in range(num_shards)]
+
+def shard_of(filename, shard_by, num_shards):
+    """Returns the shard a page belongs to, from its path relative to rag_database."""
+    if shard_by == 'source':
+        return filename.split('/', 1)[0]
+    return f"hash-{int(hashlib.md5(filename.encode()).hexdigest()[:8], 16) % num_shards:02d}"
+
+class ShardedSentenceSearch:
+    """
+    Splits the corpus over several index shards, either by source (wikipedia, bing_search) or by a
+    hash of each page's path into num_shards ranges.
+
+    Every shard is a complete index folder under index_folder/shards/<name> (faiss index, embedding
+    shards and corpus slice) that only indexes its own pages, so it can be built, rebuilt or reloaded
+    without touching the others. Queries are encoded once, searched on all shards in parallel (faiss
+    releases the GIL) and the per-shard top_k lists are merged by score.
+    """
+
+    def __init__(self, sentence_model, index_folder, max_index_memory_usage='10MB', shard_by=None, num_shards=4,
+                 search_threads=None, query_cache=None, **search_kwargs):
+        self.index_folder = os.path.abspath(index_folder)
+        manifest_path = os.path.join(self.index_folder, SHARDS_MANIFEST)
+        if shard_by is None:
+            # Searching: the layout comes from the last build
+            with open(manifest_path, 'r') as file:
+                manifest = json.load(file)
+            shard_by, num_shards = manifest['shard_by'], manifest['num_shards']
+        if shard_by not in SHARD_SCHEMES:
+            raise ValueError(f"shard_by must be one of {SHARD_SCHEMES}, got {shard_by!r}")
+
+        self.shard_by = shard_by
+        self.num_shards = num_shards
+        if isinstance(sentence_model, str):
+            model_name = sentence_model
+            sentence_model = load_sentence_model(sentence_model, search_kwargs.get('encoder_backend', 'torch'),
+                                                 search_kwargs.pop('encoder_threads', None))
+        else:
+            model_name = search_kwargs.pop('model_name', None)
+        self.sentence_model = sentence_model
+        self.query_cache = query_cache
+        self.shards = {}
+        for name in shard_names(shard_by, num_shards):
+            self.shards[name] = AutoFaissSentenceSearch(
+                sentence_model, os.path.join(self.index_folder, SHARDS_FOLDER, name), max_index_memory_usage,
+                model_name=model_name, file_filter=lambda filename, name=name: shard_of(filename, shard_by, num_shards) == name,
+                query_cache=query_cache, **search_kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=search_threads or len(self.shards))
+
+    @property
+    def searchable_shards(self):
+        return [shard for shard in self.shards.values() if shard.index is not None]
+
+    @property
+    def index_version(self):
+        # Changes when any shard is rebuilt
+        versions = [f"{name}:{shard.index_version}" for name, shard in self.shards.items() if shard.index is not None]
+        return hashlib.md5('\n'.join(versions).encode()).hexdigest()[:16]
+
+    @property
+    def sentence_model_name(self):
+        # Every shard encodes with the same model and backend
+        return next(iter(self.shards.values())).sentence_model_name
+
+    def build_index(self, full_rebuild=False, shards=None):
+        """
+        Builds or updates the shards named in shards (all of them by default). Each shard build is
+        incremental on its own; pages that moved to another shard are tombstoned in the old one.
+        """
+        with open(os.path.join(self.index_folder, SHARDS_MANIFEST), 'w') as file:
+            json.dump({'shard_by': self.shard_by, 'num_shards': self.num_shards}, file)
+        shards_folder = os.path.join(self.index_folder, SHARDS_FOLDER)
+        for name in os.listdir(shards_folder):
+            # Shards of an earlier layout
+            if name not in self.shards:
+                shutil.rmtree(os.path.join(shards_folder, name))
+
+        for name in shards or self.shards:
+            shard = self.shards[name]
+            has_index = os.path.exists(os.path.join(shard.index_folder, "knn.index"))
+            if not has_index and not shard.discover_json_files():
+                print(f"Shard {name}: no pages, skipped")
+                continue
+            print(f"Building shard {name}")
+            shard.build_index(full_rebuild=full_rebuild)
+
+    def load_index(self):
+        for shard in self.shards.values():
+            if os.path.exists(os.path.join(shard.index_folder, "knn.index")):
+                shard.load_index()
+
+    def load_dataframe(self):
+        for shard in self.searchable_shards:
+            shard.load_dataframe()
+
+    def index_stats(self):
+        shards = {shard_name: shard.index_stats() for shard_name, shard in self.shards.items() if shard.index is not None}
+        return {'index_folder': self.index_folder, 'sentences': sum(stats['sentences'] for stats in shards.values()),
+                'vectors': sum(stats['vectors'] for stats in shards.values()), 'shards': shards}
+
+    def search_sentences(self, query, top_k=5, context_size=3, search_filter=None, passages=False, max_passage_tokens=None):
+        return self.search_sentences_batch([query], top_k=top_k, context_size=context_size, search_filter=search_filter,
+                                           passages=passages, max_passage_tokens=max_passage_tokens)[0]
+
+    def search_sentences_batch(self, queries, top_k=5, context_size=3, search_filter=None, passages=False, max_passage_tokens=None):
+        """
+        Searches every shard for all queries and merges the per-shard top_k lists by score, keeping
+        the best hit of a sentence that several shards return. A search_filter is applied inside
+        each shard; shards without matching pages return nothing. With passages, each shard merges
+        the windows of its own hits and the passages are merged by their best score.
+
+        Returns:
+        list: One list of search_sentences style result dicts per query, in query order.
+        """
+        shards = self.searchable_shards
+        if not len(queries) or not shards:
+            return [[] for _ in queries]
+        with tracer.span('search', queries=len(queries), top_k=top_k, shards=len(shards)):
+            search = lambda queries: self.search_shards(shards, queries, top_k, context_size, search_filter, passages, max_passage_tokens)
+            if self.query_cache is not None:
+                return self.query_cache.search_batch(self.index_version, self.sentence_model_name, queries, top_k, context_size,
+                                                     search, search_filter,
+                                                     passages=(max_passage_tokens or 0) if passages else None)
+            return search(queries)
+
+    def search_shards(self, shards, queries, top_k, context_size, search_filter, passages=False, max_passage_tokens=None):
+        q_embeddings = shards[0].encode_queries(queries)
+        with tracer.span('search.shards', shards=len(shards)):
+            shard_results = list(self.executor.map(
+                lambda shard: shard.search_embeddings(q_embeddings, top_k, context_size, with_scores=True, search_filter=search_filter,
+                                                      passages=passages, max_passage_tokens=max_passage_tokens), shards))
+
+        # Inner product scores rank high to low, L2 distances low to high
+        sign = 1 if shards[0].index.metric_type == faiss.METRIC_INNER_PRODUCT else -1
+        text_key = 'Passage' if passages else 'Main Sentence'
+        batch_results = []
+        with tracer.span('search.merge', queries=len(queries)):
+            for query_results in zip(*shard_results):
+                hits = [hit for results in query_results for hit in results]
+                # Shards deduplicate only their own pages; the same sentence found in several shards is kept once
+                results = []
+                seen = set()
+                for _, result in heapq.nlargest(len(hits), hits, key=lambda hit: sign * hit[0]):
+                    if len(results) >= top_k:
+                        break
+                    if result[text_key] in seen:
+                        continue
+                    seen.add(result[text_key])
+                    results.append(result)
+                batch_results.append(results)
+        return batch_results
+
+def open_search(sentence_model, index_folder, max_index_memory_usage='10MB', index_load_mode='memory', search_params=None,
+                query_cache=None, encoder_backend='torch', encoder_threads=None):
+    """
+    Opens an index folder for searching, sharded or not, with its index and corpus loaded. A model
+    name is loaded with encoder_backend on encoder_threads torch threads; an already loaded model
+    is taken as loaded with encoder_backend.
+    """
+    if os.path.exists(os.path.join(index_folder, SHARDS_MANIFEST)):
+        afss = ShardedSentenceSearch(sentence_model, index_folder, max_index_memory_usage,
+                                     index_load_mode=index_load_mode, search_params=search_params, query_cache=query_cache,
+                                     encoder_backend=encoder_backend, encoder_threads=encoder_threads)
+    else:
+        afss = AutoFaissSentenceSearch(sentence_model=sentence_model, index_folder=index_folder,
+                                       max_index_memory_usage=max_index_memory_usage,
+                                       index_load_mode=index_load_mode, search_params=search_params, query_cache=query_cache,
+                                       encoder_backend=encoder_backend, encoder_threads=encoder_threads)
+    with tracer.span('search.load_index', load_mode=index_load_mode):
+        afss.load_index()
+    with tracer.span('search.load_dataframe'):
+        afss.load_dataframe()
+    return afss
@@ -0,0 +1,243 @@
+import os
+import json
+import atexit
+import time
+import threading
+
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the stage duration histogram buckets
+DURATION_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, float('inf'))
+
+class NullSpan:
+    """What span() returns while tracing is off: entering, leaving and set() do nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+NULL_SPAN = NullSpan()
+
+class Span:
+    __slots__ = ('tracer', 'name', 'attrs', 'start_ns', 'end_ns', 'thread_id', 'parent')
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.start_ns = self.end_ns = 0
+        self.thread_id = threading.get_ident()
+        self.parent = None
+
+    @property
+    def seconds(self):
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end_ns = time.perf_counter_ns()
+        self.tracer.stack().pop()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.tracer.finish(self)
+        return False
+
+class StageMetrics:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for bucket, upper_bound in enumerate(DURATION_BUCKETS):
+            if seconds <= upper_bound:
+                self.buckets[bucket] += 1
+                break
+
+class Tracer:
+    """
+    Process-wide stage timer. Code marks stages with `with tracer.span('search.encode'):` and
+    counts events with tracer.count(); while disabled both return immediately, so instrumented code
+    pays one attribute check per call. When enabled, every finished span updates per-stage duration
+    metrics and is passed to each sink.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sinks = []
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def enable(self, *sinks):
+        self.sinks.extend(sinks)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = []
+
+    def remove_sink(self, sink):
+        sink.close()
+        self.sinks.remove(sink)
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def span(self, name, **attrs):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, attrs)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self, span):
+        with self.lock:
+            if span.name not in self.stages:
+                self.stages[span.name] = StageMetrics()
+            self.stages[span.name].observe(span.seconds)
+        for sink in self.sinks:
+            sink.on_span(span)
+
+    def prometheus_text(self, prefix='mirage'):
+        """Returns the stage and counter metrics in the Prometheus text exposition format."""
+        with self.lock:
+            stages = {name: (metrics.count, metrics.total, metrics.max, list(metrics.buckets))
+                      for name, metrics in self.stages.items()}
+            counters = dict(self.counters)
+
+        lines = [f"# HELP {prefix}_stage_seconds Time spent in each pipeline stage.",
+                 f"# TYPE {prefix}_stage_seconds histogram"]
+        for name, (count, total, _, buckets) in sorted(stages.items()):
+            cumulative = 0
+            for upper_bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                cumulative += bucket_count
+                le = '+Inf' if upper_bound == float('inf') else repr(upper_bound)
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {total}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {count}')
+        lines += [f"# HELP {prefix}_stage_seconds_max Longest single run of each pipeline stage.",
+                  f"# TYPE {prefix}_stage_seconds_max gauge"]
+        for name, (_, _, longest, _) in sorted(stages.items()):
+            lines.append(f'{prefix}_stage_seconds_max{{stage="{name}"}} {longest}')
+        for name, value in sorted(counters.items()):
+            metric = f"{prefix}_{name.replace('.', '_')}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        return '\n'.join(lines) + '\n'
+
+tracer = Tracer()
+
+class JsonLogSink:
+    """Appends one JSON object per finished span to path."""
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def on_span(self, span):
+        record = {'stage': span.name, 'seconds': span.seconds, 'start_ns': span.start_ns, 'parent': span.parent,
+                  'pid': os.getpid(), 'thread': span.thread_id, **span.attrs}
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        self.file.close()
+
+class PrometheusSink:
+    """Writes the tracer's metrics to path in the Prometheus text format when closed or flushed."""
+
+    def __init__(self, path, tracer=tracer):
+        self.path = path
+        self.tracer = tracer
+
+    def on_span(self, span):
+        pass
+
+    def flush(self):
+        with open(f"{self.path}.tmp", 'w') as file:
+            file.write(self.tracer.prometheus_text())
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def close(self):
+        self.flush()
+
+class ChromeTraceSink:
+    """Collects spans as Chrome trace events and writes them to path (open in chrome://tracing or Perfetto) when closed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self.lock = threading.Lock()
+
+    def on_span(self, span):
+        event = {'name': span.name, 'cat': span.name.split('.')[0], 'ph': 'X', 'ts': span.start_ns / 1000,
+                 'dur': (span.end_ns - span.start_ns) / 1000, 'pid': os.getpid(), 'tid': span.thread_id,
+                 'args': {key: str(value) for key, value in span.attrs.items()}}
+        with self.lock:
+            self.events.append(event)
+
+    def close(self):
+        with open(self.path, 'w') as file:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, file)
+
+@contextmanager
+def chrome_trace(path):
+    """Traces everything inside the block, e.g. a single query, into a Chrome trace file at path."""
+    sink = ChromeTraceSink(path)
+    was_enabled = tracer.enabled
+    tracer.enable(sink)
+    try:
+        yield sink
+    finally:
+        tracer.remove_sink(sink)
+        tracer.enabled = was_enabled
+
+def configure_tracing(section):
+    """
+    Enables tracing from a config.txt section: tracing=True turns it on, trace_log names a JSON lines
+    file and metrics_file a Prometheus text file written at exit.
+    """
+    if not section.getboolean('tracing', False):
+        return tracer
+    sinks = []
+    if section.get('trace_log', ''):
+        sinks.append(JsonLogSink(section['trace_log']))
+    if section.get('metrics_file', ''):
+        sinks.append(PrometheusSink(section['metrics_file']))
+    tracer.enable(*sinks)
+    # Closing the sinks flushes the JSON log and writes the metrics file
+    atexit.register(tracer.disable)
+    return tracer
@@ -1,18 +1,38 @@
 import os
 import json
+import time
 import hashlib
+import threading
+import requests
 import wikipediaapi
 
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from crawl_manifest import open_manifest
+
 def md5_hash(sentence):
     return hashlib.md5(sentence.encode()).hexdigest()
 
 class WikipediaPageFetcher:
-    def __init__(self, user_agent, language='en', extract_format=wikipediaapi.ExtractFormat.WIKI):
+    def __init__(self, user_agent, language='en', extract_format=wikipediaapi.ExtractFormat.WIKI, api_url=None, manifest=None):
         self.wiki_wiki = wikipediaapi.Wikipedia(
             user_agent=user_agent,
             language=language,
             extract_format=extract_format
         )
+        self.user_agent = user_agent
+        self.api_url = api_url or f"https://{language}.wikipedia.org/w/api.php"
+        self.local = threading.local()
+        self.manifest_instance = manifest
+
+    @property
+    def manifest(self):
+        # The crawl manifest of rag_database under the working directory, like the page files;
+        # looked up on every use so a recreated database is picked up
+        if self.manifest_instance is None:
+            return open_manifest(os.path.join(os.getcwd(), 'rag_database'))
+        return self.manifest_instance
 
     def get_wikipedia_page_content(self, page_title):
         """
@@ -32,69 +52,150 @@ class WikipediaPageFetcher:
     def save_content_to_file(self, page, base_folder='wikipedia'):
         if not page:
             return "Page not found"
+        return self.save_page_data(page.title, page.fullurl, page.text, base_folder)
 
-        page_title = page.title
-        content = page.text
-        hash_value = md5_hash(page_title)
-        file_name = f"{hash_value}.json"
+    def page_file_path(self, page_title, base_folder='wikipedia'):
         folder_path = os.path.join(os.getcwd(), 'rag_database', base_folder)
-        file_path = os.path.join(folder_path, file_name)
+        return os.path.join(folder_path, f"{md5_hash(page_title)}.json")
 
-        os.makedirs(folder_path, exist_ok=True)
+    def save_page_data(self, page_title, page_url, content, base_folder='wikipedia'):
+        hash_value = md5_hash(page_title)
+        file_path = self.page_file_path(page_title, base_folder)
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
         # Extracting a short description from the content
         description = ' '.join(content.split('\n')[:2]) if content else ''
 
         page_data = {
             "Title": page_title,
-            "Link": page.fullurl,
+            "Link": page_url,
             "Description": description,
             "Position": "",
             "PageText": content.split("\n"),
             "Hash": hash_value
         }
 
-        with open(file_path, 'w', encoding='utf-8') as file:
-            json.dump(page_data, file, indent=4)
+        # Recorded in the manifest; a page whose content has not changed is not rewritten
+        self.manifest.write_file(file_path, json.dumps(page_data, indent=4).encode('utf-8'), page_url or None)
 
         return f"Content saved to {file_path}"
-    
-    def fetch_pages_from_file(self, file_path, base_folder='wikipedia'):
+
+    def session(self):
+        # One keep-alive session per worker thread
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+            self.local.session.headers['User-Agent'] = self.user_agent
+        return self.local.session
+
+    def fetch_page_extract(self, page_title, retries=3, backoff=1.0, timeout=20):
+        """
+        Fetches the plain text extract and URL of one page straight from the MediaWiki API,
+        retrying connection errors, 429 and 5xx responses with exponential backoff.
+
+        Returns:
+        dict: {'title', 'fullurl', 'extract'} of the page, or None if it does not exist.
+        """
+        params = {
+            'action': 'query',
+            'format': 'json',
+            'formatversion': 2,
+            'prop': 'extracts|info',
+            'explaintext': 1,
+            'inprop': 'url',
+            'redirects': 1,
+            'titles': page_title
+        }
+        for attempt in range(retries + 1):
+            try:
+                response = self.session().get(self.api_url, params=params, timeout=timeout)
+                if response.status_code == 200:
+                    pages = response.json().get('query', {}).get('pages', [])
+                    if not pages or pages[0].get('missing') or pages[0].get('invalid'):
+                        return None
+                    return pages[0]
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == retries:
+                    raise
+                print(f"Retrying {page_title} after error: {e}")
+            if attempt < retries:
+                time.sleep(backoff * 2 ** attempt)
+        raise requests.HTTPError(f"Giving up on {page_title} after {retries + 1} attempts")
+
+    def download_page(self, page_title, base_folder='wikipedia', retries=3, backoff=1.0):
+        page = self.fetch_page_extract(page_title, retries=retries, backoff=backoff)
+        if page is None:
+            return None
+        # Saved under the title exactly as requested, not the one the API resolved redirects and
+        # capitalisation to, as save_content_to_file does, so every run finds the page under one name
+        self.save_page_data(page_title, page.get('fullurl', ''), page.get('extract', ''), base_folder)
+        if page.get('fullurl'):
+            # 'touched' is the page's last change; the API sends no validators for conditional requests
+            self.manifest.record_fetch(page['fullurl'], 200, md5_hash(page.get('extract', '')), last_modified=page.get('touched'))
+        return page['title']
+
+    def fetch_pages_bulk(self, page_titles, base_folder='wikipedia', max_workers=8, retries=3, backoff=1.0, recrawl_after=None):
+        """
+        Downloads many pages concurrently with a bounded worker pool, skipping titles whose
+        md5-named JSON the crawl manifest already records.
+
+        Args:
+        page_titles (list): Titles to download; duplicates are fetched once.
+        base_folder (str): Base folder where the content will be saved.
+        max_workers (int): Number of concurrent downloads.
+        retries (int): Retries per page on connection errors, 429 and 5xx responses.
+        backoff (float): Initial retry delay in seconds, doubled after each attempt.
+        recrawl_after (float): Also re-fetch pages last fetched more than this many seconds ago.
+
+        Returns:
+        dict: Counts of downloaded, skipped, missing and failed titles, and pages_per_sec.
+        """
+        # md5 of the title as given, like save_content_to_file: 'python' and 'Python' are separate files
+        titles = list(dict.fromkeys(title.strip() for title in page_titles if title.strip()))
+        # Pages saved before the manifest existed or by other tools are recorded first, so they are not
+        # downloaded again; only whether a page exists matters here, so unchanged folders are skipped
+        self.manifest.sync(changed_folders_only=True)
+        pending = [title for title in titles if self.manifest.needs_fetch(self.page_file_path(title, base_folder), recrawl_after)]
+        stats = {'downloaded': 0, 'skipped': len(titles) - len(pending), 'missing': 0, 'failed': 0}
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self.download_page, title, base_folder, retries, backoff): title for title in pending}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    if future.result() is None:
+                        stats['missing'] += 1
+                        print(f"Page not found: {futures[future]}")
+                    else:
+                        stats['downloaded'] += 1
+                except requests.RequestException as e:
+                    stats['failed'] += 1
+                    print(f"Failed to download {futures[future]}: {e}")
+        elapsed = max(time.perf_counter() - start_time, 1e-9)
+
+        stats['pages_per_sec'] = stats['downloaded'] / elapsed
+        print(f"Downloaded {stats['downloaded']} pages in {elapsed:.2f}s ({stats['pages_per_sec']:.1f} pages/sec), "
+              f"skipped {stats['skipped']}, missing {stats['missing']}, failed {stats['failed']}")
+        return stats
+
+    def fetch_pages_from_file(self, file_path, base_folder='wikipedia', max_workers=8):
         """
         Reads a list of page titles from a file and downloads each page if not already downloaded.
 
         Args:
         file_path (str): Path to the file containing page titles.
         base_folder (str): Base folder where the content will be saved.
+        max_workers (int): Number of concurrent downloads.
 
         Returns:
-        None
+        dict: Download counts, see fetch_pages_bulk.
         """
         with open(file_path, 'r', encoding='utf-8') as file:
-            page_titles = file.readlines()
-
-        for title in page_titles:
-            title = title.strip()
-            if title:
-                # Sanitize file name and check if it already exists
-                sanitized_title = title.replace(" ", "_").replace("/", "_") + '.txt'
-                
-                current_working_directory = os.getcwd()
-                folder_path = os.path.join(current_working_directory,'rag_database', base_folder)
-                file_path = os.path.join(folder_path, sanitized_title)
-                
-                if os.path.exists(file_path):
-                    print(f"File already exists for page: {title}")
-                    continue
-
-                content = self.get_wikipedia_page_content(title)
-                if content != "Page not found":
-                    self.save_content_to_file(content, title, base_folder)
-                    print(f"Downloaded and saved page: {title}")
-                else:
-                    print(f"Page not found: {title}")
-                    
-                    
+            page_titles = file.read().splitlines()
+        return self.fetch_pages_bulk(page_titles, base_folder, max_workers=max_workers)
+
     # def upload_files_to_s3(self, folder_path, bucket_name, s3_folder):
     #     """
     #     Uploads files from a local directory to an S3 bucket.